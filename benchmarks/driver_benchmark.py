@@ -0,0 +1,174 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""End-to-end benchmark of CloudByteBlockDeviceAPI against local fakes.
+
+Runs create_volume, attach_volume, list_volumes, detach_volume and
+destroy_volume against the fake ElastiCenter and fake iscsiadm, and
+reports wall time, REST calls and iscsiadm subprocesses per operation.
+
+    python benchmarks/driver_benchmark.py --volumes 5 --latency 0.005
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cloudbyte_flocker_driver import cloudbyte
+from cloudbyte_flocker_driver.testtools import fake_elasticenter
+from cloudbyte_flocker_driver.testtools import fake_iscsiadm
+from cloudbyte_flocker_driver.testtools import fake_multipathd
+
+OPERATIONS = ['create_volume', 'attach_volume', 'list_volumes',
+              'detach_volume', 'destroy_volume']
+
+
+class Environment(object):
+    """A fake ElastiCenter, fake iscsiadm root and a driver wired to them.
+
+    With ``extra_portals`` the VSM advertises its targets on that many more
+    portals and the driver attaches through fake dm-multipath. With
+    ``vsms`` above 1 the account has that many VSMs and the driver places
+    volumes across all of them.
+    """
+
+    def __init__(self, latency, job_duration, inventory_size, driver_config,
+                 extra_portals=0, vsms=1):
+        self.root = tempfile.mkdtemp(prefix='cloudbyte-bench-')
+        fake_iscsiadm.prepare_root(self.root)
+
+        portals = ['127.0.1.%d' % (i + 1) for i in range(extra_portals)]
+        self.elasticenter = fake_elasticenter.FakeElastiCenter(
+            latency=latency, job_duration=job_duration,
+            inventory_size=inventory_size, iscsi_root=self.root,
+            vsm_portals=portals,
+            extra_vsms=['VSM%d' % (i + 2) for i in range(vsms - 1)])
+        self.server = fake_elasticenter.serve(self.elasticenter)
+
+        config = dict(
+            elasticenter_ip='127.0.0.1:%d' % self.server.server_port,
+            elasticenter_protocol='http',
+            apikey='benchmark',
+            vsm_name='VSM1',
+            account_name='Account1',
+            iscsiadm_command=fake_iscsiadm.command_line(self.root),
+            disk_by_path_dir=fake_iscsiadm.by_path_dir(self.root),
+            state_path=os.path.join(self.root, 'state.db'),
+            sysfs_root=fake_iscsiadm.sysfs_root(self.root),
+        )
+        if vsms > 1:
+            config['vsms'] = ['VSM%d' % (i + 1) for i in range(vsms)]
+        if extra_portals:
+            config.update(
+                multipath=True,
+                multipathd_command=fake_multipathd.command_line(self.root),
+                multipath_conf_dir=os.path.join(self.root, 'multipath'),
+                multipath_install_command='install -D -m 0644')
+        config.update(driver_config)
+        self.api = cloudbyte.cloudbyte_from_configuration(
+            uuid.uuid4(), **config)
+
+    def rest_calls(self):
+        return sum(self.elasticenter.request_counts.values())
+
+    def subprocesses(self):
+        try:
+            with open(os.path.join(self.root, 'calls.log')) as log:
+                return sum(1 for _ in log)
+        except IOError:
+            return 0
+
+    def measure(self, results, operation, fn, *args):
+        rest, procs = self.rest_calls(), self.subprocesses()
+        start = time.time()
+        value = fn(*args)
+        results[operation].append((time.time() - start,
+                                   self.rest_calls() - rest,
+                                   self.subprocesses() - procs))
+        return value
+
+    def close(self):
+        self.api.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+
+def run(env, volumes, size):
+    results = dict((operation, []) for operation in OPERATIONS)
+    api = env.api
+    node = api.compute_instance_id()
+
+    for _ in range(volumes):
+        volume = env.measure(results, 'create_volume', api.create_volume,
+                             uuid.uuid4(), size)
+        env.measure(results, 'attach_volume', api.attach_volume,
+                    volume.blockdevice_id, node)
+        env.measure(results, 'list_volumes', api.list_volumes)
+        env.measure(results, 'detach_volume', api.detach_volume,
+                    volume.blockdevice_id)
+        env.measure(results, 'destroy_volume', api.destroy_volume,
+                    volume.blockdevice_id)
+    return results
+
+
+def report(results, out=sys.stdout):
+    out.write('%-16s %6s %10s %10s %10s %8s\n' % (
+        'operation', 'runs', 'mean ms', 'max ms', 'rest/op', 'procs/op'))
+    for operation in OPERATIONS:
+        samples = results[operation]
+        if not samples:
+            continue
+        runs = len(samples)
+        walls = [wall for wall, _, _ in samples]
+        out.write('%-16s %6d %10.1f %10.1f %10.1f %8.1f\n' % (
+            operation, runs, 1000 * sum(walls) / runs, 1000 * max(walls),
+            float(sum(rest for _, rest, _ in samples)) / runs,
+            float(sum(procs for _, _, procs in samples)) / runs))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--volumes', type=int, default=5,
+                        help='volumes to run through the full lifecycle')
+    parser.add_argument('--size', type=int, default=cloudbyte.ALLOCATION_UNIT,
+                        help='volume size in bytes')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every ElastiCenter request')
+    parser.add_argument('--job-duration', type=float, default=0.0,
+                        help='seconds an async job takes to finish')
+    parser.add_argument('--inventory', type=int, default=0,
+                        help='volumes of other tenants on the ElastiCenter')
+    parser.add_argument('--multipath-portals', type=int, default=0,
+                        help='extra VSM portals to attach through multipath')
+    parser.add_argument('--vsms', type=int, default=1,
+                        help='VSMs to place volumes across')
+    parser.add_argument('--show-metrics', action='store_true',
+                        help="print the driver's Prometheus metrics")
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a Chrome trace of every operation')
+    args = parser.parse_args(argv)
+
+    driver_config = {'metrics_enabled': args.show_metrics}
+    if args.trace:
+        driver_config.update(tracing_file=args.trace, tracing_format='chrome',
+                             tracing_sample_rate=1.0)
+
+    env = Environment(args.latency, args.job_duration, args.inventory,
+                      driver_config, args.multipath_portals, args.vsms)
+    try:
+        report(run(env, args.volumes, args.size))
+        if args.show_metrics:
+            sys.stdout.write(env.api.metrics.render())
+    finally:
+        env.close()
+
+
+if __name__ == '__main__':
+    main()
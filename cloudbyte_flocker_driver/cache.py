@@ -0,0 +1,142 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""In-memory caches for ElastiCenter metadata."""
+
+import threading
+import time
+
+
+class TTLCache(object):
+    """Thread-safe key/value cache where every entry expires on its own."""
+
+    def __init__(self, default_ttl=300):
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        # key -> (value, expires_at)
+        self._entries = {}
+
+    def get(self, key):
+        """Return the cached value, or None if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.default_ttl
+        # A ttl of zero or less disables caching
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RefreshingSnapshot(object):
+    """Shared copy of a listing that a background thread keeps fresh.
+
+    Readers get the last fetched value while it is at most ``max_stale``
+    seconds old; older (or invalidated) values are fetched again inline.
+    """
+
+    def __init__(self, fetch, interval=15, max_stale=None):
+        self._fetch = fetch
+        self.interval = interval
+        if max_stale is None:
+            max_stale = interval * 3
+        self.max_stale = max_stale
+
+        self._lock = threading.Lock()
+        self._value = None
+        self._fetched_at = None
+        # Bumped on invalidate so in-flight fetches don't store old data
+        self._generation = 0
+
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def get(self, fresh=False):
+        """Return the listing, fetching it first when fresh is requested."""
+
+        # A non positive interval disables the snapshot
+        if fresh or self.interval <= 0:
+            return self.refresh()
+
+        self._start()
+
+        with self._lock:
+            value, fetched_at = self._value, self._fetched_at
+
+        if value is None or time.time() - fetched_at > self.max_stale:
+            return self.refresh()
+        return value
+
+    def refresh(self):
+        """Fetch the listing now and store it as the current snapshot."""
+
+        with self._lock:
+            generation = self._generation
+
+        value = self._fetch()
+
+        with self._lock:
+            if generation == self._generation:
+                self._value = value
+                self._fetched_at = time.time()
+        return value
+
+    def seed(self, value, fetched_at):
+        """Start from a listing fetched earlier, e.g. before a restart."""
+
+        with self._lock:
+            if self._value is None:
+                self._value = value
+                self._fetched_at = fetched_at
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._value = None
+            self._fetched_at = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None or self._stopped.is_set():
+                return
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the previous snapshot, readers fall back
+                # to an inline fetch once it is too old
+                pass
+
+    def stop(self, timeout=None):
+        """Stop refreshing, waiting up to timeout for a running refresh."""
+
+        self._stopped.set()
+        with self._lock:
+            thread = self._thread
+        if thread is not None and timeout:
+            thread.join(timeout)
@@ -1,14 +1,13 @@
 # Copyright 2016 CloudByte Inc
 # See LICENSE file for details.
 
+import atexit
 import threading
 import time
+import collections
 import socket
-import shlex
 import uuid
 import six
-import json
-import subprocess
 import os.path
 
 from six.moves import http_client
@@ -21,8 +20,36 @@ from flocker.node.agents.blockdevice import (
     UnattachedVolume,IProfiledBlockDeviceAPI,
 )
 
+from cloudbyte_flocker_driver import cache
+from cloudbyte_flocker_driver import concurrency
+from cloudbyte_flocker_driver import connection
+from cloudbyte_flocker_driver import devices
+from cloudbyte_flocker_driver import iscsi
+from cloudbyte_flocker_driver import jobs
+from cloudbyte_flocker_driver import jsonstream
+from cloudbyte_flocker_driver import metrics
+from cloudbyte_flocker_driver import multipath
+from cloudbyte_flocker_driver import placement
+from cloudbyte_flocker_driver import qos
+from cloudbyte_flocker_driver import ratelimit
+from cloudbyte_flocker_driver import state
+from cloudbyte_flocker_driver import tracing
+from cloudbyte_flocker_driver import volumes as cb_volume_index
+from cloudbyte_flocker_driver import warmpool
+
 ALLOCATION_UNIT = GiB(1).bytes
 
+# Outcome of one volume in a bulk operation; error is None on success
+VolumeResult = collections.namedtuple(
+    'VolumeResult', ['request', 'volume', 'error'])
+
+# CloudByte commands that only read state and are safe to share
+READ_ONLY_COMMANDS = frozenset([
+    'listAccount', 'listTsm', 'listFileSystem', 'listVolumeiSCSIService',
+    'listiSCSIInitiator', 'queryAsyncJobResult', 'listQosGroup',
+    'listStorageSnapshots',
+])
+
 @implementer(IBlockDeviceAPI)
 @implementer(IProfiledBlockDeviceAPI)
 class CloudByteBlockDeviceAPI(object):
@@ -43,8 +70,117 @@ class CloudByteBlockDeviceAPI(object):
         self.cb_create_volume = kwargs.get('create_volume', {'blocklength': '512B', 'compression': 'off', 'deduplication': 'off',
                                                                 'sync': 'always', 'recordsize': '16k', 'protocoltype': 'ISCSI'})
         self.profiles = self._set_profiles(kwargs.get('profiles', None))
+        self.cb_templates = kwargs.get('templates', {})
+        self.cb_template_snapshot = kwargs.get('template_snapshot', 'flocker-template')
+        self.cb_vsms = self._set_vsms(kwargs.get('vsms', None))
+        # The first VSM is the primary one
+        self.cb_tsm_name, self.cb_account_name = self.cb_vsms[0]
         self._verify_basic_configuration(self.cb_tsm_name, self.cb_account_name, self.cb_apikey, self.san_ip)
 
+        self.cb_metrics_enabled = kwargs.get('metrics_enabled', False)
+        self.cb_metrics_host = kwargs.get('metrics_host', '127.0.0.1')
+        self.cb_metrics_port = kwargs.get('metrics_port', None)
+        self.cb_metrics_file = kwargs.get('metrics_file', None)
+        self.cb_metrics_dump_interval = kwargs.get('metrics_dump_interval', 15)
+        self.metrics = self._set_metrics()
+
+        self.cb_tracing_sample_rate = kwargs.get('tracing_sample_rate', 0.0)
+        self.cb_tracing_file = kwargs.get('tracing_file', None)
+        self.cb_tracing_format = kwargs.get('tracing_format', 'jsonl')
+        self.tracer = self._set_tracer()
+
+        self.cb_connection_pool_size = kwargs.get('connection_pool_size', 4)
+        self.cb_connection_idle_timeout = kwargs.get('connection_idle_timeout', 60)
+        self.cb_elasticenter_protocol = kwargs.get('elasticenter_protocol', 'https')
+        self._connection_pool = connection.get_pool(
+            self.san_ip, self.cb_connection_pool_size, self.cb_connection_idle_timeout,
+            self.cb_elasticenter_protocol)
+
+        self.cb_api_read_rate_limit = kwargs.get('api_read_rate_limit', 0)
+        self.cb_api_read_burst = kwargs.get('api_read_burst', None)
+        self.cb_api_read_max_concurrency = kwargs.get('api_read_max_concurrency', 16)
+        self.cb_api_write_rate_limit = kwargs.get('api_write_rate_limit', 0)
+        self.cb_api_write_burst = kwargs.get('api_write_burst', None)
+        self.cb_api_write_max_concurrency = kwargs.get('api_write_max_concurrency', 8)
+        self.cb_api_latency_tolerance = kwargs.get('api_latency_tolerance', 2.0)
+        self._read_budget = ratelimit.Budget(
+            'read', self.cb_api_read_rate_limit, self.cb_api_read_burst,
+            self.cb_api_read_max_concurrency, self.cb_api_latency_tolerance,
+            registry=self.metrics)
+        self._write_budget = ratelimit.Budget(
+            'write', self.cb_api_write_rate_limit, self.cb_api_write_burst,
+            self.cb_api_write_max_concurrency, self.cb_api_latency_tolerance,
+            registry=self.metrics)
+
+        self.cb_metadata_cache_ttl = kwargs.get('metadata_cache_ttl', 300)
+        self._metadata_cache = cache.TTLCache(self.cb_metadata_cache_ttl)
+        self._in_flight_requests = concurrency.SingleFlight()
+
+        self.cb_bulk_workers = kwargs.get('bulk_workers', 8)
+        self.cb_job_poll_initial_interval = kwargs.get('job_poll_initial_interval', 0.25)
+        self._job_tracker = jobs.AsyncJobTracker(
+            self.cb_job_poll_initial_interval,
+            max(self.cb_confirm_volume_create_retry_interval,
+                self.cb_confirm_volume_delete_retry_interval),
+            workers=self.cb_bulk_workers)
+
+        self.cb_disk_by_path_dir = kwargs.get('disk_by_path_dir', devices.DISK_BY_PATH)
+        self._instance_id = None
+
+        self.cb_device_wait_timeout = kwargs.get('device_wait_timeout', 10)
+        self._device_waiter = devices.DeviceWaiter(
+            registry=self.metrics, tracer=self.tracer)
+
+        self.cb_sysfs_root = kwargs.get('sysfs_root', devices.SYSFS_ROOT)
+        self._queue_tuner = devices.QueueTuner(
+            self.cb_sysfs_root, registry=self.metrics, tracer=self.tracer)
+
+        self.cb_iscsiadm_command = kwargs.get('iscsiadm_command', 'sudo iscsiadm')
+        self.cb_iscsi_discovery_ttl = kwargs.get('iscsi_discovery_ttl', 300)
+        self.cb_iscsi_session_ttl = kwargs.get('iscsi_session_ttl', 5)
+        self._iscsi = iscsi.ISCSISessionManager(
+            self.cb_iscsiadm_command, self.cb_iscsi_discovery_ttl,
+            registry=self.metrics, tracer=self.tracer,
+            session_ttl=self.cb_iscsi_session_ttl)
+
+        self.cb_multipath = kwargs.get('multipath', False)
+        self.cb_multipath_policy = kwargs.get('multipath_policy', 'round-robin')
+        self.cb_multipathd_command = kwargs.get('multipathd_command', 'sudo multipathd')
+        self.cb_multipath_conf_dir = kwargs.get('multipath_conf_dir', multipath.DEFAULT_CONF_DIR)
+        self.cb_multipath_vendor = kwargs.get('multipath_vendor', multipath.DEFAULT_VENDOR)
+        self.cb_multipath_install_command = kwargs.get('multipath_install_command', multipath.DEFAULT_INSTALL_COMMAND)
+        self._multipath = self._set_multipath()
+
+        self.cb_filesystem_page_size = kwargs.get('filesystem_page_size', 500)
+
+        self.cb_filesystem_snapshot_interval = kwargs.get('filesystem_snapshot_interval', 15)
+        self.cb_filesystem_snapshot_max_stale = kwargs.get('filesystem_snapshot_max_stale', None)
+        self._filesystem_snapshot = cache.RefreshingSnapshot(
+            self._request_filesystems, self.cb_filesystem_snapshot_interval,
+            self.cb_filesystem_snapshot_max_stale)
+
+        self.cb_state_path = kwargs.get('state_path', state.DEFAULT_STATE_PATH)
+        self._state = self._set_state()
+
+        self.cb_qos_group_mode = kwargs.get('qos_group_mode', 'shared')
+        self.cb_qos_gc_interval = kwargs.get('qos_gc_interval', 3600)
+        self.cb_qos_gc_grace = kwargs.get('qos_gc_grace', 600)
+        if self.cb_qos_group_mode not in qos.QOS_GROUP_MODES:
+            raise Exception("Unable to initialize CloudByte Plugin. "
+                            "Unknown qos_group_mode [" +
+                            str(self.cb_qos_group_mode) + "].")
+        self._qos_groups = qos.QoSGroupManager(
+            self, self.cb_qos_gc_interval, self.cb_qos_gc_grace)
+
+        self.cb_placement_cache_ttl = kwargs.get('placement_cache_ttl', 30)
+        self._placement = placement.PlacementScheduler(
+            self, self.cb_placement_cache_ttl)
+
+        self.cb_warm_pool = kwargs.get('warm_pool', None)
+        self.cb_warm_pool_refill_interval = kwargs.get('warm_pool_refill_interval', 30)
+        self.cb_warm_pool_idle_timeout = kwargs.get('warm_pool_idle_timeout', 3600)
+        self._warm_pool = self._set_warm_pool()
+
     def _verify_basic_configuration(self, cb_tsm_name, cb_account_name, cb_apikey, san_ip):
         err_msg = "Unable to initialize CloudByte Plugin. Missing configuration: "
         
@@ -57,23 +193,178 @@ class CloudByteBlockDeviceAPI(object):
         if not san_ip:
             raise Exception(err_msg + "elasticenter_ip")
     
+    def _set_metrics(self):
+        registry = metrics.Registry(self.cb_metrics_enabled)
+
+        self._api_latency = registry.histogram(
+            'cloudbyte_api_request_seconds',
+            'Latency of ElastiCenter API requests.', ['command', 'status'])
+        self._api_requests = registry.counter(
+            'cloudbyte_api_requests_total',
+            'ElastiCenter API requests sent.', ['command', 'status'])
+        self._api_in_flight = registry.gauge(
+            'cloudbyte_api_requests_in_flight',
+            'ElastiCenter API requests awaiting a response.', ['command'])
+        self._job_wait_latency = registry.histogram(
+            'cloudbyte_job_wait_seconds',
+            'Time spent waiting for CloudByte async jobs.',
+            ['operation', 'outcome'])
+        self._jobs_in_flight = registry.gauge(
+            'cloudbyte_jobs_in_flight',
+            'CloudByte async jobs being waited on.', ['operation'])
+
+        if self.cb_metrics_enabled:
+            if self.cb_metrics_port:
+                metrics.serve(registry, self.cb_metrics_port, self.cb_metrics_host)
+            if self.cb_metrics_file:
+                metrics.dump_periodically(registry, self.cb_metrics_file,
+                                          self.cb_metrics_dump_interval)
+        return registry
+
+    def _set_tracer(self):
+        exporter = None
+        if self.cb_tracing_file and self.cb_tracing_sample_rate > 0:
+            exporter_class = tracing.EXPORTERS.get(self.cb_tracing_format)
+            if exporter_class is None:
+                raise Exception("Unable to initialize CloudByte Plugin. "
+                                "Unknown tracing_format [" +
+                                str(self.cb_tracing_format) + "].")
+            exporter = exporter_class(self.cb_tracing_file)
+        return tracing.Tracer(self.cb_tracing_sample_rate, exporter)
+
+    def _set_multipath(self):
+        if not self.cb_multipath:
+            return None
+
+        if self.cb_multipath_policy not in multipath.PATH_SELECTORS:
+            raise Exception("Unable to initialize CloudByte Plugin. "
+                            "Unknown multipath_policy [" +
+                            str(self.cb_multipath_policy) + "].")
+        return multipath.MultipathManager(
+            self._iscsi, self._device_waiter, self._get_expected_disk_path,
+            self.cb_multipathd_command, self.cb_multipath_policy,
+            self.cb_multipath_conf_dir, self.cb_multipath_vendor,
+            self.cb_disk_by_path_dir, registry=self.metrics,
+            tracer=self.tracer, install=self.cb_multipath_install_command)
+
+    def _set_state(self):
+        store = state.open_store(self.cb_state_path)
+
+        # Pick up where the previous run left off; entries keep only
+        # the remainder of their TTL
+        now = time.time()
+        for key, value, updated in store.metadata():
+            ttl = self.cb_metadata_cache_ttl - (now - updated)
+            self._metadata_cache.set(key, value, ttl)
+
+        cb_volumes, listed_at = store.listing()
+        if cb_volumes is not None:
+            self._filesystem_snapshot.seed(cb_volumes, listed_at)
+        return store
+
+    def _remember(self, key, value):
+        """Cache an ElastiCenter id and keep it across restarts."""
+
+        self._metadata_cache.set(key, value)
+        self._state.set_metadata(key, value)
+
+    def _set_vsms(self, vsms):
+        if not vsms:
+            return [(self.cb_tsm_name, self.cb_account_name)]
+
+        # A VSM is its name, or a dict of vsm_name and account_name
+        parsed = []
+        for vsm in vsms:
+            if not isinstance(vsm, dict):
+                vsm = {'vsm_name': vsm}
+            vsm_name = vsm.get('vsm_name')
+            account_name = vsm.get('account_name', self.cb_account_name)
+            if not vsm_name or not account_name:
+                raise Exception("Unable to initialize CloudByte Plugin. "
+                                "Missing vsm_name or account_name in vsms.")
+            parsed.append((vsm_name, account_name))
+        return parsed
+
+    def _set_warm_pool(self):
+        if not self.cb_warm_pool:
+            return None
+
+        buckets = []
+        for bucket in self.cb_warm_pool:
+            profile = bucket.get('profile')
+            if profile and profile not in self.profiles:
+                raise Exception("Unable to initialize CloudByte Plugin. "
+                                "Unknown warm_pool profile [" + profile + "].")
+            buckets.append(warmpool.Bucket(
+                profile, bucket.get('size_gb', 1), bucket.get('count', 1),
+                bucket.get('min_count', 0)))
+
+        return warmpool.WarmPool(self, buckets,
+                                 self.cb_warm_pool_refill_interval,
+                                 self.cb_warm_pool_idle_timeout)
+
+    def _start_warm_pool(self):
+        # Filling starts once the driver is used, not when it is configured
+        if self._warm_pool is not None:
+            self._warm_pool.start()
+
+    def close(self, timeout=5):
+        """Stop the driver's background threads."""
+
+        # The pool creates volumes through the others, stop it first
+        if self._warm_pool is not None:
+            self._warm_pool.stop(timeout)
+        self._filesystem_snapshot.stop(timeout)
+        self._job_tracker.stop(timeout)
+        self._connection_pool.close()
+
     def _set_profiles(self, user_profiles):
         profiles = {'gold': '10000', 'silver': '500', 'bronze': '100'}
 
         if user_profiles:
             profiles = user_profiles
+
+        # A profile is its IOPS, or a dict of IOPS, iSCSI and queue tuning
+        self._iscsi_tuning = {}
+        self._queue_tuning = {}
+        for name, profile in profiles.items():
+            if not isinstance(profile, dict):
+                continue
+            if not profile.get('iops'):
+                raise Exception("Unable to initialize CloudByte Plugin. "
+                                "Missing iops in profile [" + name + "].")
+            try:
+                settings = iscsi.normalize_settings(profile.get('iscsi'))
+                queue_settings = devices.normalize_queue_settings(
+                    profile.get('queue'))
+            except ValueError as e:
+                raise Exception("Unable to initialize CloudByte Plugin. "
+                                "Profile [" + name + "]: " + str(e))
+            if settings:
+                self._iscsi_tuning[name] = settings
+            if queue_settings:
+                self._queue_tuning[name] = queue_settings
         return profiles
 
-    def _path_exists(self, path, counter=1):
-        for i in xrange(counter):
-            if os.path.exists(path):
-                return True
-            time.sleep(2)
-        return False
+    def _get_profile_iops(self, profile_name):
+        profile = self.profiles.get(profile_name)
+        if isinstance(profile, dict):
+            return profile.get('iops')
+        return profile
+
+    def _get_volume_profile(self, vol):
+        """Name of the profile the volume was created with, if tuned."""
+
+        # Skip the QoS group lookup unless some profile is tuned
+        if not self._iscsi_tuning and not self._queue_tuning:
+            return None
+        return self._qos_groups.profile_of(vol.get('Tsmid'),
+                                           vol.get('groupid'))
 
     def _get_expected_disk_path(self, ip, iqn):
-        return '/dev/disk/by-path/ip-%s:3260-iscsi-%s-lun-0' % (ip,
-                                                       iqn) 
+        return '%s/ip-%s:3260-iscsi-%s-lun-0' % (self.cb_disk_by_path_dir,
+                                                 ip, iqn)
+
     def _get_device_file_from_path(self, disk_by_path):
         device = None
         if os.path.exists(disk_by_path):
@@ -81,18 +372,14 @@ class CloudByteBlockDeviceAPI(object):
         return device.replace('../../', '/dev/')
 
     def _iscsi_logout(self, tgt_ip, tgt_iqn):
-        cmd = 'sudo iscsiadm -m node -p %s -T %s -u' % (tgt_ip, tgt_iqn)
-        subprocess.check_output(shlex.split(cmd))
-    
-        cmd = 'sudo iscsiadm -m node -o delete -T %s' % (tgt_iqn)
-        subprocess.check_output(shlex.split(cmd))
+        self._iscsi.logout(tgt_ip, tgt_iqn)
 
-    def _iscsi_login(self, tgt_ip, tgt_iqn):
+    def _iscsi_login(self, tgt_ip, tgt_iqn, settings=None):
         attached_at = None
         path = self._get_expected_disk_path(tgt_ip, tgt_iqn)
-        cmd = 'sudo iscsiadm -m node -p %s -T %s --login' % (tgt_ip, tgt_iqn)
-        subprocess.check_output(shlex.split(cmd))
-        if self._path_exists(path, 5):
+        # Discovers the target first unless its node record is known
+        self._iscsi.login(tgt_ip, tgt_iqn, settings)
+        if self._device_waiter.wait(path, True, self.cb_device_wait_timeout):
             attached_at = path
         
         if not attached_at:
@@ -102,9 +389,7 @@ class CloudByteBlockDeviceAPI(object):
         return attached_at
 
     def _iscsi_discovery(self, portal):
-        cmd = 'sudo iscsiadm -m discovery -t sendtargets -p %s' % portal
-        output = subprocess.check_output(shlex.split(cmd))
-        return output.split('\n')
+        return [iqn for _, iqn in self._iscsi.discover(portal)]
 
     def _get_volume_size_in_bypes(self, size):
         return MiB(int(size)).bytes
@@ -149,39 +434,50 @@ class CloudByteBlockDeviceAPI(object):
 
         return error_msg
 
-    def _execute_and_get_response_details(self, host, url):
+    def _execute_and_get_response_details(self, host, url, cmd=None):
         """Will prepare response after executing an http request."""
 
         res_details = {}
-        try:
-            # Prepare the connection
-            connection = http_client.HTTPSConnection(host)
-            # Make the connection
-            connection.request('GET', url)
-            # Extract the response as the connection was successful
-            response = connection.getresponse()
-            # Read the response
-            data = response.read()
+
+        def read_response(response):
+            # Volume listings are streamed into compact records
+            if response.status == 200 and cmd == 'listFileSystem':
+                return cb_volume_index.read_filesystems_response(response)
             # Transform the json string into a py object
-            data = json.loads(data)
-            # Extract http error msg if any
-            error_details = None
-            if response.status != 200:
-                error_details = self._extract_http_error(data)
+            return jsonstream.loads(response.read())
 
-            # Prepare the return object
-            res_details['data'] = data
-            res_details['error'] = error_details
-            res_details['http_status'] = response.status
+        # Reuse a kept-alive connection to this ElastiCenter; only
+        # read-only commands are safe to resend once they went out
+        status, data = self._connection_pool.request(
+            'GET', url, read_response, idempotent=cmd in READ_ONLY_COMMANDS)
+        # Extract http error msg if any
+        error_details = None
+        if status != 200:
+            error_details = self._extract_http_error(data)
 
-        finally:
-            connection.close()
+        # Prepare the return object
+        res_details['data'] = data
+        res_details['error'] = error_details
+        res_details['http_status'] = status
 
         return res_details
 
     def _api_request_for_cloudbyte(self, cmd, params, version=None):
         """Make http calls to CloudByte."""
-        
+
+        with self.tracer.span('cloudbyte.' + cmd):
+            if cmd not in READ_ONLY_COMMANDS:
+                return self._execute_api_request(cmd, params)
+
+            # Identical read-only requests in flight share a single response
+            key = (cmd, tuple(sorted(
+                (k, six.text_type(v)) for k, v in (params or {}).items())))
+            return self._in_flight_requests.do(
+                key, self._execute_api_request, cmd, params)
+
+    def _execute_api_request(self, cmd, params):
+        """Execute a single CloudByte API call and check its status."""
+
         # Below is retrieved from /etc/cinder/cinder.conf
         apikey = self.cb_apikey
 
@@ -198,9 +494,19 @@ class CloudByteBlockDeviceAPI(object):
         error_details = None
         http_status = None
 
+        # Read-only and mutating calls are throttled separately
+        if cmd in READ_ONLY_COMMANDS:
+            budget = self._read_budget
+        else:
+            budget = self._write_budget
+        budget.acquire()
+
+        in_flight = self._api_in_flight.labels(cmd)
+        in_flight.inc()
+        start = time.time()
         try:
             # Execute CloudByte API & frame the response
-            res_obj = self._execute_and_get_response_details(host, url)
+            res_obj = self._execute_and_get_response_details(host, url, cmd)
 
             data = res_obj['data']
             error_details = res_obj['error']
@@ -208,8 +514,15 @@ class CloudByteBlockDeviceAPI(object):
 
         except http_client.HTTPException as ex:
             msg = ("Error executing CloudByte API ["+cmd+"], "
-                     "Error: "+ex+". URL [" +str(url)+ "].")
+                     "Error: "+str(ex)+". URL [" +str(url)+ "].")
             raise UnknownVolume(msg)
+        finally:
+            latency = time.time() - start
+            budget.release(cmd, latency, http_status)
+            in_flight.dec()
+            status = http_status or 'error'
+            self._api_latency.labels(cmd, status).observe(latency)
+            self._api_requests.labels(cmd, status).inc()
 
         # Check if it was an error response from CloudByte
         if http_status != 200:
@@ -221,23 +534,32 @@ class CloudByteBlockDeviceAPI(object):
         return data
 
     def _get_account_id_from_name(self, account_name):
+        key = ('account', account_name)
+        account_id = self._metadata_cache.get(key)
+        if account_id is not None:
+            return account_id
+
         params = {}
         data = self._api_request_for_cloudbyte("listAccount", params)
-        accounts = data["listAccountResponse"]["account"]
-
-        account_id = None
-        for account in accounts:
-            if account.get("name") == account_name:
-                account_id = account.get("id")
-                break
+        account_id = self._get_account_id_from_response(data, account_name)
 
         if account_id is None:
+            self._metadata_cache.invalidate(key)
             msg = ("Failed to get CloudByte account details "
                     "for account ["+account_name+"].")
             raise UnknownVolume(msg)
 
+        self._remember(key, account_id)
         return account_id
 
+    def _get_account_id_from_response(self, data, account_name):
+        accounts = data["listAccountResponse"]["account"]
+
+        for account in accounts:
+            if account.get("name") == account_name:
+                return account.get("id")
+        return None
+
     def _request_tsm_details(self, account_id):
         params = {"accountid": account_id}
 
@@ -263,8 +585,55 @@ class CloudByteBlockDeviceAPI(object):
 
         return tsmdetails
 
+    def _get_cached_tsm_details(self, account_id, tsm_name, account_name):
+        key = ('tsm', account_id, tsm_name)
+        tsm_details = self._metadata_cache.get(key)
+        if tsm_details is not None:
+            return tsm_details
+
+        tsm_data = self._request_tsm_details(account_id)
+        tsm_details = self._get_tsm_details(tsm_data, tsm_name, account_name)
+
+        # Only remember TSMs that were actually found
+        if tsm_details:
+            self._remember(key, tsm_details)
+        else:
+            self._metadata_cache.invalidate(key)
+        return tsm_details
+
+    def _get_vsm_details(self):
+        """[(account id, tsm details)] of every configured VSM."""
+
+        vsms = []
+        for tsm_name, account_name in self.cb_vsms:
+            account_id = self._get_account_id_from_name(account_name)
+            vsms.append((account_id, self._get_cached_tsm_details(
+                account_id, tsm_name, account_name)))
+        return vsms
+
+    def _get_account_id_of_tsm(self, tsmid):
+        for account_id, tsm_details in self._get_vsm_details():
+            if tsm_details.get('tsmid') == tsmid:
+                return account_id
+        return self._get_account_id_from_name(self.cb_account_name)
+
+    def _place_volume(self, size, profile_name):
+        """(account id, tsm details) of the VSM a new volume goes to."""
+
+        iops = self._get_profile_iops(profile_name) or self.cb_add_qosgroup.get('iops')
+        return self._placement.choose(size, int(iops or 0))
+
     def _add_qos_group_request(self, tsmid, volume_name,
                                qos_group_params, profile_name):
+        params = self._get_qos_group_params(tsmid, volume_name,
+                                            qos_group_params, profile_name)
+        # Recorded first, the group is ours even if the response is lost
+        self._qos_groups.own(tsmid, params['name'])
+        data = self._api_request_for_cloudbyte("addQosGroup", params)
+        return data
+
+    def _get_qos_group_params(self, tsmid, volume_name,
+                              qos_group_params, profile_name):
         # Prepare the user input params
         params = {
             "name": "QoS_" + volume_name,
@@ -276,20 +645,25 @@ class CloudByteBlockDeviceAPI(object):
             params.update(qos_group_params)
             
         if profile_name:
-            iops = self.profiles.get(profile_name)
+            iops = self._get_profile_iops(profile_name)
             if not iops:
                 msg = ("Requested profile not found ["+profile_name+"].")
                 raise UnknownVolume(msg)
 
             profile = {'iops': iops}
             params.update(profile)
-        
-        data = self._api_request_for_cloudbyte("addQosGroup", params)
-        return data
+
+        return params
 
     def _create_volume_request(self, size, datasetid, qosgroupid,
                                tsmid, volume_name, file_system_params):       
+        params = self._get_create_volume_params(
+            size, datasetid, qosgroupid, tsmid, volume_name, file_system_params)
+        data = self._api_request_for_cloudbyte("createVolume", params)
+        return data
 
+    def _get_create_volume_params(self, size, datasetid, qosgroupid,
+                                  tsmid, volume_name, file_system_params):
         # Prepare the user input params
         params = {
             "datasetid": datasetid,
@@ -303,8 +677,7 @@ class CloudByteBlockDeviceAPI(object):
         if file_system_params:
             params.update(file_system_params)
 
-        data = self._api_request_for_cloudbyte("createVolume", params)
-        return data
+        return params
 
     def _queryAsyncJobResult_request(self, jobid):
         async_cmd = "queryAsyncJobResult"
@@ -315,11 +688,14 @@ class CloudByteBlockDeviceAPI(object):
         return data
 
     def _retry_volume_operation(self, operation, jobid):
-        """CloudByte async calls via the FixedIntervalLoopingCall."""
+        """Query the status of a CloudByte async job."""
 
         # Query the CloudByte storage with this jobid
         volume_response = self._queryAsyncJobResult_request(jobid)
+        return self._get_job_result_from_response(operation, jobid,
+                                                  volume_response)
 
+    def _get_job_result_from_response(self, operation, jobid, volume_response):
         result_res = None
         if volume_response is not None:
             result_res = volume_response.get('queryasyncjobresultresponse')
@@ -336,6 +712,11 @@ class CloudByteBlockDeviceAPI(object):
     def _wait_for_volume_creation(self, volume_response, cb_volume_name):
         """Given the job wait for it to complete."""
 
+        jobid = self._get_create_job_id(volume_response, cb_volume_name)
+        self._wait_for_job('Create Volume', jobid, cb_volume_name,
+                           self._get_create_timeout())
+
+    def _get_create_job_id(self, volume_response, cb_volume_name):
         vol_res = volume_response.get('createvolumeresponse')
 
         if vol_res is None:
@@ -350,38 +731,64 @@ class CloudByteBlockDeviceAPI(object):
                     "create volume ["+cb_volume_name+"] response.")
             raise ValueError(msg)
 
-        retry_interval = (
-            self.cb_confirm_volume_create_retry_interval)
+        return jobid
 
-        max_retries = (
-            self.cb_confirm_volume_create_retries)
-        retries = 0
-        
-        for retries in range(0, max_retries):
-            result_res = self._retry_volume_operation('Create Volume', jobid)
-            
-            status = result_res.get('jobstatus')
-            if status == 1:
-                break
-            elif status == 2:
-                job_result = result_res.get("jobresult")
-                err_msg = job_result.get("errortext")
-                err_code = job_result.get("errorcode")
-                msg = (
-                    "Error in Operation [Create Volume] "
-                    "for volume ["+cb_volume_name+"] in CloudByte "
-                    "storage: ["+err_msg+"], "
-                    "error code: ["+err_code+"].")
-                raise ValueError(msg)
-            
-            elif retries == max_retries - 1:
-                # All attempts exhausted
-                msg = ("CloudByte operation [%(operation)s] failed"
-                              " for volume ["+cb_volume_name+"]. Exhausted all"
-                              " ["+max_retries+"] attempts.")
-                raise ValueError(msg)
+    def _get_create_timeout(self):
+        return (self.cb_confirm_volume_create_retry_interval *
+                self.cb_confirm_volume_create_retries)
+
+    def _wait_for_job(self, operation, jobid, cb_volume_name, timeout):
+        """Wait for a CloudByte async job and raise if it did not succeed."""
+
+        # Polls run on the tracker's thread, attach them to this trace
+        wait_span = self.tracer.span('job.wait', operation=operation, jobid=jobid)
+
+        def poll(jobid):
+            with self.tracer.span('job.poll', parent=parent, jobid=jobid):
+                return self._retry_volume_operation(operation, jobid)
+
+        in_flight = self._jobs_in_flight.labels(operation)
+        in_flight.inc()
+        start = time.time()
+        outcome = 'error'
+        try:
+            with wait_span as parent:
+                result_res = self._job_tracker.wait(jobid, poll, timeout)
+            outcome = self._get_job_outcome(result_res)
+        finally:
+            in_flight.dec()
+            self._job_wait_latency.labels(operation, outcome).observe(
+                time.time() - start)
 
-            time.sleep(retry_interval)
+        self._check_job_result(operation, cb_volume_name, timeout, result_res)
+
+    def _get_job_outcome(self, result_res):
+        if result_res is None:
+            return 'timeout'
+        if result_res.get('jobstatus') == jobs.JOB_FAILED:
+            return 'failed'
+        return 'succeeded'
+
+    def _check_job_result(self, operation, cb_volume_name, timeout, result_res):
+        """Raise unless the async job finished successfully."""
+
+        if result_res is None:
+            # All attempts exhausted
+            msg = ("CloudByte operation ["+operation+"] failed"
+                          " for volume ["+cb_volume_name+"]. Timed out"
+                          " after ["+str(timeout)+"] seconds.")
+            raise ValueError(msg)
+
+        if result_res.get('jobstatus') == jobs.JOB_FAILED:
+            job_result = result_res.get("jobresult") or {}
+            err_msg = job_result.get("errortext")
+            err_code = job_result.get("errorcode")
+            msg = (
+                "Error in Operation ["+operation+"] "
+                "for volume ["+cb_volume_name+"] in CloudByte "
+                "storage: ["+str(err_msg)+"], "
+                "error code: ["+str(err_code)+"].")
+            raise ValueError(msg)
 
     def _get_iscsi_service_id_from_response(self, volume_id, data):
         iscsi_service_res = data.get('listVolumeiSCSIServiceResponse')
@@ -397,12 +804,9 @@ class CloudByteBlockDeviceAPI(object):
             msg = ('No iscsi services found in CloudByte storage.')
             raise ValueError(msg)
 
-        iscsi_id = None
-
-        for iscsi_service in iscsi_service_list:
-            if iscsi_service['volume_id'] == volume_id:
-                iscsi_id = iscsi_service['id']
-                break
+        iscsi_service = cb_volume_index.index_by(
+            iscsi_service_list, 'volume_id').get(volume_id)
+        iscsi_id = iscsi_service['id'] if iscsi_service else None
 
         if iscsi_id is None:
             msg = ("No iscsi service found for CloudByte "
@@ -427,13 +831,27 @@ class CloudByteBlockDeviceAPI(object):
             msg = ('No iscsi initiators were found in CloudByte.')
             raise ValueError(msg)
 
-        ig_id = None
+        ig = cb_volume_index.index_by(ig_list, 'initiatorgroup').get(filter)
 
-        for ig in ig_list:
-            if ig.get('initiatorgroup') == filter:
-                ig_id = ig['id']
-                break
+        return ig['id'] if ig else None
+
+    def _get_initiator_group_id(self, account_id, ig_name):
+        key = ('initiator_group', account_id, ig_name)
+        ig_id = self._metadata_cache.get(key)
+        if ig_id is not None:
+            return ig_id
+
+        params = {"accountid": account_id}
 
+        iscsi_initiator_data = self._api_request_for_cloudbyte(
+            'listiSCSIInitiator', params)
+        ig_id = self._get_initiator_group_id_from_response(
+            iscsi_initiator_data, ig_name)
+
+        if ig_id is None:
+            self._metadata_cache.invalidate(key)
+        else:
+            self._remember(key, ig_id)
         return ig_id
 
     def _request_update_iscsi_service(self, iscsi_id, ig_id):
@@ -448,105 +866,124 @@ class CloudByteBlockDeviceAPI(object):
     def _search_volume_id(self, cb_volumes, cb_volume_id):
         """Search the volume in CloudByte."""
 
-        volumes_res = cb_volumes.get('listFilesystemResponse')
+        vol = cb_volumes.get(cb_volume_id)
 
-        if volumes_res is None:
-            msg = ("No response was received from CloudByte's "
-                    "list filesystem api call.")
-            raise ValueError(msg)
-
-        volumes = volumes_res.get('filesystem')
-
-        if volumes is None:
-            msg = ("No volume was found at CloudByte storage.")
-            raise ValueError(msg)
-
-        volume_id = None
-
-        for vol in volumes:
-            if vol['id'] == cb_volume_id:
-                volume_id = vol['id']
-                break
-
-        return volume_id
+        return vol['id'] if vol else None
     
     def _search_volume_id_by_name(self, cb_volumes, cb_volume_name):
         """Search the volume in CloudByte."""
 
-        volumes_res = cb_volumes.get('listFilesystemResponse')
-
-        if volumes_res is None:
-            msg = ("No response was received from CloudByte's "
-                    "list filesystem api call.")
-            raise ValueError(msg)
-
-        volumes = volumes_res.get('filesystem')
+        vol = cb_volumes.get_by_name(cb_volume_name)
 
-        if volumes is None:
-            msg = ("No volume was found at CloudByte storage.")
-            raise ValueError(msg)
-
-        volume_id = None
-
-        for vol in volumes:
-            if vol['name'] == cb_volume_name:
-                volume_id = vol['id']
-                break
-
-        if not volume_id:
+        if not vol:
             msg = ("Volume not found at CloudByte. "
-                    "Volumes [" +str(cb_volumes)+ "]. "
+                    "Volumes [" +cb_volume_index.describe(cb_volumes.by_name)+ "]. "
                     "Accepted volume name [" +cb_volume_name+"].")
             raise ValueError(msg)
         
-        return volume_id
+        return vol['id']
 
     def _search_volume(self, cb_volumes, cb_volume_id):
         """Search the volume in CloudByte."""
 
-        volumes_res = cb_volumes.get('listFilesystemResponse')
+        volume = cb_volumes.get(cb_volume_id)
 
-        if volumes_res is None:
-            msg = ("No response was received from CloudByte's "
-                    "list filesystem api call.")
+        if not volume:
+            msg = ("Volume was not found at CloudByte storage. "
+                   "Accepted volume ["+cb_volume_id+"]. "
+                   "Volumes ["+cb_volume_index.describe(cb_volumes.by_id)+"].")
             raise ValueError(msg)
 
-        volumes = volumes_res.get('filesystem')
+        return volume
 
-        if volumes is None:
-            msg = ("No volume was found at CloudByte storage.")
-            raise ValueError(msg)
+    def _iter_filesystems(self, params):
+        """Yield CloudByte volumes matching params, a page at a time."""
 
-        volume = None
+        page_size = self.cb_filesystem_page_size
+        page = 1
+        seen = set()
 
-        for vol in volumes:
-            if vol['id'] == cb_volume_id:
-                volume = vol
-                break
+        while True:
+            page_params = dict(params)
+            if page_size:
+                page_params.update(page=page, pagesize=page_size)
 
-        if not volume:
-            msg = ("Volume was not found at CloudByte storage. "
-                   "Accepted volume ["+cb_volume_id+"]. "
-                   "Volumes ["+str(cb_volumes)+"].")
-            raise ValueError(msg)
+            data = self._api_request_for_cloudbyte('listFileSystem', page_params)
+            volumes = cb_volume_index.filesystems_from_response(data)
+            del data
 
-        return volume
+            new_volumes = [vol for vol in volumes if vol['id'] not in seen]
+            for vol in new_volumes:
+                seen.add(vol['id'])
+                yield vol
 
-    def _update_initiator_group(self, volume_id, ig_name):
+            # A short page is the last one; a page with nothing new means
+            # the ElastiCenter ignores paging and returned everything
+            if not page_size or len(volumes) < page_size or not new_volumes:
+                return
+            page += 1
 
-        # Get account id of this account
-        account_name = self.cb_account_name
-        account_id = self._get_account_id_from_name(account_name)
+    def _request_filesystems(self):
+        """Fetch the volumes of all of our VSMs."""
 
-        # Fetch the initiator group ID
-        params = {"accountid": account_id}
+        volumes = []
+        seen = set()
+        for account_id, tsm_details in self._get_vsm_details():
+            params = {"accountid": account_id, "tsmid": tsm_details.get('tsmid')}
+            for vol in self._iter_filesystems(params):
+                if vol['id'] not in seen:
+                    seen.add(vol['id'])
+                    volumes.append(vol)
+        cb_volumes = cb_volume_index.VolumeIndex(volumes)
+        self._state.replace_listing(cb_volumes.volumes)
+        return cb_volumes
+
+    def _request_filesystem(self, cb_volume_id):
+        """Fetch a single volume, as an index holding at most that volume."""
+
+        volumes = self._iter_filesystems({"id": cb_volume_id})
+        cb_volumes = cb_volume_index.VolumeIndex(
+            [vol for vol in volumes if vol['id'] == cb_volume_id])
+        for vol in cb_volumes.volumes:
+            self._state.put_volume(vol)
+        return cb_volumes
+
+    def _list_filesystems(self, fresh=False):
+        """Index of CloudByte volumes, from the shared snapshot unless fresh."""
+
+        return self._filesystem_snapshot.get(fresh)
+
+    def _list_filesystems_with(self, cb_volume_id):
+        """List CloudByte volumes, refetching if cb_volume_id is missing."""
+
+        cb_volumes = self._list_filesystems()
+        if cb_volumes.get(cb_volume_id) is None:
+            # The volume may have been created after the snapshot was taken
+            cb_volumes = self._request_filesystem(cb_volume_id)
+        return cb_volumes
+
+    def _get_volume_record(self, cb_volume_id):
+        """Record of a volume as ElastiCenter lists it, None if unknown.
+
+        The local store only answers while ElastiCenter cannot be reached.
+        """
 
-        iscsi_initiator_data = self._api_request_for_cloudbyte(
-            'listiSCSIInitiator', params)
+        try:
+            cb_volumes = self._list_filesystems_with(cb_volume_id)
+        except socket.error:
+            vol = self._state.get_volume(cb_volume_id)
+            if vol is None:
+                raise
+            return vol
+        return cb_volumes.get(cb_volume_id)
 
-        # Filter the list of initiator groups with the name
-        ig_id = self._get_initiator_group_id_from_response(
-            iscsi_initiator_data, ig_name)
+    def _update_initiator_group(self, volume_id, ig_name, tsmid=None):
+
+        # Get account id of the volume's VSM
+        account_id = self._get_account_id_of_tsm(tsmid)
+
+        # Fetch the initiator group ID
+        ig_id = self._get_initiator_group_id(account_id, ig_name)
 
         params = {"storageid": volume_id}
 
@@ -561,6 +998,11 @@ class CloudByteBlockDeviceAPI(object):
     def _wait_for_volume_deletion(self, volume_response, cb_volume_id):
         """Given the job wait for it to complete."""
 
+        jobid = self._get_delete_job_id(volume_response, cb_volume_id)
+        self._wait_for_job('Delete Volume', jobid, cb_volume_id,
+                           self._get_delete_timeout())
+
+    def _get_delete_job_id(self, volume_response, cb_volume_id):
         vol_res = volume_response.get('deleteFileSystemResponse')
 
         if vol_res is None:
@@ -575,76 +1017,135 @@ class CloudByteBlockDeviceAPI(object):
                     "delete volume ["+cb_volume_id+"] response.")
             raise ValueError(msg)
 
-        retry_interval = (
-            self.cb_confirm_volume_delete_retry_interval)
+        return jobid
 
-        max_retries = (
-            self.cb_confirm_volume_delete_retries)
-
-        retries = 0
-        
-        for retries in range(0, max_retries):
-            result_res = self._retry_volume_operation('Delete Volume', jobid)
-            
-            status = result_res.get('jobstatus')
-            if status == 1:
-                break
-            elif status == 2:
-                job_result = result_res.get("jobresult")
-                err_msg = job_result.get("errortext")
-                err_code = job_result.get("errorcode")
-                msg = (
-                      "Error in Operation [Delete Volume] "
-                      "for volume ["+cb_volume_id+"] in CloudByte "
-                      "storage: ["+err_msg+"], "
-                      "error code: ["+err_code+"].")
-                raise ValueError(msg)
-            
-            elif retries == max_retries - 1:
-                # All attempts exhausted
-                msg = ("CloudByte operation [%(operation)s] failed"
-                              " for volume ["+cb_volume_id+"]. Exhausted all"
-                              " ["+max_retries+"] attempts.")
-                raise ValueError(msg)
-                
-            time.sleep(retry_interval)
+    def _get_delete_timeout(self):
+        return (self.cb_confirm_volume_delete_retry_interval *
+                self.cb_confirm_volume_delete_retries)
 
+    @tracing.traced
     def compute_instance_id(self):
-        return unicode(socket.gethostbyname(socket.getfqdn()))
+        # Resolved once, this node's address does not change under us
+        if self._instance_id is None:
+            self._instance_id = unicode(socket.gethostbyname(socket.getfqdn()))
+        return self._instance_id
 
+    @tracing.traced
     def create_volume(self, dataset_id, size):
         return self.create_volume_with_profile(dataset_id, size, None)
 
+    @tracing.traced
     def create_volume_with_profile(self, dataset_id, size, profile_name):
-        # Get account id of this account
-        account_id = self._get_account_id_from_name(self.cb_account_name)
+        return self._create_dataset_volume(dataset_id, size, profile_name)
+
+    @tracing.traced
+    def create_volumes(self, requests):
+        """Create many volumes concurrently.
+
+        requests is a list of (dataset_id, size) or
+        (dataset_id, size, profile_name) tuples. Returns a VolumeResult per
+        request, in order, carrying either the volume or the exception.
+        """
+
+        # Resolve the shared 'ALL' initiator groups once for all volumes
+        ig_ids = dict((account_id,
+                       self._get_initiator_group_id(account_id, 'ALL'))
+                      for account_id, _ in self._get_vsm_details())
+
+        def create(request):
+            dataset_id, size = request[:2]
+            profile_name = request[2] if len(request) > 2 else None
+            return self._create_dataset_volume(dataset_id, size,
+                                               profile_name, ig_ids)
+
+        return self._run_bulk(create, requests)
+
+    def _create_dataset_volume(self, dataset_id, size, profile_name,
+                               ig_ids=None):
+        """Clone, claim or create the volume of a dataset.
+
+        ig_ids optionally maps account ids to their 'ALL' initiator group.
+        """
+
+        template = self._get_template(dataset_id, profile_name)
+        if template is None:
+            volume_id = self._claim_pool_volume(dataset_id, size, profile_name)
+            if volume_id is not None:
+                return self._new_volume(volume_id, dataset_id, size)
+
+        # Clones stay on the VSM of their template
+        account_id, tsm_details, ig_id = None, None, None
+        if template is None:
+            account_id, tsm_details = self._place_volume(size, profile_name)
+            ig_id = (ig_ids or {}).get(account_id)
+
+        volume_id = self._create_volume(account_id, tsm_details, ig_id,
+                                        str(dataset_id), size, profile_name,
+                                        template)
+        return self._new_volume(volume_id, dataset_id, size)
+
+    def _run_bulk(self, operation, requests):
+        parent = self.tracer.current()
+
+        def run(request):
+            # Workers run on their own threads, keep them in this trace
+            with self.tracer.span('bulk.item', parent=parent):
+                return operation(request)
+
+        outcomes = concurrency.run_concurrently(
+            run, requests, self.cb_bulk_workers)
+
+        return [VolumeResult(request, volume, error)
+                for request, (volume, error) in zip(requests, outcomes)]
+
+    def _create_volume(self, account_id, tsm_details, ig_id,
+                       cb_volume_name, size, profile_name, template=None):
+        """Create and export volume cb_volume_name, returning its id."""
+
+        if template is not None:
+            volume_id, tsmid = self._clone_template(template, cb_volume_name,
+                                                    size)
+            account_id = self._get_account_id_of_tsm(tsmid)
+            self._export_volume(account_id, ig_id, volume_id)
+            return volume_id
 
-        # Set backend storage volume name using OpenStack volume id
-        cb_volume_name = str(dataset_id)
-
-        tsm_data = self._request_tsm_details(account_id)
-        tsm_details = self._get_tsm_details(tsm_data, self.cb_tsm_name, self.cb_account_name)
-
-        qos_data = self._add_qos_group_request(tsm_details.get('tsmid'), cb_volume_name, self.cb_add_qosgroup, profile_name)
-
-        # Extract the qos group id from response
-        qosgroupid = qos_data['addqosgroupresponse']['qosgroup']['id']
-
-        # Send a create volume request to CloudByte API
-        vol_data = self._create_volume_request(
-            size, tsm_details.get('datasetid'), qosgroupid,
-            tsm_details.get('tsmid'), cb_volume_name, self.cb_create_volume)
+        try:
+            qosgroupid = self._get_qos_group_id(tsm_details.get('tsmid'),
+                                                cb_volume_name, profile_name)
+
+            # Send a create volume request to CloudByte API
+            vol_data = self._create_volume_request(
+                size, tsm_details.get('datasetid'), qosgroupid,
+                tsm_details.get('tsmid'), cb_volume_name, self.cb_create_volume)
+        except Exception:
+            # The cached account/TSM/QoS group ids may no longer be valid
+            self._metadata_cache.clear()
+            self._state.clear_metadata()
+            self._qos_groups.clear()
+            raise
+        finally:
+            self._filesystem_snapshot.invalidate()
 
         # Since create volume is an async call;
         # need to confirm the creation before proceeding further
         self._wait_for_volume_creation(vol_data, cb_volume_name)
 
         # Fetch iscsi id
-        cb_volumes = self._api_request_for_cloudbyte(
-            'listFileSystem', params={})
+        cb_volumes = self._list_filesystems(fresh=True)
         volume_id = self._search_volume_id_by_name(cb_volumes,
                                                       cb_volume_name)
-        vol = self._search_volume(cb_volumes, volume_id)
+        self._export_volume(account_id, ig_id, volume_id)
+        return volume_id
+
+    def _new_volume(self, volume_id, dataset_id, size):
+        return BlockDeviceVolume(
+            blockdevice_id=unicode(volume_id),
+            size=size,
+            attached_to=None,
+            dataset_id=dataset_id)
+
+    def _export_volume(self, account_id, ig_id, volume_id):
+        """Expose a new volume to the 'ALL' initiator group."""
 
         params = {"storageid": volume_id}
 
@@ -654,60 +1155,249 @@ class CloudByteBlockDeviceAPI(object):
             volume_id, iscsi_service_data)
 
         # Fetch the initiator group ID
-        params = {"accountid": account_id}
-
-        iscsi_initiator_data = self._api_request_for_cloudbyte(
-            'listiSCSIInitiator', params)
-        ig_id = self._get_initiator_group_id_from_response(
-            iscsi_initiator_data, 'ALL')
+        if ig_id is None:
+            ig_id = self._get_initiator_group_id(account_id, 'ALL')
 
         # Update the iscsi service with above fetched iscsi_id & ig_id
         self._request_update_iscsi_service(iscsi_id, ig_id)
-        
-        return BlockDeviceVolume(
-            blockdevice_id=unicode(volume_id),
-            size=size,
-            attached_to=None,
-            dataset_id=dataset_id)
 
+    def _get_template(self, dataset_id, profile_name):
+        """Template volume a dataset is cloned from, or None."""
+
+        template = self.cb_templates.get(str(dataset_id))
+        if template is None:
+            profile = self.profiles.get(profile_name)
+            if isinstance(profile, dict):
+                template = profile.get('template')
+        return template
+
+    def _template_names(self):
+        """Ids and names of the configured templates; they back no dataset."""
+
+        templates = set(self.cb_templates.values())
+        templates.update(profile.get('template')
+                         for profile in self.profiles.values()
+                         if isinstance(profile, dict))
+        return templates
+
+    def _clone_template(self, template, cb_volume_name, size):
+        """Clone the template's snapshot as cb_volume_name.
+
+        Returns the id of the clone and of the TSM it was created on.
+        """
+
+        cb_volumes = self._list_filesystems()
+        template_vol = cb_volumes.get(template) or cb_volumes.get_by_name(template)
+        if template_vol is None:
+            msg = ("Template volume ["+template+"] was not found at "
+                   "CloudByte storage.")
+            raise ValueError(msg)
+
+        template_mib = int(template_vol['currentTotalSpace'])
+        if MiB(template_mib).bytes > size:
+            msg = ("Template volume ["+template+"] is larger than the "
+                   "requested size of volume ["+cb_volume_name+"].")
+            raise ValueError(msg)
+
+        path = self._in_flight_requests.do(
+            ('template_snapshot', template_vol['id']),
+            self._get_template_snapshot_path, template_vol['id'])
+
+        params = {"id": template_vol['id'], "clonename": cb_volume_name,
+                  "path": path}
+        try:
+            data = self._api_request_for_cloudbyte('cloneDatasetSnapshot',
+                                                   params)
+        except Exception:
+            # The snapshot may have been removed, look it up again next time
+            self._metadata_cache.invalidate(
+                ('template_snapshot', template_vol['id'],
+                 self.cb_template_snapshot))
+            raise
+        finally:
+            self._filesystem_snapshot.invalidate()
+
+        clone_res = data.get('cloneDatasetSnapshot')
+        if clone_res is None:
+            msg = ("Null response received while cloning template ["+template+"] "
+                   "to volume ["+cb_volume_name+"] at CloudByte storage.")
+            raise ValueError(msg)
+
+        volume_id = (clone_res.get('filesystem') or {}).get('id')
+        if volume_id is None:
+            # Releases that clone asynchronously answer with a job instead
+            if clone_res.get('jobid') is not None:
+                self._wait_for_job('Clone Volume', clone_res['jobid'],
+                                   cb_volume_name, self._get_create_timeout())
+            cb_volumes = self._list_filesystems(fresh=True)
+            volume_id = self._search_volume_id_by_name(cb_volumes,
+                                                       cb_volume_name)
+
+        if MiB(template_mib).bytes < size:
+            params = {"id": volume_id,
+                      "quotasize": self._get_volume_size_in_gb(size)}
+            try:
+                self._api_request_for_cloudbyte('updateFileSystem', params)
+            finally:
+                self._filesystem_snapshot.invalidate()
+        return volume_id, template_vol.get('Tsmid')
+
+    def _get_template_snapshot_path(self, template_id):
+        """Path of the template's clone source snapshot, taken if missing."""
+
+        key = ('template_snapshot', template_id, self.cb_template_snapshot)
+        path = self._metadata_cache.get(key)
+        if path is not None:
+            return path
+
+        path = self._find_snapshot_path(template_id, self.cb_template_snapshot)
+        if path is None:
+            params = {"id": template_id, "name": self.cb_template_snapshot}
+            self._api_request_for_cloudbyte('createStorageSnapshot', params)
+            path = self._find_snapshot_path(template_id,
+                                            self.cb_template_snapshot)
+
+        if path is None:
+            msg = ("Snapshot ["+self.cb_template_snapshot+"] of template "
+                   "volume ["+template_id+"] was not found at CloudByte storage.")
+            raise ValueError(msg)
+
+        self._metadata_cache.set(key, path)
+        return path
+
+    def _find_snapshot_path(self, cb_volume_id, snapshot_name):
+        data = self._api_request_for_cloudbyte('listStorageSnapshots',
+                                               {"id": cb_volume_id})
+        return self._get_snapshot_path_from_response(data, snapshot_name)
+
+    def _get_snapshot_path_from_response(self, data, snapshot_name):
+        snapshots_res = data.get('listDatasetSnapshotsResponse')
+
+        if snapshots_res is None:
+            msg = ("No response was received from CloudByte's "
+                   "list storage snapshots api call.")
+            raise ValueError(msg)
+
+        for snapshot in snapshots_res.get('snapshot') or []:
+            if snapshot.get('name') == snapshot_name:
+                return snapshot.get('path')
+        return None
+
+    def _claim_pool_volume(self, dataset_id, size, profile_name):
+        """Take a ready volume from the warm pool; return its id or None."""
+
+        if self._warm_pool is None:
+            return None
+
+        self._start_warm_pool()
+        return self._warm_pool.claim(
+            dataset_id, profile_name, self._get_volume_size_in_gb(size))
+
+    def _create_pool_volume(self, cb_volume_name, size, profile_name):
+        """Create and export a warm pool volume, returning its id."""
+
+        account_id, tsm_details = self._place_volume(size, profile_name)
+
+        return self._create_volume(account_id, tsm_details, None,
+                                   cb_volume_name, size, profile_name)
+
+    def _bind_pool_volume(self, cb_volume_id, dataset_id):
+        """Rename a warm pool volume after the dataset it now backs."""
+
+        params = {"id": cb_volume_id, "name": str(dataset_id)}
+        try:
+            self._api_request_for_cloudbyte('updateFileSystem', params)
+        finally:
+            self._filesystem_snapshot.invalidate()
+
+        # Not every ElastiCenter release renames a filesystem in use
+        vol = self._request_filesystem(cb_volume_id).get(cb_volume_id)
+        if vol is None or vol['name'] != str(dataset_id):
+            msg = ("CloudByte did not rename warm pool volume [" +
+                   str(cb_volume_id) + "] to [" + str(dataset_id) + "].")
+            raise ValueError(msg)
+        self._state.set_dataset(cb_volume_id, dataset_id)
+
+    def _get_qos_group_id(self, tsmid, cb_volume_name, profile_name):
+        if self.cb_qos_group_mode == 'shared':
+            return self._qos_groups.group_id(tsmid, profile_name)
+
+        qos_data = self._add_qos_group_request(tsmid, cb_volume_name, self.cb_add_qosgroup, profile_name)
+
+        # Extract the qos group id from response
+        return qos_data['addqosgroupresponse']['qosgroup']['id']
+
+    @tracing.traced
     def destroy_volume(self, cb_volume_id):
         if cb_volume_id is not None:
+            # Not from the snapshot, the volume may be gone already
+            self._destroy_volume(cb_volume_id,
+                                 self._request_filesystem(cb_volume_id))
+
+        return
 
-            cb_volumes = self._api_request_for_cloudbyte(
-                'listFileSystem', {})
+    @tracing.traced
+    def destroy_volumes(self, cb_volume_ids):
+        """Destroy many volumes concurrently.
 
-            # Search cb_volume_id in CloudByte volumes
-            # incase it has already been deleted from CloudByte
-            cb_volume_id = self._search_volume_id(cb_volumes, cb_volume_id)
+        Returns a VolumeResult per blockdevice id, in order; error is set
+        for the volumes that could not be destroyed.
+        """
 
-            # Delete volume at CloudByte
-            if cb_volume_id is not None:
-                # Need to set the initiator group to None before deleting
-                self._update_initiator_group(cb_volume_id, 'None')
+        cb_volumes = self._list_filesystems(fresh=True)
+        # Resolve the shared 'None' initiator groups once for all volumes
+        for account_id, _ in self._get_vsm_details():
+            self._get_initiator_group_id(account_id, 'None')
 
-                params = {"id": cb_volume_id}
+        return self._run_bulk(
+            lambda cb_volume_id: self._destroy_volume(cb_volume_id, cb_volumes),
+            cb_volume_ids)
+
+    def _destroy_volume(self, cb_volume_id, cb_volumes):
+        # Search cb_volume_id in CloudByte volumes
+        # incase it has already been deleted from CloudByte
+        vol = cb_volumes.get(cb_volume_id)
+
+        # Delete volume at CloudByte
+        if vol is not None:
+            cb_volume_id = vol['id']
+            # Need to set the initiator group to None before deleting
+            self._update_initiator_group(cb_volume_id, 'None',
+                                         vol.get('Tsmid'))
+
+            params = {"id": cb_volume_id}
+            try:
                 del_res = self._api_request_for_cloudbyte('deleteFileSystem',
                                                           params)
+            finally:
+                self._filesystem_snapshot.invalidate()
 
-                self._wait_for_volume_deletion(del_res, cb_volume_id)
-  
-        return
+            self._wait_for_volume_deletion(del_res, cb_volume_id)
+            self._state.delete_volume(cb_volume_id)
+
+            # Its QoS group may now be unused
+            self._qos_groups.maybe_collect_garbage()
 
+    @tracing.traced
     def get_device_path(self, cb_volume_id):
-        cb_volumes = self._api_request_for_cloudbyte(
-            'listFileSystem', {})
+        vol = self._get_volume_record(cb_volume_id)
 
-        vol = self._search_volume(cb_volumes, cb_volume_id)
+        if not vol:
+            raise UnknownVolume(cb_volume_id)
+
+        if self._multipath is not None:
+            device = self._multipath.device(vol['iqnname'])
+            if device is None:
+                raise UnattachedVolume(cb_volume_id)
+            return filepath.FilePath(device)
 
         disk_by_path = self._get_expected_disk_path(vol['ipaddress'], vol['iqnname'])
         return filepath.FilePath(
             self._get_device_file_from_path(disk_by_path)).realpath()
 
+    @tracing.traced
     def attach_volume(self, cb_volume_id, attach_to):
-        cb_volumes = self._api_request_for_cloudbyte(
-            'listFileSystem', {})
-
-        vol = self._search_volume(cb_volumes, cb_volume_id)
+        vol = self._get_volume_record(cb_volume_id)
 
         if not vol:
             raise UnknownVolume(cb_volume_id)
@@ -716,12 +1406,25 @@ class CloudByteBlockDeviceAPI(object):
         tgt_iqn = vol['iqnname']
         path = self._get_expected_disk_path(tgt_ip, tgt_iqn)
         
-        if not self._path_exists(path, 2):
-            targets = self._iscsi_discovery(vol['ipaddress'])
-            if len(targets) < 1 and vol['iqnname'] not in targets:
-                raise Exception("No targes found during discovery.")
-            
-            self._iscsi_login(vol['ipaddress'], vol['iqnname'])
+        profile_name = self._get_volume_profile(vol)
+        iscsi_settings = self._iscsi_tuning.get(profile_name)
+        device = None
+        if self._multipath is not None:
+            # One session per portal, assembled into a dm device
+            device = self._multipath.device(tgt_iqn)
+            if device is None:
+                device = self._multipath.attach(tgt_ip, tgt_iqn,
+                                                self.cb_device_wait_timeout,
+                                                iscsi_settings)
+        elif not os.path.exists(path):
+            self._iscsi_login(vol['ipaddress'], vol['iqnname'],
+                              iscsi_settings)
+
+        queue_settings = self._queue_tuning.get(profile_name)
+        if queue_settings:
+            self._queue_tuner.apply(
+                device or self._get_device_file_from_path(path),
+                queue_settings)
 
         return BlockDeviceVolume(
             blockdevice_id=unicode(cb_volume_id),
@@ -729,57 +1432,68 @@ class CloudByteBlockDeviceAPI(object):
             attached_to=attach_to,
             dataset_id=uuid.UUID(vol['name']))
 
+    @tracing.traced
     def detach_volume(self, cb_volume_id):
-        cb_volumes = self._api_request_for_cloudbyte(
-            'listFileSystem', {})
-
         # Search cb_volume_id in CloudByte volumes
         # incase it has already been deleted from CloudByte
-        vol = self._search_volume(cb_volumes, cb_volume_id)
+        vol = self._get_volume_record(cb_volume_id)
 
         if not vol:
             raise UnknownVolume(cb_volume_id)
 
         tgt_iqn = vol['iqnname']
         svip = vol['ipaddress']
+        if self._multipath is not None:
+            if not self._multipath.is_attached(tgt_iqn):
+                raise UnattachedVolume(cb_volume_id)
+            self._multipath.detach(tgt_iqn, self.cb_device_wait_timeout)
+            return
+
         path = self._get_expected_disk_path(svip, tgt_iqn)
-        if not self._path_exists(path, 2):
+        if not os.path.exists(path):
             raise UnattachedVolume(cb_volume_id)
         self._iscsi_logout(svip, tgt_iqn)
+        self._device_waiter.wait(path, False, self.cb_device_wait_timeout)
 
+    @tracing.traced
     def list_volumes(self):
-        account_id = self._get_account_id_from_name(self.cb_account_name)
-        tsm_data = self._request_tsm_details(account_id)
-        tsm_details = self._get_tsm_details(tsm_data, self.cb_tsm_name, self.cb_account_name)
-        
-        volumes = []
-        cb_volumes_res = self._api_request_for_cloudbyte(
-            'listFileSystem', {})
+        # The agent lists volumes first thing, start filling the pool then
+        self._start_warm_pool()
 
-        volumes_res = cb_volumes_res.get('listFilesystemResponse')
+        tsmids = []
+        for _, tsm_details in self._get_vsm_details():
+            if tsm_details['tsmid'] not in tsmids:
+                tsmids.append(tsm_details['tsmid'])
 
-        if volumes_res is None:
-            msg = ("No response was received from CloudByte's list filesystem api call.")
-            raise ValueError(msg)
-        
-        cb_volumes = volumes_res.get('filesystem')
-
-        if cb_volumes: 
-            for v in cb_volumes:
-                if v['Tsmid'] == tsm_details['tsmid']:
-                    attached_to = None
-                    path = self._get_expected_disk_path(v['ipaddress'], v['iqnname'])
-                    if self._path_exists(path, 1):
-                        attached_to = self.compute_instance_id()
-                    volumes.append(BlockDeviceVolume(
-                                   blockdevice_id=unicode(v['id']),
-                                   size=self._get_volume_size_in_bypes(v['currentTotalSpace']),
-                                   attached_to=attached_to,
-                                   dataset_id=uuid.UUID(str(v['name']))))
+        volumes = []
+        cb_volumes = self._list_filesystems()
+
+        # Targets with a LUN logged in on this node, through any portal
+        local_iqns = set(iqn for _, iqn in
+                         devices.scan_iscsi_devices(self.cb_disk_by_path_dir))
+
+        listed = [v for tsmid in tsmids for v in cb_volumes.in_tsm(tsmid)]
+        templates = self._template_names()
+        for v in listed:
+            # Warm pool and template volumes do not back any dataset
+            if (warmpool.is_pool_volume(v['name']) or
+                    v['id'] in templates or v['name'] in templates):
+                continue
+            attached_to = None
+            if v['iqnname'] in local_iqns:
+                attached_to = self.compute_instance_id()
+            volumes.append(BlockDeviceVolume(
+                           blockdevice_id=unicode(v['id']),
+                           size=self._get_volume_size_in_bypes(v['currentTotalSpace']),
+                           attached_to=attached_to,
+                           dataset_id=uuid.UUID(str(v['name']))))
         return volumes
     
     def allocation_unit(self):
         return ALLOCATION_UNIT
 
 def cloudbyte_from_configuration(cluster_id, **kwargs):
-    return CloudByteBlockDeviceAPI(str(cluster_id), **kwargs)
+    api = CloudByteBlockDeviceAPI(str(cluster_id), **kwargs)
+    # Flocker never releases the API, stop its threads on exit
+    atexit.register(api.close)
+    return api
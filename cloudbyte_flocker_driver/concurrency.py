@@ -0,0 +1,90 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Concurrency helpers for sharing ElastiCenter work between threads."""
+
+import sys
+import threading
+
+import six
+from six.moves import queue
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """Collapse concurrent calls with the same key into a single call.
+
+    The first caller for a key runs the function; callers arriving while
+    it is in flight wait for it and get the same result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                six.reraise(*call.exc_info)
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+
+def run_concurrently(fn, items, workers):
+    """Call fn on every item using at most workers threads.
+
+    Returns a (result, exception) pair per item, in the order of items;
+    exception is None when the call succeeded.
+    """
+
+    items = list(items)
+    outcomes = [None] * len(items)
+    pending = queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def work():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                outcomes[index] = (fn(item), None)
+            except Exception as e:
+                outcomes[index] = (None, e)
+
+    threads = [threading.Thread(target=work)
+               for _ in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return outcomes
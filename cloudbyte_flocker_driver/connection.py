@@ -0,0 +1,136 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Keep-alive HTTPS connection pool for ElastiCenter."""
+
+import socket
+import threading
+import time
+
+from six.moves import http_client
+
+# Errors seen when ElastiCenter has already closed a kept-alive socket.
+STALE_CONNECTION_ERRORS = (
+    http_client.BadStatusLine, http_client.CannotSendRequest,
+    http_client.ResponseNotReady, socket.error,
+)
+
+CONNECTION_CLASSES = {
+    'https': http_client.HTTPSConnection,
+    'http': http_client.HTTPConnection,
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _read_body(response):
+    return response.read()
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of persistent connections to a single host."""
+
+    def __init__(self, host, size=4, idle_timeout=60,
+                 connection_factory=http_client.HTTPSConnection):
+        self.host = host
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._connection_factory = connection_factory
+        self._lock = threading.Lock()
+        # Idle connections as (connection, last_used) pairs, newest last
+        self._idle = []
+
+    def _evict_expired(self, now):
+        """Remove idle connections past the idle timeout; caller holds lock."""
+        expired = [c for c, used in self._idle
+                   if now - used > self.idle_timeout]
+        self._idle = [(c, used) for c, used in self._idle
+                      if now - used <= self.idle_timeout]
+        return expired
+
+    def _acquire(self):
+        with self._lock:
+            expired = self._evict_expired(time.time())
+            idle = self._idle.pop() if self._idle else None
+
+        for connection in expired:
+            connection.close()
+
+        if idle is not None:
+            return idle[0], True
+        return self._connection_factory(self.host), False
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def _receive(self, connection, reader):
+        response = connection.getresponse()
+        # The body must be fully read before the socket can be reused
+        return response, reader(response)
+
+    def request(self, method, url, reader=None, idempotent=False):
+        """Run a request on a pooled connection, return (status, body).
+
+        reader, if given, consumes the whole response and its result is
+        returned in place of the raw body. A request that fails on a stale
+        kept-alive socket is resent on a new connection when it could not
+        be sent, or, if it is idempotent, when no response came back.
+        """
+
+        if reader is None:
+            reader = _read_body
+
+        connection, reused = self._acquire()
+        try:
+            try:
+                sent = False
+                connection.request(method, url)
+                sent = True
+                response, data = self._receive(connection, reader)
+            except STALE_CONNECTION_ERRORS:
+                connection.close()
+                # ElastiCenter may have acted on a request it received
+                if not reused or (sent and not idempotent):
+                    raise
+                connection = self._connection_factory(self.host)
+                connection.request(method, url)
+                response, data = self._receive(connection, reader)
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+
+        return response.status, data
+
+    def close(self):
+        """Close every idle connection held by the pool."""
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection, _ in idle:
+            connection.close()
+
+
+def get_pool(host, size=4, idle_timeout=60, protocol='https'):
+    """Return the shared connection pool for an ElastiCenter host."""
+
+    if protocol not in CONNECTION_CLASSES:
+        raise ValueError("Unsupported ElastiCenter protocol [" + protocol + "].")
+
+    with _pools_lock:
+        pool = _pools.get((protocol, host))
+        if pool is None:
+            pool = ConnectionPool(host, size, idle_timeout,
+                                  CONNECTION_CLASSES[protocol])
+            _pools[(protocol, host)] = pool
+        return pool
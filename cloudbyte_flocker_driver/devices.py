@@ -0,0 +1,251 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Local view of the iSCSI block devices present on this node."""
+
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import time
+
+from cloudbyte_flocker_driver import metrics
+from cloudbyte_flocker_driver import tracing
+
+DISK_BY_PATH = '/dev/disk/by-path'
+SYSFS_ROOT = '/sys'
+
+# Files of /sys/block/<dev>/queue a profile may set
+QUEUE_SETTINGS = ('scheduler', 'read_ahead_kb', 'nr_requests',
+                  'max_sectors_kb', 'rq_affinity', 'nomerges', 'add_random',
+                  'rotational')
+
+# inotify(7) constants
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DIR_CHANGES = _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+# e.g. ip-20.10.1.1:3260-iscsi-iqn.2016-01.com.cloudbyte:vol1-lun-0
+_BY_PATH_ISCSI = re.compile(
+    r'^ip-(?P<ip>.+):(?P<port>\d+)-iscsi-(?P<iqn>.+)-lun-(?P<lun>\d+)$')
+
+
+def parse_by_path_name(name):
+    """Return (ip, port, iqn, lun) of an iSCSI by-path link name or None."""
+
+    match = _BY_PATH_ISCSI.match(name)
+    if match is None:
+        return None
+    return (match.group('ip'), int(match.group('port')),
+            match.group('iqn'), int(match.group('lun')))
+
+
+def scan_iscsi_devices(by_path_dir=DISK_BY_PATH):
+    """Map (portal ip, iqn) to the by-path link of every local iSCSI LUN."""
+
+    try:
+        names = os.listdir(by_path_dir)
+    except OSError:
+        # No by-path directory means no iSCSI devices yet
+        return {}
+
+    devices = {}
+    for name in names:
+        parsed = parse_by_path_name(name)
+        if parsed is None:
+            continue
+        ip, _, iqn, _ = parsed
+        devices[(ip, iqn)] = os.path.join(by_path_dir, name)
+    return devices
+
+
+def normalize_queue_settings(tuning):
+    """Return sorted (queue file, value) pairs of a queue tuning set."""
+
+    settings = []
+    for name, value in (tuning or {}).items():
+        if name not in QUEUE_SETTINGS:
+            raise ValueError("Unknown block queue setting [" + name + "].")
+        settings.append((name, str(value)))
+    return sorted(settings)
+
+
+def parse_queue_value(text):
+    """Current value of a queue file; the bracketed entry for scheduler."""
+
+    match = re.search(r'\[(\S+)\]', text)
+    return match.group(1) if match else text.strip()
+
+
+class QueueTuner(object):
+    """Apply queue settings to block devices through sysfs.
+
+    A multipath device's underlying paths get the same settings, since
+    requests are queued again on each of them. What was applied to each
+    device, and which settings did not take, is kept in ``applied``.
+    """
+
+    def __init__(self, sysfs_root=SYSFS_ROOT, registry=None, tracer=None):
+        self.sysfs_root = sysfs_root
+        self._tracer = tracer or tracing.Tracer()
+        self.applied = {}
+
+        if registry is None:
+            registry = metrics.Registry(enabled=False)
+        self._mismatches = registry.counter(
+            'cloudbyte_queue_tuning_mismatches_total',
+            'Block queue settings a device did not end up with.',
+            ['setting'])
+
+    def _block_dir(self, name):
+        return os.path.join(self.sysfs_root, 'block', name)
+
+    def _devices(self, device):
+        name = os.path.basename(device)
+        try:
+            slaves = sorted(os.listdir(os.path.join(self._block_dir(name),
+                                                    'slaves')))
+        except OSError:
+            slaves = []
+        return [name] + slaves
+
+    def apply(self, device, settings):
+        """Write settings for device, e.g. /dev/sdb; return the mismatches.
+
+        Mismatches map 'name/setting' to (wanted, actual).
+        """
+
+        mismatches = {}
+        with self._tracer.span('queue.tune', device=device) as span:
+            for name in self._devices(device):
+                queue = os.path.join(self._block_dir(name), 'queue')
+                for key, wanted in settings:
+                    actual = self._write(os.path.join(queue, key), wanted)
+                    if actual != wanted:
+                        mismatches['%s/%s' % (name, key)] = (wanted, actual)
+                        self._mismatches.labels(key).inc()
+            span.set('mismatches', len(mismatches))
+
+        self.applied[os.path.basename(device)] = (list(settings), mismatches)
+        return mismatches
+
+    def _write(self, path, value):
+        """Write value to a sysfs file and return what it reads back."""
+
+        if not os.path.exists(path):
+            # Not every device or kernel has every queue file
+            return None
+        try:
+            with open(path, 'w') as f:
+                f.write(value)
+        except (IOError, OSError):
+            # The kernel rejects values it does not support; the read
+            # back below reports what is in effect
+            pass
+        try:
+            with open(path) as f:
+                return parse_queue_value(f.read())
+        except (IOError, OSError):
+            return None
+
+
+def _load_inotify():
+    """Return libc if it provides inotify, otherwise None."""
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class DeviceWaiter(object):
+    """Wait for a device link to appear or disappear.
+
+    The link's directory is watched with inotify so waiters wake up as soon
+    as udev changes it; without inotify (or without the directory yet) the
+    link is polled every ``poll_interval`` seconds instead.
+    """
+
+    def __init__(self, poll_interval=0.1, registry=None, tracer=None):
+        self.poll_interval = poll_interval
+        self._libc = _load_inotify()
+        self._tracer = tracer or tracing.Tracer()
+
+        if registry is None:
+            registry = metrics.Registry(enabled=False)
+        self._latency = registry.histogram(
+            'cloudbyte_device_wait_seconds',
+            'Time spent waiting for device links.', ['state', 'outcome'])
+
+    def wait(self, path, present=True, timeout=10):
+        """Return True once os.path.exists(path) == present, False on timeout."""
+
+        start = time.time()
+        with self._tracer.span('device.wait', path=path,
+                               present=present) as span:
+            found = self._wait(path, present, timeout)
+            span.set('found', found)
+        self._latency.labels('present' if present else 'absent',
+                             'ok' if found else 'timeout').observe(
+                                 time.time() - start)
+        return found
+
+    def _wait(self, path, present, timeout):
+        if os.path.exists(path) == present:
+            return True
+
+        deadline = time.time() + timeout
+        fd = self._watch(os.path.dirname(path))
+        if fd is None:
+            return self._poll(path, present, deadline)
+
+        try:
+            while True:
+                # Check after arming the watch so no change is missed
+                if os.path.exists(path) == present:
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                readable, _, _ = select.select([fd], [], [], remaining)
+                if readable:
+                    self._drain(fd)
+        finally:
+            os.close(fd)
+
+    def _watch(self, directory):
+        if self._libc is None:
+            return None
+
+        fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            return None
+        if self._libc.inotify_add_watch(
+                fd, directory.encode('utf-8'), _IN_DIR_CHANGES) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _drain(self, fd):
+        # Events only signal a change, the path itself is checked again
+        try:
+            while os.read(fd, 4096):
+                pass
+        except OSError:
+            pass
+
+    def _poll(self, path, present, deadline):
+        while time.time() < deadline:
+            if os.path.exists(path) == present:
+                return True
+            time.sleep(self.poll_interval)
+        return os.path.exists(path) == present
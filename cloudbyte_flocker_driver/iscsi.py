@@ -0,0 +1,368 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""In-process bookkeeping of open-iscsi sessions and node records."""
+
+import re
+import shlex
+import subprocess
+import threading
+import time
+
+from cloudbyte_flocker_driver import cache
+from cloudbyte_flocker_driver import metrics
+from cloudbyte_flocker_driver import tracing
+
+# iscsiadm exit codes that only mean "nothing to do"
+ISCSI_ERR_SESS_EXISTS = 15
+ISCSI_ERR_NO_OBJS_FOUND = 21
+
+# e.g. tcp: [3] 20.10.1.1:3260,1 iqn.2016-01.com.cloudbyte:vol1 (non-flash)
+_SESSION_LINE = re.compile(
+    r'^\S+:\s+\[(?P<sid>\d+)\]\s+(?P<ip>\S+):(?P<port>\d+),\d+\s+(?P<iqn>\S+)')
+# e.g. 20.10.1.1:3260,1 iqn.2016-01.com.cloudbyte:vol1
+_NODE_LINE = re.compile(r'^(?P<ip>\S+):(?P<port>\d+),\d+\s+(?P<iqn>\S+)')
+# `iscsiadm -m session -P 2` blocks, e.g. Target: iqn... (non-flash)
+_TARGET_LINE = re.compile(r'^Target:\s+(?P<iqn>\S+)')
+_PORTAL_LINE = re.compile(r'^Current Portal:\s+(?P<ip>\S+):(?P<port>\d+),\d+')
+
+# Short names accepted in a profile's iSCSI tuning
+SETTING_ALIASES = {
+    'cmds_max': 'node.session.cmds_max',
+    'queue_depth': 'node.session.queue_depth',
+    'nr_sessions': 'node.session.nr_sessions',
+    'MaxRecvDataSegmentLength': 'node.conn[0].iscsi.MaxRecvDataSegmentLength',
+    'FirstBurstLength': 'node.session.iscsi.FirstBurstLength',
+    'MaxBurstLength': 'node.session.iscsi.MaxBurstLength',
+    'ImmediateData': 'node.session.iscsi.ImmediateData',
+    'InitialR2T': 'node.session.iscsi.InitialR2T',
+}
+
+
+class ISCSIError(Exception):
+    pass
+
+
+def parse_sessions(output):
+    """Map (portal ip, iqn) to session id from `iscsiadm -m session`."""
+
+    sessions = {}
+    for line in output.splitlines():
+        match = _SESSION_LINE.match(line.strip())
+        if match:
+            sessions[(match.group('ip'), match.group('iqn'))] = \
+                match.group('sid')
+    return sessions
+
+
+def parse_nodes(output):
+    """Set of (portal ip, iqn) from `iscsiadm -m node` or discovery output."""
+
+    nodes = set()
+    for line in output.splitlines():
+        match = _NODE_LINE.match(line.strip())
+        if match:
+            nodes.add((match.group('ip'), match.group('iqn')))
+    return nodes
+
+
+def normalize_settings(tuning):
+    """Return sorted (node record key, value) pairs of an iSCSI tuning set."""
+
+    settings = []
+    for key, value in (tuning or {}).items():
+        key = SETTING_ALIASES.get(key, key)
+        if not key.startswith('node.'):
+            raise ValueError("Unknown iSCSI setting [" + key + "].")
+        if isinstance(value, bool):
+            value = 'Yes' if value else 'No'
+        settings.append((key, str(value)))
+    return sorted(settings)
+
+
+def parse_node_record(output):
+    """Map key to value from `iscsiadm -m node -T iqn -p ip`."""
+
+    record = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition(' = ')
+        if sep:
+            record[key.strip()] = value.strip()
+    return record
+
+
+def parse_session_params(output):
+    """Negotiated parameters of each session in `iscsiadm -m session -P 2`.
+
+    Returns a list of (portal ip, iqn, {parameter: value}), one per session.
+    """
+
+    sessions = []
+    iqn = None
+    params = None
+    for line in output.splitlines():
+        line = line.strip()
+        match = _TARGET_LINE.match(line)
+        if match:
+            iqn = match.group('iqn')
+            continue
+        match = _PORTAL_LINE.match(line)
+        if match and iqn:
+            params = {}
+            sessions.append((match.group('ip'), iqn, params))
+            continue
+        key, sep, value = line.partition(': ')
+        if sep and params is not None and ' ' not in key:
+            params[key] = value.strip()
+    return sessions
+
+
+def find_mismatches(settings, record, negotiated, session_count):
+    """Compare wanted settings with what the live session ended up with.
+
+    iSCSI login parameters are checked against the values negotiated with
+    the target (which may lower them), the others against the node record.
+    Returns {key: (wanted, actual)}.
+    """
+
+    mismatches = {}
+    for key, wanted in settings:
+        if key == 'node.session.nr_sessions':
+            actual = str(session_count)
+        elif '.iscsi.' in key:
+            actual = negotiated.get(key.rsplit('.', 1)[1])
+        else:
+            actual = record.get(key)
+        if actual is None or actual.lower() != wanted.lower():
+            mismatches[key] = (wanted, actual)
+    return mismatches
+
+
+class ISCSISessionManager(object):
+    """Tracks iSCSI sessions and node records to avoid redundant iscsiadm runs.
+
+    The session and node tables are read from iscsiadm once, then kept up
+    to date by the logins and logouts done here. Sessions can also end
+    outside the driver, so a session entry older than ``session_ttl``
+    seconds is checked against iscsiadm before a login is skipped.
+    iscsiadm invocations for the same target (or discovery portal) are
+    serialized.
+    """
+
+    def __init__(self, iscsiadm='sudo iscsiadm', discovery_ttl=300,
+                 registry=None, tracer=None, session_ttl=5):
+        self._iscsiadm = shlex.split(iscsiadm)
+        self._tracer = tracer or tracing.Tracer()
+        self._discoveries = cache.TTLCache(discovery_ttl)
+        self.session_ttl = session_ttl
+
+        if registry is None:
+            registry = metrics.Registry(enabled=False)
+        self._latency = registry.histogram(
+            'cloudbyte_iscsiadm_seconds',
+            'Duration of iscsiadm invocations.', ['mode', 'exit_code'])
+        self._in_flight = registry.gauge(
+            'cloudbyte_iscsiadm_in_flight', 'Running iscsiadm processes.')
+        self._mismatches = registry.counter(
+            'cloudbyte_iscsi_tuning_mismatches_total',
+            'iSCSI tuning settings a new session did not end up with.',
+            ['setting'])
+
+        self._lock = threading.Lock()
+        self._target_locks = {}
+        self._sessions = None
+        self._nodes = None
+        # (portal ip, iqn) -> when its session was last known to exist
+        self._session_seen = {}
+        # (portal ip, iqn) -> (applied settings, mismatches) of the last login
+        self.tuning = {}
+
+    def _target_lock(self, key):
+        with self._lock:
+            lock = self._target_locks.get(key)
+            if lock is None:
+                lock = self._target_locks[key] = threading.Lock()
+            return lock
+
+    def iscsiadm(self, *args, **kwargs):
+        """Run iscsiadm, returning its output.
+
+        Exit codes listed in ``ok_codes`` are treated as success with empty
+        output.
+        """
+
+        ok_codes = kwargs.get('ok_codes', ())
+        mode = args[1] if args[:1] == ('-m',) else ''
+
+        self._in_flight.inc()
+        start = time.time()
+        exit_code = 0
+        with self._tracer.span('iscsiadm', args=' '.join(args)) as span:
+            try:
+                output = subprocess.check_output(self._iscsiadm + list(args))
+            except subprocess.CalledProcessError as e:
+                exit_code = e.returncode
+                if e.returncode in ok_codes:
+                    return ''
+                raise
+            except OSError:
+                exit_code = 'error'
+                raise
+            finally:
+                span.set('exit_code', exit_code)
+                self._in_flight.dec()
+                self._latency.labels(mode, exit_code).observe(time.time() - start)
+        if not isinstance(output, str):
+            output = output.decode('utf-8')
+        return output
+
+    def refresh(self):
+        """Reload the session and node tables from iscsiadm."""
+
+        sessions = parse_sessions(self.iscsiadm(
+            '-m', 'session', ok_codes=(ISCSI_ERR_NO_OBJS_FOUND,)))
+        nodes = parse_nodes(self.iscsiadm(
+            '-m', 'node', ok_codes=(ISCSI_ERR_NO_OBJS_FOUND,)))
+
+        now = time.time()
+        with self._lock:
+            self._sessions = sessions
+            self._nodes = nodes
+            self._session_seen = dict((key, now) for key in sessions)
+
+    def _load(self):
+        with self._lock:
+            loaded = self._sessions is not None
+        if not loaded:
+            self.refresh()
+
+    def has_session(self, ip, iqn):
+        self._load()
+        with self._lock:
+            return (ip, iqn) in self._sessions
+
+    def _session_is_fresh(self, ip, iqn):
+        with self._lock:
+            seen = self._session_seen.get((ip, iqn))
+        return seen is not None and time.time() - seen < self.session_ttl
+
+    def has_node(self, ip, iqn):
+        self._load()
+        with self._lock:
+            return (ip, iqn) in self._nodes
+
+    def discover(self, portal):
+        """Return the (ip, iqn) targets advertised by portal, cached."""
+
+        targets = self._discoveries.get(portal)
+        if targets is not None:
+            return targets
+
+        with self._target_lock(('discovery', portal)):
+            targets = self._discoveries.get(portal)
+            if targets is not None:
+                return targets
+
+            targets = parse_nodes(self.iscsiadm(
+                '-m', 'discovery', '-t', 'sendtargets', '-p', portal))
+            self._discoveries.set(portal, targets)
+
+        # sendtargets discovery creates a node record per target
+        self._load()
+        with self._lock:
+            self._nodes.update(targets)
+        return targets
+
+    def forget_discovery(self, portal):
+        self._discoveries.invalidate(portal)
+
+    def login(self, ip, iqn, settings=None):
+        """Log into the target unless a session already exists.
+
+        ``settings`` are (key, value) pairs written to the node record
+        before logging in and checked against the session afterwards.
+        """
+
+        with self._target_lock(iqn):
+            if self.has_session(ip, iqn):
+                # Sessions also end outside the driver (admin logout,
+                # target restart); recheck an entry that is not recent
+                if not self._session_is_fresh(ip, iqn):
+                    self.refresh()
+                if self.has_session(ip, iqn):
+                    return
+
+            if not self.has_node(ip, iqn):
+                if (ip, iqn) not in self.discover(ip):
+                    # Cached discovery may predate the target, ask again
+                    self.forget_discovery(ip)
+                    if (ip, iqn) not in self.discover(ip):
+                        raise ISCSIError(
+                            "Target [" + iqn + "] not found during "
+                            "discovery on portal [" + ip + "].")
+
+            for key, value in settings or ():
+                self.iscsiadm('-m', 'node', '-p', ip, '-T', iqn,
+                              '-o', 'update', '-n', key, '-v', value)
+
+            self.iscsiadm('-m', 'node', '-p', ip, '-T', iqn, '--login',
+                          ok_codes=(ISCSI_ERR_SESS_EXISTS,))
+
+            with self._lock:
+                # The session id is only known after the next refresh
+                self._sessions[(ip, iqn)] = None
+                self._session_seen[(ip, iqn)] = time.time()
+
+            if settings:
+                self.verify(ip, iqn, settings)
+
+    def verify(self, ip, iqn, settings):
+        """Record which settings the target's session did not take.
+
+        Returns {key: (wanted, actual)}.
+        """
+
+        record = parse_node_record(self.iscsiadm(
+            '-m', 'node', '-p', ip, '-T', iqn))
+        sessions = [params for portal, target, params in
+                    parse_session_params(self.iscsiadm(
+                        '-m', 'session', '-P', '2',
+                        ok_codes=(ISCSI_ERR_NO_OBJS_FOUND,)))
+                    if (portal, target) == (ip, iqn)]
+
+        mismatches = find_mismatches(
+            settings, record, sessions[0] if sessions else {}, len(sessions))
+        for key in mismatches:
+            self._mismatches.labels(key).inc()
+        with self._lock:
+            self.tuning[(ip, iqn)] = (list(settings), mismatches)
+        return mismatches
+
+    def logout(self, ip, iqn):
+        """Log out of the target and delete its node record."""
+
+        self.logout_all([ip], iqn)
+
+    def logout_all(self, ips, iqn):
+        """Log out of the target on each portal, then delete its node records."""
+
+        with self._target_lock(iqn):
+            # Logging out needs the node records, delete them last
+            for ip in ips:
+                self.iscsiadm('-m', 'node', '-p', ip, '-T', iqn, '-u',
+                              ok_codes=(ISCSI_ERR_NO_OBJS_FOUND,))
+            self.iscsiadm('-m', 'node', '-o', 'delete', '-T', iqn,
+                          ok_codes=(ISCSI_ERR_NO_OBJS_FOUND,))
+
+            # Their discovery results still list the deleted node records
+            for ip in ips:
+                self.forget_discovery(ip)
+
+            self._load()
+            with self._lock:
+                for ip in ips:
+                    self._sessions.pop((ip, iqn), None)
+                    self._session_seen.pop((ip, iqn), None)
+                    self.tuning.pop((ip, iqn), None)
+                self._nodes = set(
+                    node for node in self._nodes if node[1] != iqn)
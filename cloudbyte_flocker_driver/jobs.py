@@ -0,0 +1,187 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Tracking of CloudByte asynchronous jobs."""
+
+import random
+import sys
+import threading
+import time
+
+import six
+from six.moves import queue
+
+# queryAsyncJobResult job statuses that mean the job has finished
+JOB_SUCCEEDED = 1
+JOB_FAILED = 2
+
+
+class _Job(object):
+    def __init__(self, jobid, query, interval):
+        self.jobid = jobid
+        self.query = query
+        self.interval = interval
+        self.next_check = time.time() + interval
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class AsyncJobTracker(object):
+    """Wait for async jobs, scheduling all of them from one background thread.
+
+    Each job is first checked after ``initial_interval`` seconds; the gap
+    between checks then grows by ``backoff`` up to ``max_interval``, with
+    +/- ``jitter`` (a fraction) of randomness so jobs don't poll in step.
+    Due jobs are queried by up to ``workers`` threads, a slow query only
+    delays the job it belongs to.
+    """
+
+    def __init__(self, initial_interval=0.25, max_interval=5, backoff=2.0,
+                 jitter=0.2, workers=8):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.workers = max(1, workers)
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._jobs = []
+        # Jobs handed to a worker and not rescheduled yet
+        self._checking = set()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._workers = []
+        self._stopped = False
+
+    def wait(self, jobid, query, timeout):
+        """Wait for jobid to finish and return its last query result.
+
+        ``query(jobid)`` returns the queryasyncjobresultresponse of the job.
+        Returns None when the job has not finished within timeout seconds.
+        """
+
+        job = _Job(jobid, query, self.initial_interval)
+
+        with self._lock:
+            stopped = self._stopped
+            if not stopped:
+                self._jobs.append(job)
+                self._start()
+                self._changed.notify()
+
+        if stopped:
+            # No poller any more, check the job from this thread
+            self._poll(job, time.time() + timeout)
+
+        if not job.done.wait(0 if stopped else timeout):
+            with self._lock:
+                if job in self._jobs:
+                    self._jobs.remove(job)
+            return None
+
+        if job.exc_info is not None:
+            six.reraise(*job.exc_info)
+        return job.result
+
+    def _start(self):
+        """Start the poller and worker threads; caller holds the lock."""
+
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+            for _ in range(self.workers):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _jittered(self, interval):
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def stop(self, timeout=None):
+        """Stop polling, waiting up to timeout for a running check."""
+
+        with self._lock:
+            self._stopped = True
+            threads = [self._thread] if self._thread is not None else []
+            threads.extend(self._workers)
+            self._changed.notify()
+        for _ in self._workers:
+            self._queue.put(None)
+        if timeout:
+            deadline = time.time() + timeout
+            for thread in threads:
+                thread.join(max(0, deadline - time.time()))
+
+    def _due_jobs(self):
+        """Block until some jobs need checking and return them.
+
+        Returns None once the tracker is stopped.
+        """
+
+        with self._lock:
+            while not self._stopped:
+                now = time.time()
+                waiting = [job for job in self._jobs
+                           if job not in self._checking]
+                due = [job for job in waiting if job.next_check <= now]
+                if due:
+                    self._checking.update(due)
+                    return due
+                if waiting:
+                    next_check = min(job.next_check for job in waiting)
+                    self._changed.wait(next_check - now)
+                else:
+                    self._changed.wait()
+
+    def _finish(self, job):
+        with self._lock:
+            if job in self._jobs:
+                self._jobs.remove(job)
+        job.done.set()
+
+    def _check(self, job):
+        """Query a job once, finishing it or scheduling its next check."""
+
+        try:
+            result = job.query(job.jobid)
+        except Exception:
+            job.exc_info = sys.exc_info()
+            self._finish(job)
+            return
+
+        if result.get('jobstatus') in (JOB_SUCCEEDED, JOB_FAILED):
+            job.result = result
+            self._finish(job)
+        else:
+            job.interval = min(job.interval * self.backoff,
+                               self.max_interval)
+            job.next_check = time.time() + self._jittered(job.interval)
+
+    def _poll(self, job, deadline):
+        while not job.done.is_set() and job.next_check < deadline:
+            time.sleep(max(0, job.next_check - time.time()))
+            self._check(job)
+
+    def _run(self):
+        while True:
+            due = self._due_jobs()
+            if due is None:
+                return
+            for job in due:
+                self._queue.put(job)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                self._check(job)
+            finally:
+                with self._lock:
+                    self._checking.discard(job)
+                    self._changed.notify()
@@ -0,0 +1,98 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""JSON decoding helpers: a fast backend when available and array streaming."""
+
+import codecs
+import json
+import re
+
+try:
+    import simplejson as _json
+except ImportError:
+    _json = json
+
+# Fastest installed decoder for whole documents
+try:
+    import orjson as _fast_json
+except ImportError:
+    try:
+        import ujson as _fast_json
+    except ImportError:
+        _fast_json = _json
+
+loads = _fast_json.loads
+
+_WHITESPACE = re.compile(r'[\s,]*')
+
+
+class JSONArrayStream(object):
+    """Iterate over the items of one array inside a streamed JSON document.
+
+    Items of the array under ``key`` are decoded one at a time as the bytes
+    arrive from ``readable`` (anything with ``read(size)``), so the full
+    document is never held in memory. If the key never shows up, the whole
+    document is decoded instead and left in ``document``.
+    """
+
+    def __init__(self, readable, key, chunk_size=65536):
+        self._readable = readable
+        self._start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+        self._chunk_size = chunk_size
+        self._decoder = _json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = u''
+        self._eof = False
+        self.found = False
+        self.document = None
+
+    def _read_more(self):
+        if self._eof:
+            return False
+        chunk = self._readable.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            self._buffer += self._text_decoder.decode(b'', final=True)
+            return False
+        self._buffer += self._text_decoder.decode(chunk)
+        return True
+
+    def _find_array(self):
+        while True:
+            match = self._start.search(self._buffer)
+            if match:
+                self._buffer = self._buffer[match.end():]
+                return True
+            if not self._read_more():
+                return False
+
+    def __iter__(self):
+        if not self._find_array():
+            self.document = loads(self._buffer) if self._buffer else {}
+            return
+
+        self.found = True
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(self._buffer, pos).end()
+            if pos >= len(self._buffer):
+                # Drop what was consumed before waiting for more bytes
+                self._buffer, pos = u'', 0
+                if not self._read_more():
+                    raise ValueError("Truncated JSON array in response.")
+                continue
+
+            if self._buffer[pos] == u']':
+                return
+
+            try:
+                item, end = self._decoder.raw_decode(self._buffer, pos)
+            except ValueError:
+                # The item is not complete yet
+                self._buffer, pos = self._buffer[pos:], 0
+                if not self._read_more():
+                    raise
+                continue
+
+            pos = end
+            yield item
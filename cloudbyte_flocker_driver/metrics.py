@@ -0,0 +1,255 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Counters, gauges and latency histograms in Prometheus text format."""
+
+import bisect
+import os
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+class _NoopMetric(object):
+    """Stand-in for every metric when metrics are disabled."""
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+NOOP = _NoopMetric()
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._new_child()
+            return child
+
+    def _default(self):
+        return self.labels(*([''] * len(self.labelnames)))
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            lines.extend(child.render(self.name, self.labelnames, values))
+        return lines
+
+
+class _Value(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = float(value)
+
+    def render(self, name, labelnames, values):
+        return ['%s%s %r' % (name, _format_labels(labelnames, values),
+                             self.value)]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+    _new_child = _Value
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+    _new_child = _Value
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set(self, value):
+        self._default().set(value)
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if index < len(self.counts):
+                self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def render(self, name, labelnames, values):
+        lines = []
+        cumulative = 0
+        with self._lock:
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    name, _format_labels(labelnames, values, ('le', bound)),
+                    cumulative))
+            lines.append('%s_bucket%s %d' % (
+                name, _format_labels(labelnames, values, ('le', '+Inf')),
+                self.count))
+            lines.append('%s_sum%s %r' % (
+                name, _format_labels(labelnames, values), self.sum))
+            lines.append('%s_count%s %d' % (
+                name, _format_labels(labelnames, values), self.count))
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+
+class Registry(object):
+    """Named metrics of one process; hands out no-ops when disabled."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, documentation, labelnames, **kwargs):
+        if not self.enabled:
+            return NOOP
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(
+                    name, documentation, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames,
+                         buckets=buckets)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for _, metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(registry, port, host='127.0.0.1'):
+    """Expose registry over HTTP from a daemon thread; returns the server."""
+
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def dump_periodically(registry, path, interval=15):
+    """Rewrite path with the registry contents every interval seconds."""
+
+    def dump():
+        while True:
+            try:
+                with open(path + '.tmp', 'w') as f:
+                    f.write(registry.render())
+                os.rename(path + '.tmp', path)
+            except (IOError, OSError):
+                # Try again on the next round, e.g. once the directory exists
+                pass
+            time.sleep(interval)
+
+    thread = threading.Thread(target=dump)
+    thread.daemon = True
+    thread.start()
+    return thread
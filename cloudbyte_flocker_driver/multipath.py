@@ -0,0 +1,285 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""dm-multipath attach of a volume through every portal of its VSM.
+
+A target is logged into on each portal that advertises it, giving one
+SCSI path (and TCP session) per portal. multipathd assembles the paths
+into a single dm device, spreading I/O over them with the configured
+path selector.
+"""
+
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+
+from cloudbyte_flocker_driver import devices
+from cloudbyte_flocker_driver import metrics
+from cloudbyte_flocker_driver import tracing
+
+DEFAULT_CONF_DIR = '/etc/multipath/conf.d'
+CONF_FILE_NAME = 'cloudbyte.conf'
+# Installs a file (and any missing directories) owned by root
+DEFAULT_INSTALL_COMMAND = 'sudo install -D -m 0644'
+
+# multipath.conf path_selector per policy
+PATH_SELECTORS = {
+    'round-robin': 'round-robin 0',
+    'queue-length': 'queue-length 0',
+    'service-time': 'service-time 0',
+}
+
+# SCSI vendor ids are 8 characters; multipath matches them as a regex
+DEFAULT_VENDOR = 'CloudByt'
+
+_CONF_TEMPLATE = '''# Written by the CloudByte Flocker driver
+devices {
+    device {
+        vendor "%(vendor)s"
+        product ".*"
+        path_grouping_policy multibus
+        path_selector "%(path_selector)s"
+        failback immediate
+        no_path_retry 12
+    }
+}
+'''
+
+
+class MultipathError(Exception):
+    pass
+
+
+def parse_columns(output):
+    """Split `multipathd ... raw format` output into rows of two columns."""
+
+    rows = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            rows.append((fields[0], fields[1]))
+    return rows
+
+
+def _is_map_name(name):
+    # Paths not (yet) in a map are reported as orphans
+    return name not in ('', '-', '[orphan]')
+
+
+class MultipathManager(object):
+    """Log into every portal of a target and find its multipath device.
+
+    ``iscsi`` is the ISCSISessionManager doing logins and discovery and
+    ``disk_path(ip, iqn)`` returns the by-path link of a target's LUN on
+    one portal. The configuration file is written with ``install``, like
+    multipathd run through sudo by default.
+    """
+
+    def __init__(self, iscsi, device_waiter, disk_path,
+                 multipathd='sudo multipathd', policy='round-robin',
+                 conf_dir=DEFAULT_CONF_DIR, vendor=DEFAULT_VENDOR,
+                 by_path_dir=devices.DISK_BY_PATH, poll_interval=0.1,
+                 registry=None, tracer=None,
+                 install=DEFAULT_INSTALL_COMMAND):
+        if policy not in PATH_SELECTORS:
+            raise ValueError("Unknown multipath policy [" + str(policy) + "].")
+
+        self._iscsi = iscsi
+        self._device_waiter = device_waiter
+        self._disk_path = disk_path
+        self._multipathd = shlex.split(multipathd)
+        self._install = shlex.split(install)
+        self.policy = policy
+        self.conf_dir = conf_dir
+        self.vendor = vendor
+        self.by_path_dir = by_path_dir
+        self.poll_interval = poll_interval
+        self._tracer = tracer or tracing.Tracer()
+
+        if registry is None:
+            registry = metrics.Registry(enabled=False)
+        self._latency = registry.histogram(
+            'cloudbyte_multipathd_seconds',
+            'Duration of multipathd invocations.', ['command', 'exit_code'])
+
+        self._lock = threading.Lock()
+        self._configured = False
+        # iqn -> (map name, dm device) of the targets attached by us
+        self._maps = {}
+
+    def multipathd(self, *args):
+        """Run multipathd, returning its output."""
+
+        start = time.time()
+        exit_code = 0
+        with self._tracer.span('multipathd', args=' '.join(args)) as span:
+            try:
+                output = subprocess.check_output(self._multipathd + list(args))
+            except subprocess.CalledProcessError as e:
+                exit_code = e.returncode
+                raise
+            except OSError:
+                exit_code = 'error'
+                raise
+            finally:
+                span.set('exit_code', exit_code)
+                self._latency.labels(args[0] if args else '',
+                                     exit_code).observe(time.time() - start)
+        if not isinstance(output, str):
+            output = output.decode('utf-8')
+        return output
+
+    def configure(self):
+        """Install the device section for our LUNs and reload multipathd.
+
+        Only done once per process, and only reloads when the file changed.
+        """
+
+        with self._lock:
+            if self._configured:
+                return
+
+            conf = _CONF_TEMPLATE % {
+                'vendor': self.vendor,
+                'path_selector': PATH_SELECTORS[self.policy]}
+            path = os.path.join(self.conf_dir, CONF_FILE_NAME)
+            try:
+                with open(path) as f:
+                    current = f.read()
+            except IOError:
+                current = None
+
+            if current != conf:
+                self._install_file(conf, path)
+                self.multipathd('reconfigure')
+            self._configured = True
+
+    def _install_file(self, content, path):
+        fd, tmp_path = tempfile.mkstemp(prefix='cloudbyte-multipath-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            subprocess.check_call(self._install + [tmp_path, path])
+        finally:
+            os.unlink(tmp_path)
+
+    def portals(self, ip, iqn):
+        """Portal ips advertising iqn, as discovered through portal ip."""
+
+        targets = self._iscsi.discover(ip)
+        if (ip, iqn) not in targets:
+            # Cached discovery may predate the target, ask again
+            self._iscsi.forget_discovery(ip)
+            targets = self._iscsi.discover(ip)
+
+        portals = sorted(portal for portal, target in targets
+                         if target == iqn)
+        if not portals:
+            raise MultipathError("Target [" + iqn + "] not found during "
+                                 "discovery on portal [" + ip + "].")
+        return portals
+
+    def _local_paths(self, iqn):
+        """Map portal ip to the by-path link of every local path of iqn."""
+
+        return dict((portal, link) for (portal, target), link
+                    in devices.scan_iscsi_devices(self.by_path_dir).items()
+                    if target == iqn)
+
+    def is_attached(self, iqn):
+        return bool(self._local_paths(iqn))
+
+    def _find_map(self, links):
+        """Return (map name, dm device) holding any of links, or None."""
+
+        disks = set(os.path.basename(os.readlink(link)) for link in links
+                    if os.path.islink(link))
+        if not disks:
+            return None
+
+        names = set(name for disk, name in parse_columns(
+            self.multipathd('show', 'paths', 'raw', 'format', '%d %m'))
+            if disk in disks and _is_map_name(name))
+        if not names:
+            return None
+
+        for name, dm in parse_columns(
+                self.multipathd('show', 'maps', 'raw', 'format', '%n %d')):
+            if name in names:
+                return name, dm
+        return None
+
+    def device(self, iqn):
+        """Return /dev/dm-N of the target's multipath map, or None.
+
+        The map found at attach is trusted while the target has local
+        paths, multipathd is only asked for targets attached elsewhere
+        (e.g. before a restart).
+        """
+
+        links = self._local_paths(iqn).values()
+        with self._lock:
+            if not links:
+                self._maps.pop(iqn, None)
+                return None
+            found = self._maps.get(iqn)
+        if found is None:
+            found = self._remember_map(iqn, self._find_map(links))
+        return '/dev/' + found[1] if found else None
+
+    def _remember_map(self, iqn, found):
+        if found is not None:
+            with self._lock:
+                self._maps[iqn] = found
+        return found
+
+    def attach(self, ip, iqn, timeout=10, settings=None):
+        """Log into the target on all its portals; return its dm device."""
+
+        self.configure()
+
+        links = []
+        for portal in self.portals(ip, iqn):
+            self._iscsi.login(portal, iqn, settings)
+            links.append(self._disk_path(portal, iqn))
+
+        deadline = time.time() + timeout
+        for link in links:
+            if not self._device_waiter.wait(
+                    link, True, max(0, deadline - time.time())):
+                raise MultipathError("Failed iSCSI login to device: [" +
+                                     link + "].")
+
+        # multipathd assembles the map asynchronously from udev events
+        while True:
+            found = self._remember_map(iqn, self._find_map(links))
+            if found is not None:
+                return '/dev/' + found[1]
+            if time.time() >= deadline:
+                raise MultipathError("No multipath device was assembled "
+                                     "for target [" + iqn + "].")
+            time.sleep(self.poll_interval)
+
+    def detach(self, iqn, timeout=10):
+        """Flush the target's map and log out of all of its portals."""
+
+        paths = self._local_paths(iqn)
+
+        with self._lock:
+            self._maps.pop(iqn, None)
+        # Looked up again, the map must not be flushed by a stale name
+        found = self._find_map(paths.values())
+        if found is not None:
+            # Flushing first keeps multipathd from queueing I/O on paths
+            # that are about to go away
+            self.multipathd('del', 'map', found[0])
+
+        self._iscsi.logout_all(sorted(paths), iqn)
+
+        deadline = time.time() + timeout
+        for link in paths.values():
+            self._device_waiter.wait(link, False,
+                                     max(0, deadline - time.time()))
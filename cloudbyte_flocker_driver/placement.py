@@ -0,0 +1,170 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Choice of the VSM a new volume is created on.
+
+Each configured VSM is scored by the headroom it would have left after
+taking the volume: the smaller of its remaining capacity and remaining
+IOPS, as a fraction of its total. VSMs the volume does not fit on are
+skipped. The figures come from listTsm and are cached for a short while;
+volumes placed since they were read are counted against them so a burst
+of creates is spread instead of piling onto one VSM.
+"""
+
+import logging
+import re
+import threading
+
+from bitmath import Byte, KiB, MiB, GiB, TiB
+
+from cloudbyte_flocker_driver import cache
+
+# listTsm fields holding capacity and IOPS figures
+CAPACITY_FIELDS = ('availablequota', 'totalquota')
+IOPS_FIELDS = ('availableiops', 'totaliops')
+
+_log = logging.getLogger(__name__)
+
+_UNITS = {'': MiB, 'B': Byte, 'K': KiB, 'M': MiB, 'G': GiB, 'T': TiB}
+_SIZE = re.compile(r'^\s*(?P<value>\d+(\.\d+)?)\s*(?P<unit>[BKMGT]?)\S*\s*$',
+                   re.IGNORECASE)
+
+
+def parse_size(value):
+    """Bytes in a size such as '100G' or '512M'; bare numbers are MiB."""
+
+    if value is None:
+        return None
+    match = _SIZE.match(str(value))
+    if match is None:
+        return None
+    unit = _UNITS[match.group('unit').upper()]
+    return int(unit(float(match.group('value'))).bytes)
+
+
+def parse_count(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def tsm_headroom(tsm):
+    """Return (free bytes, total bytes, free IOPS, total IOPS) of a TSM.
+
+    Figures the TSM does not report are None.
+    """
+
+    return (parse_size(tsm.get(CAPACITY_FIELDS[0])),
+            parse_size(tsm.get(CAPACITY_FIELDS[1])),
+            parse_count(tsm.get(IOPS_FIELDS[0])),
+            parse_count(tsm.get(IOPS_FIELDS[1])))
+
+
+def score(headroom, size, iops):
+    """Fraction of the TSM left after placing the volume; None if it won't fit."""
+
+    free_bytes, total_bytes, free_iops, total_iops = headroom
+    fractions = []
+    for free, total, need in ((free_bytes, total_bytes, size),
+                              (free_iops, total_iops, iops)):
+        if free is None or not need:
+            continue
+        if need > free:
+            return None
+        fractions.append(float(free - need) / (total or free))
+    return min(fractions) if fractions else 0.0
+
+
+class PlacementScheduler(object):
+    """Pick the configured VSM with the most headroom for a new volume.
+
+    ``driver`` is the CloudByteBlockDeviceAPI whose VSMs are considered.
+    """
+
+    def __init__(self, driver, ttl=30):
+        self._driver = driver
+        self._figures = cache.TTLCache(ttl)
+        self._lock = threading.Lock()
+        # tsm id -> [bytes, iops] placed since its figures were read
+        self._reserved = {}
+        # (tsm id, fields) already warned about
+        self._warned = set()
+
+    def _tsm_figures(self, account_id):
+        tsms = self._figures.get(account_id)
+        if tsms is not None:
+            return tsms
+
+        data = self._driver._request_tsm_details(account_id)
+        tsms = dict((tsm.get('id'), tsm) for tsm in
+                    data['listTsmResponse'].get('listTsm') or [])
+        self._figures.set(account_id, tsms)
+        for tsm in tsms.values():
+            self._check_figures(tsm)
+        with self._lock:
+            # Fresh figures already count the volumes placed so far
+            for tsm_id in tsms:
+                self._reserved.pop(tsm_id, None)
+        return tsms
+
+    def _check_figures(self, tsm):
+        """Warn, once per VSM, about figures listTsm left out."""
+
+        missing = tuple(
+            field for field, value in zip(CAPACITY_FIELDS + IOPS_FIELDS,
+                                          tsm_headroom(tsm))
+            if value is None)
+        key = (tsm.get('id'), missing)
+        with self._lock:
+            if not missing or key in self._warned:
+                return
+            self._warned.add(key)
+        _log.warning("listTsm reports no usable %s for VSM [%s], its "
+                     "headroom is not taken into account when placing "
+                     "volumes.", ', '.join(missing), tsm.get('name'))
+
+    def _headroom(self, account_id, tsm_id):
+        free_bytes, total_bytes, free_iops, total_iops = tsm_headroom(
+            self._tsm_figures(account_id).get(tsm_id, {}))
+        with self._lock:
+            placed_bytes, placed_iops = self._reserved.get(tsm_id, (0, 0))
+        if free_bytes is not None:
+            free_bytes -= placed_bytes
+        if free_iops is not None:
+            free_iops -= placed_iops
+        return free_bytes, total_bytes, free_iops, total_iops
+
+    def choose(self, size, iops):
+        """Return (account id, tsm details) of the VSM to create on."""
+
+        vsms = [(account_id, tsm_details) for account_id, tsm_details
+                in self._driver._get_vsm_details() if tsm_details]
+        if not vsms:
+            raise ValueError("None of the configured VSMs was found in "
+                             "CloudByte storage.")
+        if len(vsms) == 1:
+            return vsms[0]
+
+        ranked = []
+        for index, (account_id, tsm_details) in enumerate(vsms):
+            tsm_id = tsm_details.get('tsmid')
+            fit = score(self._headroom(account_id, tsm_id), size, iops)
+            if fit is None:
+                continue
+            with self._lock:
+                placed_bytes = self._reserved.get(tsm_id, (0, 0))[0]
+            # Ties go to the VSM with the least placed on it lately
+            ranked.append((-fit, placed_bytes, index))
+
+        if not ranked:
+            raise ValueError("No configured VSM has room for a volume of [" +
+                             str(int(size)) + "] bytes and [" + str(iops) +
+                             "] IOPS.")
+
+        account_id, tsm_details = vsms[min(ranked)[2]]
+        with self._lock:
+            placed = self._reserved.setdefault(tsm_details.get('tsmid'), [0, 0])
+            placed[0] += size
+            placed[1] += iops
+        return account_id, tsm_details
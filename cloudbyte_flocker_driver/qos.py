@@ -0,0 +1,258 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Reusable QoS groups and cleanup of orphaned ones.
+
+Volumes created with the same profile and QoS settings share a single
+QoS group named after those settings, instead of each getting a
+``QoS_<volume name>`` group of its own. Shared groups, and the per-volume
+groups this driver added, are deleted once no volume has referred to them
+for a grace period, which covers groups whose volume is still being
+created, possibly by another node. Other groups on the TSM may belong to
+other tools or clusters and are left alone.
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+QOS_GROUP_PREFIX = 'QoS_'
+SHARED_QOS_GROUP_PREFIX = QOS_GROUP_PREFIX + 'shared_'
+
+QOS_GROUP_MODES = ('shared', 'per_volume')
+
+
+def shared_group_name(profile_name, params):
+    """Name identifying a profile and its effective QoS settings."""
+
+    settings = json.dumps(sorted((k, str(v)) for k, v in params.items()
+                                 if k not in ('name', 'tsmid')))
+    digest = hashlib.sha1(settings.encode('utf-8')).hexdigest()[:8]
+    return '%s%s_%s' % (SHARED_QOS_GROUP_PREFIX, profile_name or 'default',
+                        digest)
+
+
+def profile_from_group(group, profile_iops):
+    """Name of the profile a QoS group was made for, or None.
+
+    ``profile_iops`` maps profile names to their IOPS. Shared groups are
+    named after their profile; per-volume groups can only be matched by
+    their IOPS, when exactly one profile has them.
+    """
+
+    name = str(group.get('name', ''))
+    if name.startswith(SHARED_QOS_GROUP_PREFIX):
+        profile_name = name[len(SHARED_QOS_GROUP_PREFIX):].rsplit('_', 1)[0]
+        return profile_name if profile_name in profile_iops else None
+
+    matches = [candidate for candidate, iops in profile_iops.items()
+               if str(iops) == str(group.get('iops'))]
+    return matches[0] if len(matches) == 1 else None
+
+
+def find_group_id(groups, name):
+    for group in groups:
+        if group.get('name') == name:
+            return group['id']
+    return None
+
+
+def groups_from_response(data):
+    """Return the QoS group list of a listQosGroup response."""
+
+    groups_res = data.get('listqosgroupresponse')
+
+    if groups_res is None:
+        msg = ("No response was received from CloudByte's "
+               "list qos group api call.")
+        raise ValueError(msg)
+
+    return groups_res.get('qosgroup') or []
+
+
+class QoSGroupManager(object):
+    """Find or create the shared QoS group of each profile, and clean up.
+
+    ``driver`` is the CloudByteBlockDeviceAPI used to talk to ElastiCenter.
+    """
+
+    def __init__(self, driver, gc_interval=3600, gc_grace=600):
+        self._driver = driver
+        self.gc_interval = gc_interval
+        self.gc_grace = gc_grace
+
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        # (tsm id, group name) -> group id
+        self._group_ids = {}
+        # Group id -> name of the profile it was made for
+        self._profiles = {}
+        # tsm id -> {orphaned group id: when it was first seen orphaned}
+        self._suspects = {}
+        # (tsm id, name) of the per-volume groups added by this driver
+        self._owned = set(driver._state.qos_groups())
+        self._last_gc = None
+        self._gc_thread = None
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def shared_group(self, tsmid, profile_name):
+        """Return (cache key, addQosGroup params) of a profile's shared group."""
+
+        driver = self._driver
+        params = driver._get_qos_group_params(
+            tsmid, '', driver.cb_add_qosgroup, profile_name)
+        params['name'] = shared_group_name(profile_name, params)
+        return (tsmid, params['name']), params
+
+    def cached_group_id(self, key):
+        with self._lock:
+            return self._group_ids.get(key)
+
+    def remember_group_id(self, key, group_id):
+        with self._lock:
+            self._group_ids[key] = group_id
+
+    def group_id(self, tsmid, profile_name):
+        """Id of the shared group for profile_name, created if needed."""
+
+        key, params = self.shared_group(tsmid, profile_name)
+
+        with self._key_lock(key):
+            group_id = self.cached_group_id(key)
+            if group_id is not None:
+                return group_id
+
+            group_id = find_group_id(self._list_groups(tsmid), params['name'])
+            if group_id is None:
+                data = self._driver._api_request_for_cloudbyte(
+                    'addQosGroup', params)
+                group_id = data['addqosgroupresponse']['qosgroup']['id']
+
+            self.remember_group_id(key, group_id)
+            return group_id
+
+    def profile_of(self, tsmid, group_id):
+        """Profile of the volumes in QoS group group_id, None if unknown."""
+
+        if group_id is None:
+            return None
+        with self._lock:
+            if group_id in self._profiles:
+                return self._profiles[group_id]
+
+        driver = self._driver
+        profile_iops = dict((profile_name, driver._get_profile_iops(profile_name))
+                            for profile_name in driver.profiles)
+        profile_name = None
+        for group in self._list_groups(tsmid):
+            if group.get('id') == group_id:
+                profile_name = profile_from_group(group, profile_iops)
+                break
+
+        with self._lock:
+            self._profiles[group_id] = profile_name
+        return profile_name
+
+    def own(self, tsmid, name):
+        """Record a per-volume group added here, so it can be collected."""
+
+        with self._lock:
+            self._owned.add((tsmid, name))
+        self._driver._state.add_qos_group(tsmid, name)
+
+    def _disown(self, tsmid, name):
+        with self._lock:
+            self._owned.discard((tsmid, name))
+        self._driver._state.delete_qos_group(tsmid, name)
+
+    def _collectable(self, tsmid, name):
+        if name.startswith(SHARED_QOS_GROUP_PREFIX):
+            return True
+        with self._lock:
+            return (tsmid, name) in self._owned
+
+    def clear(self):
+        """Forget the cached group ids, e.g. after a failed create."""
+
+        with self._lock:
+            self._group_ids.clear()
+
+    def _list_groups(self, tsmid):
+        data = self._driver._api_request_for_cloudbyte(
+            'listQosGroup', {"tsmid": tsmid})
+        return groups_from_response(data)
+
+    def maybe_collect_garbage(self):
+        """Start a background cleanup if one is due."""
+
+        if not self.gc_interval:
+            return
+
+        now = time.time()
+        with self._lock:
+            if self._gc_thread is not None and self._gc_thread.is_alive():
+                return
+            if self._last_gc is not None and now - self._last_gc < self.gc_interval:
+                return
+            self._last_gc = now
+            self._gc_thread = threading.Thread(target=self._collect_garbage)
+            self._gc_thread.daemon = True
+        self._gc_thread.start()
+
+    def _collect_garbage(self):
+        try:
+            driver = self._driver
+            cb_volumes = driver._list_filesystems(fresh=True)
+            for _, tsm_details in driver._get_vsm_details():
+                self.collect_garbage(tsm_details.get('tsmid'), cb_volumes)
+        except Exception:
+            # Cleanup is best effort, the next round tries again
+            pass
+
+    def collect_garbage(self, tsmid, cb_volumes):
+        """Delete our QoS groups of the TSM that no volume refers to anymore.
+
+        Returns the ids of the deleted groups.
+        """
+
+        referenced = set(vol.get('groupid') for vol in cb_volumes.volumes)
+        if cb_volumes.volumes and referenced == set([None]):
+            # This ElastiCenter does not report group ids; nothing is safe
+            return []
+
+        with self._lock:
+            in_use = set(self._group_ids.values())
+
+        now = time.time()
+        previous = self._suspects.get(tsmid, {})
+        suspects = {}
+        deleted = []
+        for group in self._list_groups(tsmid):
+            group_id = group.get('id')
+            name = str(group.get('name', ''))
+            if (not self._collectable(tsmid, name) or
+                    group_id in referenced or group_id in in_use):
+                continue
+
+            first_seen = previous.get(group_id, now)
+            if now - first_seen < self.gc_grace:
+                suspects[group_id] = first_seen
+                continue
+
+            try:
+                self._driver._api_request_for_cloudbyte(
+                    'deleteQosGroup', {"id": group_id})
+                deleted.append(group_id)
+                self._disown(tsmid, name)
+            except Exception:
+                suspects[group_id] = first_seen
+
+        self._suspects[tsmid] = suspects
+        return deleted
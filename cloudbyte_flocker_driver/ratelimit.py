@@ -0,0 +1,146 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Client-side request budgets protecting ElastiCenter from overload.
+
+A budget combines a token bucket (sustained request rate) with an AIMD
+cap on concurrent requests: the cap grows by one for every cap's worth
+of healthy responses and is halved when a response fails or takes
+noticeably longer than usual for its command.
+"""
+
+import threading
+import time
+
+from cloudbyte_flocker_driver import metrics
+
+
+def is_overload(status):
+    """Whether an HTTP status (None for no response) signals overload."""
+
+    return status is None or status == 429 or status >= 500
+
+
+class TokenBucket(object):
+    """Allow ``rate`` acquisitions per second with bursts of ``burst``.
+
+    A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+
+    def acquire(self):
+        """Take a token, sleeping until it is available; return the wait."""
+
+        if self.rate <= 0:
+            return 0
+
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve the token now so waiters are served in order
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveConcurrency(object):
+    """Cap on concurrent requests, adjusted additively up and halved down."""
+
+    def __init__(self, initial=4, minimum=1, maximum=16, backoff=0.5,
+                 latency_tolerance=2.0, latency_floor=0.1, smoothing=0.1):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        # Answers faster than this are never treated as a slowdown
+        self.latency_floor = latency_floor
+        self.smoothing = smoothing
+        self.limit = float(min(max(initial, minimum), maximum))
+
+        self._changed = threading.Condition(threading.Lock())
+        self._in_flight = 0
+        # Smoothed latency of answered requests, per command
+        self._baselines = {}
+        self._last_decrease = 0
+
+    def acquire(self):
+        with self._changed:
+            while self._in_flight >= int(self.limit):
+                self._changed.wait()
+            self._in_flight += 1
+
+    def release(self, key, latency, overloaded):
+        """Return a slot and adjust the cap from the request's outcome."""
+
+        with self._changed:
+            self._in_flight -= 1
+
+            baseline = self._baselines.get(key)
+            if not overloaded:
+                # Slow answers still count, so the baseline follows lasting
+                # shifts in latency instead of throttling forever
+                self._baselines[key] = latency if baseline is None else (
+                    baseline + self.smoothing * (latency - baseline))
+                if (baseline is not None and latency > self.latency_floor and
+                        latency > baseline * self.latency_tolerance):
+                    overloaded = True
+
+            if overloaded:
+                now = time.time()
+                # Requests failing together are a single congestion signal
+                if now - self._last_decrease > latency:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+            self._changed.notify_all()
+
+
+class Budget(object):
+    """Rate limit plus adaptive concurrency for one class of requests."""
+
+    def __init__(self, name, rate=0, burst=None, max_concurrency=16,
+                 latency_tolerance=2.0, registry=None):
+        self.name = name
+        self._bucket = TokenBucket(rate, burst)
+        self._concurrency = AdaptiveConcurrency(
+            initial=min(4, max_concurrency), maximum=max_concurrency,
+            latency_tolerance=latency_tolerance)
+
+        if registry is None:
+            registry = metrics.Registry(enabled=False)
+        self._throttled = registry.histogram(
+            'cloudbyte_api_throttle_seconds',
+            'Time ElastiCenter requests waited for the client-side limiter.',
+            ['budget']).labels(name)
+        self._limit = registry.gauge(
+            'cloudbyte_api_concurrency_limit',
+            'Current adaptive cap on concurrent ElastiCenter requests.',
+            ['budget']).labels(name)
+        self._limit.set(int(self._concurrency.limit))
+
+    def acquire(self):
+        """Block until the request may be sent."""
+
+        start = time.time()
+        self._bucket.acquire()
+        self._concurrency.acquire()
+        self._throttled.observe(time.time() - start)
+
+    def release(self, command, latency, status):
+        """Report a finished request; status is None if none was received."""
+
+        self._concurrency.release(command, latency, is_overload(status))
+        self._limit.set(int(self._concurrency.limit))
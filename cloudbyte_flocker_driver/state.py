@@ -0,0 +1,266 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Local SQLite copy of the driver's view of ElastiCenter.
+
+The store survives agent restarts. It keeps the last volume listing of
+our VSMs, the account, VSM and initiator group ids and the per-volume QoS
+groups the driver added. After a restart the driver lists from it instead
+of fetching everything again, and every listing it fetches is written
+back. Single volume records are only used while ElastiCenter cannot be
+reached.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import six
+
+from cloudbyte_flocker_driver import volumes as cb_volume_index
+
+DEFAULT_STATE_PATH = '/var/lib/flocker/cloudbyte-state.db'
+
+_log = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS volumes (
+    blockdevice_id TEXT PRIMARY KEY,
+    dataset_id TEXT,
+    tsm_id TEXT,
+    portal TEXT,
+    iqn TEXT,
+    size_mib TEXT,
+    group_id TEXT,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS qos_groups (
+    tsm_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (tsm_id, name)
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+'''
+
+# listFileSystem field -> column
+_COLUMNS = (
+    ('id', 'blockdevice_id'),
+    ('name', 'dataset_id'),
+    ('Tsmid', 'tsm_id'),
+    ('ipaddress', 'portal'),
+    ('iqnname', 'iqn'),
+    ('currentTotalSpace', 'size_mib'),
+    ('groupid', 'group_id'),
+)
+
+# Metadata key of the time the stored listing was fetched
+_LISTED_AT = json.dumps('listed_at')
+
+
+def _row_to_record(row):
+    return cb_volume_index.FileSystemRecord(dict(
+        (field, row[i]) for i, (field, _) in enumerate(_COLUMNS)))
+
+
+class StateStore(object):
+    """Thread-safe store of volume records and metadata."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _select_columns(self):
+        return ', '.join(column for _, column in _COLUMNS)
+
+    def _values(self, vol, now):
+        return [vol.get(field) for field, _ in _COLUMNS] + [now]
+
+    def _stored_values(self, vol):
+        # As SQLite hands them back from the TEXT columns
+        return tuple(None if vol.get(field) is None
+                     else six.text_type(vol.get(field))
+                     for field, _ in _COLUMNS)
+
+    def get_volume(self, blockdevice_id):
+        """Return the FileSystemRecord of a volume, or None."""
+
+        with self._lock:
+            row = self._db.execute(
+                'SELECT ' + self._select_columns() + ' FROM volumes '
+                'WHERE blockdevice_id = ?', (blockdevice_id,)).fetchone()
+        return _row_to_record(row) if row else None
+
+    def listing(self):
+        """Return (VolumeIndex, listed_at) of the last stored listing.
+
+        listed_at is None when no listing was ever stored.
+        """
+
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT ' + self._select_columns() + ' FROM volumes').fetchall()
+            listed_at = self._db.execute(
+                'SELECT value FROM metadata WHERE key = ?',
+                (_LISTED_AT,)).fetchone()
+
+        if listed_at is None:
+            return None, None
+        return (cb_volume_index.VolumeIndex([_row_to_record(r) for r in rows]),
+                float(json.loads(listed_at[0])))
+
+    def replace_listing(self, volumes):
+        """Store a full listing, writing only the volumes that changed."""
+
+        now = time.time()
+        listed = dict((six.text_type(vol.get('id')), vol) for vol in volumes)
+        with self._lock, self._db:
+            stored = dict((row[0], tuple(row)) for row in self._db.execute(
+                'SELECT ' + self._select_columns() + ' FROM volumes'))
+            self._db.executemany(
+                'DELETE FROM volumes WHERE blockdevice_id = ?',
+                [(i,) for i in stored if i not in listed])
+            self._upsert([vol for i, vol in listed.items()
+                          if stored.get(i) != self._stored_values(vol)], now)
+            self._set_metadata(_LISTED_AT, now, now)
+
+    def put_volume(self, vol):
+        """Add or update the record of a single volume."""
+
+        with self._lock, self._db:
+            self._upsert([vol], time.time())
+
+    def _upsert(self, volumes, now):
+        # Plain REPLACE keeps this working on old SQLite releases
+        self._db.executemany(
+            'INSERT OR REPLACE INTO volumes (' + self._select_columns() +
+            ', updated) VALUES (' + ', '.join('?' * (len(_COLUMNS) + 1)) + ')',
+            [self._values(vol, now) for vol in volumes])
+
+    def set_dataset(self, blockdevice_id, dataset_id):
+        with self._lock, self._db:
+            self._db.execute(
+                'UPDATE volumes SET dataset_id = ?, updated = ? '
+                'WHERE blockdevice_id = ?',
+                (str(dataset_id), time.time(), blockdevice_id))
+
+    def delete_volume(self, blockdevice_id):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM volumes WHERE blockdevice_id = ?',
+                             (blockdevice_id,))
+
+    def qos_groups(self):
+        """Return [(tsm id, name)] of the QoS groups the driver added."""
+
+        with self._lock:
+            return [tuple(row) for row in self._db.execute(
+                'SELECT tsm_id, name FROM qos_groups').fetchall()]
+
+    def add_qos_group(self, tsm_id, name):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO qos_groups (tsm_id, name) '
+                             'VALUES (?, ?)', (tsm_id, name))
+
+    def delete_qos_group(self, tsm_id, name):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM qos_groups WHERE tsm_id = ? AND '
+                             'name = ?', (tsm_id, name))
+
+    def metadata(self):
+        """Return [(key, value, updated)] of every stored metadata entry."""
+
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT key, value, updated FROM metadata '
+                'WHERE key != ?', (_LISTED_AT,)).fetchall()
+        return [(tuple(json.loads(key)), json.loads(value), updated)
+                for key, value, updated in rows]
+
+    def set_metadata(self, key, value):
+        with self._lock, self._db:
+            self._set_metadata(json.dumps(list(key)), value, time.time())
+
+    def _set_metadata(self, key, value, now):
+        self._db.execute(
+            'INSERT OR REPLACE INTO metadata (key, value, updated) '
+            'VALUES (?, ?, ?)', (key, json.dumps(value), now))
+
+    def clear_metadata(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM metadata WHERE key != ?',
+                             (_LISTED_AT,))
+
+
+class _NoopStore(object):
+    """Store used when persistence is disabled; remembers nothing."""
+
+    path = None
+
+    def close(self):
+        pass
+
+    def get_volume(self, blockdevice_id):
+        return None
+
+    def listing(self):
+        return None, None
+
+    def replace_listing(self, volumes):
+        pass
+
+    def put_volume(self, vol):
+        pass
+
+    def set_dataset(self, blockdevice_id, dataset_id):
+        pass
+
+    def delete_volume(self, blockdevice_id):
+        pass
+
+    def qos_groups(self):
+        return []
+
+    def add_qos_group(self, tsm_id, name):
+        pass
+
+    def delete_qos_group(self, tsm_id, name):
+        pass
+
+    def metadata(self):
+        return []
+
+    def set_metadata(self, key, value):
+        pass
+
+    def clear_metadata(self):
+        pass
+
+
+NOOP_STORE = _NoopStore()
+
+
+def open_store(path):
+    """Open the store at path; a no-op store if path or its directory is missing."""
+
+    if not path:
+        return NOOP_STORE
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        _log.warning("State store directory [%s] does not exist, local "
+                     "state is not kept across restarts.", directory)
+        return NOOP_STORE
+    return StateStore(path)
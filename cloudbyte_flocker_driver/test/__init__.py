@@ -0,0 +1,4 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Tests for the CloudByte Flocker driver."""
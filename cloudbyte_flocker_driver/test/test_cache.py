@@ -0,0 +1,100 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Metadata caches and the shared listing snapshot."""
+
+import itertools
+import time
+
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import cache
+
+
+class TTLCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.patch(cache.time, 'time', lambda: self.now)
+        self.cache = cache.TTLCache(default_ttl=10)
+
+    def test_entry_expires(self):
+        self.cache.set('tsm', 'id')
+        self.now += 9.9
+        self.assertEqual(self.cache.get('tsm'), 'id')
+        self.now += 0.1
+        self.assertIs(self.cache.get('tsm'), None)
+        # Expired entries are dropped
+        self.assertEqual(self.cache._entries, {})
+
+    def test_entries_expire_on_their_own(self):
+        self.cache.set('short', 1, ttl=1)
+        self.cache.set('long', 2)
+        self.now += 5
+        self.assertIs(self.cache.get('short'), None)
+        self.assertEqual(self.cache.get('long'), 2)
+
+    def test_non_positive_ttl_disables_caching(self):
+        self.cache.set('zero', 1, ttl=0)
+        self.cache.set('negative', 1, ttl=-1)
+        self.assertEqual(self.cache._entries, {})
+        disabled = cache.TTLCache(default_ttl=0)
+        disabled.set('default', 1)
+        self.assertIs(disabled.get('default'), None)
+
+    def test_invalidate(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.invalidate('a')
+        self.cache.invalidate('missing')
+        self.assertIs(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 2)
+
+    def test_clear(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.clear()
+        self.assertEqual([self.cache.get('a'), self.cache.get('b')],
+                         [None, None])
+
+
+class RefreshingSnapshotTests(unittest.TestCase):
+    def make_snapshot(self, **kwargs):
+        self.fetches = itertools.count(1)
+        snapshot = cache.RefreshingSnapshot(
+            lambda: next(self.fetches), **kwargs)
+        self.addCleanup(snapshot.stop)
+        return snapshot
+
+    def test_serves_snapshot_until_too_stale(self):
+        snapshot = self.make_snapshot(interval=60, max_stale=0.2)
+        self.assertEqual(snapshot.get(), 1)
+        self.assertEqual(snapshot.get(), 1)
+        time.sleep(0.3)
+        self.assertEqual(snapshot.get(), 2)
+
+    def test_invalidate_and_fresh_fetch_again(self):
+        snapshot = self.make_snapshot(interval=60)
+        self.assertEqual(snapshot.get(), 1)
+        snapshot.invalidate()
+        self.assertEqual(snapshot.get(), 2)
+        self.assertEqual(snapshot.get(fresh=True), 3)
+
+    def test_background_refresh(self):
+        snapshot = self.make_snapshot(interval=0.05)
+        snapshot.get()
+        deadline = time.time() + 5
+        while snapshot.get() < 3 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(snapshot.get() >= 3)
+
+    def test_stop_ends_refresh_thread(self):
+        snapshot = self.make_snapshot(interval=0.05)
+        snapshot.get()
+        thread = snapshot._thread
+
+        snapshot.stop(timeout=5)
+        self.assertFalse(thread.is_alive())
+        # Readers still get a value, fetched inline
+        snapshot.invalidate()
+        self.assertIsNotNone(snapshot.get())
+        self.assertIs(snapshot._thread, thread)
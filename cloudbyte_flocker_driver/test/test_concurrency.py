@@ -0,0 +1,147 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Tests for the threading helpers."""
+
+import threading
+import time
+
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import concurrency
+
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        self.flight = concurrency.SingleFlight()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.calls = []
+
+    def blocked(self, outcome):
+        """Function returning (or raising) outcome once released."""
+
+        def fn(*args):
+            self.calls.append(args)
+            self.release.wait(10)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        return fn
+
+    def run_followers(self, key, fn, count):
+        """Call key from count threads; returns their outcomes."""
+
+        outcomes = []
+
+        def follow():
+            try:
+                outcomes.append(self.flight.do(key, fn, 'follower'))
+            except Exception as e:
+                outcomes.append(e)
+
+        threads = [threading.Thread(target=follow) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        # Let them find the call in flight
+        time.sleep(0.1)
+        return threads, outcomes
+
+    def lead(self, key, fn):
+        outcomes = []
+
+        def run():
+            try:
+                outcomes.append(self.flight.do(key, fn, 'leader'))
+            except Exception as e:
+                outcomes.append(e)
+
+        leader = threading.Thread(target=run)
+        leader.start()
+        while not self.calls:
+            time.sleep(0.01)
+        return leader, outcomes
+
+    def test_followers_share_the_result(self):
+        fn = self.blocked('listTsm')
+        leader, led = self.lead('key', fn)
+        followers, followed = self.run_followers('key', fn, 3)
+
+        self.release.set()
+        for thread in [leader] + followers:
+            thread.join(10)
+        self.assertEqual(led + followed, ['listTsm'] * 4)
+        self.assertEqual(self.calls, [('leader',)])
+
+    def test_error_fans_out_to_followers(self):
+        error = ValueError('431')
+        fn = self.blocked(error)
+        leader, led = self.lead('key', fn)
+        followers, followed = self.run_followers('key', fn, 3)
+
+        self.release.set()
+        for thread in [leader] + followers:
+            thread.join(10)
+        self.assertEqual(led + followed, [error] * 4)
+        self.assertEqual(self.calls, [('leader',)])
+
+    def test_finished_call_runs_again(self):
+        self.release.set()
+        fn = self.blocked('listTsm')
+        self.flight.do('key', fn, 'first')
+        self.flight.do('key', fn, 'second')
+        self.assertEqual(self.calls, [('first',), ('second',)])
+        self.assertEqual(self.flight._calls, {})
+
+    def test_failed_call_runs_again(self):
+        self.release.set()
+        fn = self.blocked(ValueError('431'))
+        self.assertRaises(ValueError, self.flight.do, 'key', fn, 'first')
+        self.assertRaises(ValueError, self.flight.do, 'key', fn, 'second')
+        self.assertEqual(self.calls, [('first',), ('second',)])
+
+    def test_other_keys_are_not_coalesced(self):
+        fn = self.blocked('listTsm')
+        leader, led = self.lead('key', fn)
+        others, _ = self.run_followers('other', fn, 1)
+
+        self.release.set()
+        for thread in [leader] + others:
+            thread.join(10)
+        self.assertEqual(sorted(self.calls), [('follower',), ('leader',)])
+
+
+class RunConcurrentlyTests(unittest.TestCase):
+    def test_outcomes_in_order(self):
+        def fn(item):
+            # Finish in reverse order
+            time.sleep(0.01 * (5 - item))
+            if item == 2:
+                raise ValueError(item)
+            return item * 10
+
+        outcomes = concurrency.run_concurrently(fn, range(5), 5)
+        self.assertEqual([result for result, _ in outcomes],
+                         [0, 10, None, 30, 40])
+        errors = [exc for _, exc in outcomes]
+        self.assertIsInstance(errors[2], ValueError)
+        self.assertEqual(errors[:2] + errors[3:], [None] * 4)
+
+    def test_at_most_workers_threads(self):
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def fn(item):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        concurrency.run_concurrently(fn, range(12), 3)
+        self.assertEqual(peak[0], 3)
+
+    def test_no_items(self):
+        self.assertEqual(concurrency.run_concurrently(None, [], 4), [])
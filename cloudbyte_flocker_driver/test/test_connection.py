@@ -0,0 +1,133 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Tests for the ElastiCenter connection pool."""
+
+import socket
+
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import connection
+
+
+class FakeResponse(object):
+    status = 200
+    will_close = False
+
+    def read(self):
+        return b'{}'
+
+
+class FakeConnection(object):
+    """Connection failing its first send or receive as configured."""
+
+    def __init__(self, fail_send=False, fail_receive=False):
+        self.fail_send = fail_send
+        self.fail_receive = fail_receive
+        self.requests = []
+        self.closed = False
+
+    def request(self, method, url):
+        if self.fail_send:
+            raise socket.error('broken pipe')
+        self.requests.append(url)
+
+    def getresponse(self):
+        if self.fail_receive:
+            raise socket.error('connection reset')
+        return FakeResponse()
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolRetryTests(unittest.TestCase):
+    def make_pool(self, stale):
+        """Pool whose one idle connection is stale; returns (pool, new)."""
+
+        created = []
+
+        def factory(host):
+            created.append(FakeConnection())
+            return created[-1]
+
+        pool = connection.ConnectionPool('elasticenter', connection_factory=factory)
+        pool._release(stale)
+        return pool, created
+
+    def test_send_failure_is_retried(self):
+        pool, created = self.make_pool(FakeConnection(fail_send=True))
+        self.assertEqual(pool.request('GET', '/createVolume'), (200, b'{}'))
+        self.assertEqual(created[0].requests, ['/createVolume'])
+
+    def test_receive_failure_is_not_retried(self):
+        stale = FakeConnection(fail_receive=True)
+        pool, created = self.make_pool(stale)
+        self.assertRaises(socket.error, pool.request, 'GET', '/createVolume')
+        self.assertEqual(stale.requests, ['/createVolume'])
+        self.assertEqual(created, [])
+
+    def test_idempotent_receive_failure_is_retried(self):
+        pool, created = self.make_pool(FakeConnection(fail_receive=True))
+        self.assertEqual(
+            pool.request('GET', '/listTsm', idempotent=True), (200, b'{}'))
+        self.assertEqual(created[0].requests, ['/listTsm'])
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def make_pool(self, **kwargs):
+        created = []
+
+        def factory(host):
+            created.append(FakeConnection())
+            return created[-1]
+
+        pool = connection.ConnectionPool('elasticenter',
+                                         connection_factory=factory, **kwargs)
+        return pool, created
+
+    def test_connection_reused(self):
+        pool, created = self.make_pool()
+        pool.request('GET', '/listTsm')
+        pool.request('GET', '/listFileSystem')
+        self.assertEqual(len(created), 1)
+        self.assertEqual(created[0].requests, ['/listTsm', '/listFileSystem'])
+
+    def test_idle_connections_limited_to_size(self):
+        pool, created = self.make_pool(size=1)
+        first, second = FakeConnection(), FakeConnection()
+        pool._release(first)
+        pool._release(second)
+        self.assertEqual([c for c, _ in pool._idle], [first])
+        self.assertTrue(second.closed)
+
+    def test_expired_connection_evicted(self):
+        pool, created = self.make_pool(idle_timeout=60)
+        expired = FakeConnection()
+        pool._idle.append((expired, 0))
+
+        pool.request('GET', '/listTsm')
+        self.assertTrue(expired.closed)
+        self.assertEqual(expired.requests, [])
+        self.assertEqual(len(created), 1)
+
+    def test_closing_response_not_pooled(self):
+        pool, created = self.make_pool()
+        self.patch(FakeResponse, 'will_close', True)
+        pool.request('GET', '/listTsm')
+        self.assertTrue(created[0].closed)
+        self.assertEqual(pool._idle, [])
+
+    def test_close(self):
+        pool, created = self.make_pool()
+        pool.request('GET', '/listTsm')
+        pool.close()
+        self.assertTrue(created[0].closed)
+        self.assertEqual(pool._idle, [])
+
+    def test_shared_pool_per_host(self):
+        pool = connection.get_pool('shared-host', protocol='http')
+        self.addCleanup(connection._pools.pop, ('http', 'shared-host'))
+        self.assertIs(connection.get_pool('shared-host', protocol='http'), pool)
+        self.assertRaises(ValueError, connection.get_pool, 'shared-host',
+                          protocol='ftp')
@@ -0,0 +1,153 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Tests for the local block device helpers."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import devices
+from cloudbyte_flocker_driver import metrics
+from cloudbyte_flocker_driver.testtools import fake_iscsiadm
+
+
+class DeviceWaiterTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='cloudbyte-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'by-path', 'lun-0')
+        os.mkdir(os.path.dirname(self.path))
+        self.waiter = devices.DeviceWaiter(poll_interval=0.05)
+
+    def later(self, fn, delay=0.2):
+        timer = threading.Timer(delay, fn)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def create(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.mkdir(os.path.dirname(self.path))
+        open(self.path, 'w').close()
+
+    def assertWaits(self, present, timeout=5):
+        start = time.time()
+        self.assertTrue(self.waiter.wait(self.path, present, timeout))
+        self.assertTrue(time.time() - start < timeout)
+
+    def test_already_there(self):
+        self.create()
+        self.assertTrue(self.waiter.wait(self.path, True, 0))
+
+    def test_appears(self):
+        self.later(self.create)
+        self.assertWaits(True)
+
+    def test_disappears(self):
+        self.create()
+        self.later(lambda: os.unlink(self.path))
+        self.assertWaits(False)
+
+    def test_timeout(self):
+        self.assertFalse(self.waiter.wait(self.path, True, 0.2))
+        self.create()
+        self.assertFalse(self.waiter.wait(self.path, False, 0.2))
+
+    def count_polls(self):
+        polls = []
+        poll = self.waiter._poll
+
+        def counted(*args):
+            polls.append(args[0])
+            return poll(*args)
+        self.patch(self.waiter, '_poll', counted)
+        return polls
+
+    def test_polls_without_inotify(self):
+        self.patch(self.waiter, '_libc', None)
+        polls = self.count_polls()
+
+        self.later(self.create)
+        self.assertWaits(True)
+        self.assertFalse(self.waiter.wait(self.path, False, 0.2))
+        self.assertEqual(polls, [self.path, self.path])
+
+    def test_polls_until_directory_exists(self):
+        # udev creates by-path on the first iSCSI login
+        os.rmdir(os.path.dirname(self.path))
+        polls = self.count_polls()
+
+        self.later(self.create)
+        self.assertWaits(True)
+        self.assertEqual(polls, [self.path])
+
+
+class QueueTunerTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='cloudbyte-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        self.registry = metrics.Registry()
+        self.tuner = devices.QueueTuner(fake_iscsiadm.sysfs_root(self.root),
+                                        registry=self.registry)
+
+    def read(self, device, key):
+        path = os.path.join(fake_iscsiadm.sysfs_root(self.root), 'block',
+                            device, 'queue', key)
+        with open(path) as f:
+            return devices.parse_queue_value(f.read())
+
+    def test_apply(self):
+        fake_iscsiadm.add_block_device(self.root, 'sdb')
+        settings = devices.normalize_queue_settings(
+            {'scheduler': 'none', 'read_ahead_kb': 4096})
+
+        self.assertEqual(self.tuner.apply('/dev/sdb', settings), {})
+        self.assertEqual([self.read('sdb', 'scheduler'),
+                          self.read('sdb', 'read_ahead_kb')],
+                         ['none', '4096'])
+        self.assertEqual(self.tuner.applied['sdb'], (settings, {}))
+
+    def test_multipath_paths_tuned_too(self):
+        for disk in ('sdb', 'sdc'):
+            fake_iscsiadm.add_block_device(self.root, disk)
+        fake_iscsiadm.add_block_device(self.root, 'dm-0', ['sdb', 'sdc'])
+
+        self.tuner.apply('/dev/dm-0', [('nr_requests', '256')])
+        self.assertEqual(
+            [self.read(device, 'nr_requests')
+             for device in ('dm-0', 'sdb', 'sdc')], ['256'] * 3)
+
+    def test_missing_queue_file_is_a_mismatch(self):
+        fake_iscsiadm.add_block_device(self.root, 'sdb')
+        os.unlink(os.path.join(fake_iscsiadm.sysfs_root(self.root), 'block',
+                               'sdb', 'queue', 'rotational'))
+
+        mismatches = self.tuner.apply(
+            '/dev/sdb', [('nomerges', '2'), ('rotational', '0')])
+        self.assertEqual(mismatches, {'sdb/rotational': ('0', None)})
+        self.assertIn(
+            'cloudbyte_queue_tuning_mismatches_total{setting="rotational"} 1.0',
+            self.registry.render())
+
+    def test_unknown_device(self):
+        self.assertEqual(self.tuner.apply('/dev/sdz', [('nomerges', '2')]),
+                         {'sdz/nomerges': ('2', None)})
+
+    def test_parse_queue_value(self):
+        self.assertEqual(
+            devices.parse_queue_value(fake_iscsiadm.QUEUE_DEFAULTS['scheduler']),
+            'mq-deadline')
+        self.assertEqual(devices.parse_queue_value('128\n'), '128')
+
+    def test_normalize_queue_settings(self):
+        self.assertEqual(
+            devices.normalize_queue_settings({'rq_affinity': 2,
+                                              'scheduler': 'kyber'}),
+            [('rq_affinity', '2'), ('scheduler', 'kyber')])
+        self.assertEqual(devices.normalize_queue_settings(None), [])
+        self.assertRaises(ValueError, devices.normalize_queue_settings,
+                          {'queue_depth': 64})
@@ -0,0 +1,153 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""iSCSI session bookkeeping and per-profile session tuning."""
+
+import os
+import uuid
+
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import iscsi
+from cloudbyte_flocker_driver.test.test_lifecycle import DriverTestCase, GiB
+from cloudbyte_flocker_driver.testtools import fake_iscsiadm
+
+
+class ISCSISessionManagerTests(DriverTestCase):
+    def setUp(self):
+        DriverTestCase.setUp(self)
+        api = self.make_api()
+        volume = api.create_volume(uuid.uuid4(), GiB)
+        vol = self.elasticenter.filesystems[volume.blockdevice_id]
+        self.target = (vol['ipaddress'], vol['iqnname'])
+
+    def calls(self):
+        path = os.path.join(self.root, 'calls.log')
+        if not os.path.exists(path):
+            return []
+        with open(path) as log:
+            return log.read().splitlines()
+
+    def make_manager(self, **kwargs):
+        return iscsi.ISCSISessionManager(
+            fake_iscsiadm.command_line(self.root), **kwargs)
+
+    def test_recent_session_is_trusted(self):
+        manager = self.make_manager(session_ttl=60)
+        manager.login(*self.target)
+        calls = len(self.calls())
+
+        manager.login(*self.target)
+        self.assertEqual(self.calls()[calls:], [])
+
+    def test_old_session_is_rechecked(self):
+        manager = self.make_manager(session_ttl=0)
+        manager.login(*self.target)
+        calls = len(self.calls())
+
+        manager.login(*self.target)
+        self.assertEqual(self.calls()[calls:], ['-m session', '-m node'])
+
+    def test_logout_forgets_discovery(self):
+        manager = self.make_manager()
+        manager.login(*self.target)
+        manager.logout(*self.target)
+        self.assertFalse(manager.has_node(*self.target))
+
+        manager.login(*self.target)
+        self.assertTrue(manager.has_session(*self.target))
+        self.assertEqual(
+            len([c for c in self.calls() if c.startswith('-m discovery')]), 2)
+
+
+SESSION_DETAILS = '''\
+iSCSI Transport Class version 2.0-870
+version 2.0-874
+Target: iqn.2016-01.com.cloudbyte:vol1 (non-flash)
+	Current Portal: 20.10.1.1:3260,1
+	Persistent Portal: 20.10.1.1:3260,1
+		**********
+		Interface:
+		**********
+		Iface Name: default
+		Iface Transport: tcp
+		iSCSI Connection State: LOGGED IN
+		iSCSI Session State: LOGGED_IN
+		Internal iscsid Session State: NO CHANGE
+		************************
+		Negotiated iSCSI params:
+		************************
+		HeaderDigest: None
+		MaxRecvDataSegmentLength: 262144
+		FirstBurstLength: 65536
+		MaxBurstLength: 262144
+		ImmediateData: Yes
+		InitialR2T: No
+	Current Portal: 20.10.1.2:3260,1
+	Persistent Portal: 20.10.1.2:3260,1
+		Negotiated iSCSI params:
+		MaxBurstLength: 1048576
+Target: iqn.2016-01.com.cloudbyte:vol2 (non-flash)
+	Current Portal: 20.10.1.1:3260,1
+		Negotiated iSCSI params:
+		ImmediateData: No
+'''
+
+
+class SessionTuningTests(unittest.TestCase):
+    def test_parse_session_params(self):
+        sessions = iscsi.parse_session_params(SESSION_DETAILS)
+        self.assertEqual(
+            [(ip, iqn) for ip, iqn, _ in sessions],
+            [('20.10.1.1', 'iqn.2016-01.com.cloudbyte:vol1'),
+             ('20.10.1.2', 'iqn.2016-01.com.cloudbyte:vol1'),
+             ('20.10.1.1', 'iqn.2016-01.com.cloudbyte:vol2')])
+
+        params = sessions[0][2]
+        self.assertEqual(params['MaxBurstLength'], '262144')
+        self.assertEqual(params['InitialR2T'], 'No')
+        # Lines with spaces in their key are not parameters
+        self.assertNotIn('Iface Name', params)
+        self.assertEqual(sessions[1][2], {'MaxBurstLength': '1048576'})
+        self.assertEqual(sessions[2][2], {'ImmediateData': 'No'})
+
+    def test_parse_no_sessions(self):
+        self.assertEqual(iscsi.parse_session_params(''), [])
+        self.assertEqual(iscsi.parse_session_params(
+            'iscsiadm: No active sessions.\n'), [])
+
+    def test_normalize_settings(self):
+        self.assertEqual(
+            iscsi.normalize_settings({
+                'queue_depth': 64, 'ImmediateData': True,
+                'node.session.timeo.replacement_timeout': 15}),
+            [('node.session.iscsi.ImmediateData', 'Yes'),
+             ('node.session.queue_depth', '64'),
+             ('node.session.timeo.replacement_timeout', '15')])
+        self.assertEqual(iscsi.normalize_settings(None), [])
+        self.assertRaises(ValueError, iscsi.normalize_settings,
+                          {'discovery.sendtargets.auth': 'None'})
+
+    def test_find_mismatches(self):
+        settings = iscsi.normalize_settings({
+            'queue_depth': 64, 'nr_sessions': 2, 'MaxBurstLength': 1048576,
+            'ImmediateData': 'yes', 'InitialR2T': False, 'cmds_max': 256})
+        record = {'node.session.queue_depth': '64',
+                  'node.session.cmds_max': '128'}
+        negotiated = iscsi.parse_session_params(SESSION_DETAILS)[0][2]
+
+        self.assertEqual(
+            iscsi.find_mismatches(settings, record, negotiated, 1), {
+                # The target lowered it
+                'node.session.iscsi.MaxBurstLength': ('1048576', '262144'),
+                'node.session.nr_sessions': ('2', '1'),
+                'node.session.cmds_max': ('256', '128'),
+            })
+
+    def test_unknown_values_mismatch(self):
+        settings = iscsi.normalize_settings({'queue_depth': 64,
+                                             'FirstBurstLength': 65536})
+        self.assertEqual(iscsi.find_mismatches(settings, {}, {}, 1), {
+            'node.session.queue_depth': ('64', None),
+            'node.session.iscsi.FirstBurstLength': ('65536', None),
+        })
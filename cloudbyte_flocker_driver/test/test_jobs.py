@@ -0,0 +1,108 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Tests for the async job tracker."""
+
+import threading
+import time
+
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import jobs
+
+
+def pending(jobid):
+    return {'jobstatus': 0}
+
+
+def succeeded(jobid):
+    return {'jobstatus': jobs.JOB_SUCCEEDED, 'jobid': jobid}
+
+
+class AsyncJobTrackerTests(unittest.TestCase):
+    def make_tracker(self, **kwargs):
+        options = dict(initial_interval=0.01, max_interval=0.05)
+        options.update(kwargs)
+        tracker = jobs.AsyncJobTracker(**options)
+        self.addCleanup(tracker.stop, 5)
+        return tracker
+
+    def test_backoff_grows_to_max_interval(self):
+        tracker = self.make_tracker(initial_interval=1, max_interval=8,
+                                    jitter=0)
+        job = jobs._Job('job', pending, tracker.initial_interval)
+
+        intervals = []
+        for _ in range(5):
+            before = time.time()
+            tracker._check(job)
+            intervals.append(job.interval)
+            self.assertTrue(before + job.interval <= job.next_check <=
+                            time.time() + job.interval)
+        self.assertEqual(intervals, [2, 4, 8, 8, 8])
+
+    def test_jitter_bounds(self):
+        tracker = self.make_tracker(jitter=0.2)
+        samples = [tracker._jittered(10) for _ in range(1000)]
+        self.assertTrue(all(8 <= sample <= 12 for sample in samples))
+        # Not all in step
+        self.assertTrue(len(set(samples)) > 1)
+
+    def test_finished_job(self):
+        tracker = self.make_tracker()
+        calls = []
+
+        def query(jobid):
+            calls.append(jobid)
+            return succeeded(jobid) if len(calls) == 3 else pending(jobid)
+
+        self.assertEqual(tracker.wait('job', query, 10),
+                         succeeded('job'))
+        self.assertEqual(calls, ['job'] * 3)
+
+    def test_timeout(self):
+        tracker = self.make_tracker()
+        self.assertIs(tracker.wait('job', pending, 0.1), None)
+        # The abandoned job is not polled any more
+        self.assertEqual(tracker._jobs, [])
+
+    def test_query_exception_propagates(self):
+        tracker = self.make_tracker()
+
+        def query(jobid):
+            raise KeyError(jobid)
+
+        exc = self.assertRaises(KeyError, tracker.wait, 'job', query, 10)
+        self.assertEqual(exc.args, ('job',))
+
+    def test_slow_query_does_not_stall_other_jobs(self):
+        tracker = self.make_tracker(workers=2)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def hung(jobid):
+            release.wait(10)
+            return succeeded(jobid)
+
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(tracker.wait('hung', hung, 10)))
+        waiter.start()
+        self.addCleanup(waiter.join, 10)
+        time.sleep(0.05)
+
+        before = time.time()
+        self.assertEqual(tracker.wait('quick', succeeded, 5),
+                         succeeded('quick'))
+        self.assertTrue(time.time() - before < 1)
+        self.assertEqual(results, [])
+
+        release.set()
+        waiter.join(10)
+        self.assertEqual(results, [succeeded('hung')])
+
+    def test_stopped_tracker_polls_inline(self):
+        tracker = self.make_tracker()
+        tracker.stop(5)
+        self.assertEqual(tracker.wait('job', succeeded, 5), succeeded('job'))
+        self.assertIs(tracker._thread, None)
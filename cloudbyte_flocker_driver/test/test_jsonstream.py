@@ -0,0 +1,78 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Streaming decode of JSON arrays."""
+
+import io
+import json
+
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import jsonstream
+
+FILESYSTEMS = [
+    {'id': 'a1', 'name': u'vol\u00e9-1', 'tags': ['x', {'y': 'z]'}]},
+    {'id': 'a2', 'name': 'vol-2, "quoted"', 'currentTotalSpace': '1024'},
+    {'id': 'a3', 'name': u'\u2603', 'groupid': None},
+]
+
+DOCUMENT = json.dumps(
+    {'listFilesystemResponse': {'count': 3, 'filesystem': FILESYSTEMS}},
+    ensure_ascii=False, indent=1).encode('utf-8')
+
+
+def stream(data, key='filesystem', chunk_size=65536):
+    return jsonstream.JSONArrayStream(io.BytesIO(data), key, chunk_size)
+
+
+class JSONArrayStreamTests(unittest.TestCase):
+    def test_items(self):
+        items = stream(DOCUMENT)
+        self.assertEqual(list(items), FILESYSTEMS)
+        self.assertTrue(items.found)
+
+    def test_split_at_every_chunk_boundary(self):
+        # Splits keys, strings and multi-byte characters alike
+        for chunk_size in range(1, 40):
+            self.assertEqual(list(stream(DOCUMENT, chunk_size=chunk_size)),
+                             FILESYSTEMS)
+
+    def test_items_decoded_as_they_arrive(self):
+        readable = io.BytesIO(DOCUMENT)
+        items = iter(jsonstream.JSONArrayStream(readable, 'filesystem', 16))
+        self.assertEqual(next(items), FILESYSTEMS[0])
+        self.assertTrue(readable.tell() < len(DOCUMENT))
+
+    def test_empty_array(self):
+        items = stream(b'{"listFilesystemResponse": {"filesystem": []}}')
+        self.assertEqual(list(items), [])
+        self.assertTrue(items.found)
+
+    def test_missing_key_decodes_the_document(self):
+        data = b'{"errorresponse": {"errorcode": 431}}'
+        for chunk_size in (1, 65536):
+            items = stream(data, chunk_size=chunk_size)
+            self.assertEqual(list(items), [])
+            self.assertFalse(items.found)
+            self.assertEqual(items.document,
+                             {'errorresponse': {'errorcode': 431}})
+
+        items = stream(b'')
+        self.assertEqual(list(items), [])
+        self.assertEqual(items.document, {})
+
+    def test_truncated_inside_an_item(self):
+        end = DOCUMENT.index(b'"a2"')
+        for chunk_size in (1, 7, 65536):
+            items = stream(DOCUMENT[:end], chunk_size=chunk_size)
+            self.assertRaises(ValueError, list, items)
+
+    def test_truncated_between_items(self):
+        end = DOCUMENT.index(b'"a2"')
+        data = DOCUMENT[:DOCUMENT.rindex(b',', 0, end) + 1]
+        for chunk_size in (1, 7, 65536):
+            consumed = []
+            items = stream(data, chunk_size=chunk_size)
+            e = self.assertRaises(ValueError, consumed.extend, items)
+            self.assertEqual(str(e), "Truncated JSON array in response.")
+            self.assertEqual(consumed, FILESYSTEMS[:1])
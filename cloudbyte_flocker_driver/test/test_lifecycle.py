@@ -0,0 +1,252 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Volume lifecycles against the fake ElastiCenter and fake iscsiadm."""
+
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import cloudbyte
+from cloudbyte_flocker_driver.testtools import fake_elasticenter
+from cloudbyte_flocker_driver.testtools import fake_iscsiadm
+
+GiB = cloudbyte.ALLOCATION_UNIT
+
+
+class DriverTestCase(unittest.TestCase):
+    """Runs a fake ElastiCenter and iscsiadm root for each test."""
+
+    # Keyword arguments of the FakeElastiCenter
+    elasticenter_options = {}
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='cloudbyte-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        fake_iscsiadm.prepare_root(self.root)
+
+        self.elasticenter = fake_elasticenter.FakeElastiCenter(
+            iscsi_root=self.root, **self.elasticenter_options)
+        self.server = fake_elasticenter.serve(self.elasticenter)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def driver_config(self, **config):
+        options = dict(
+            elasticenter_ip='127.0.0.1:%d' % self.server.server_port,
+            elasticenter_protocol='http',
+            apikey='test',
+            vsm_name='VSM1',
+            account_name='Account1',
+            iscsiadm_command=fake_iscsiadm.command_line(self.root),
+            disk_by_path_dir=fake_iscsiadm.by_path_dir(self.root),
+            state_path=os.path.join(self.root, 'state.db'),
+            sysfs_root=fake_iscsiadm.sysfs_root(self.root),
+        )
+        options.update(config)
+        return options
+
+    def make_api(self, **config):
+        api = cloudbyte.cloudbyte_from_configuration(
+            uuid.uuid4(), **self.driver_config(**config))
+        self.addCleanup(api.close)
+        return api
+
+    def wait_for(self, predicate, timeout=10):
+        deadline = time.time() + timeout
+        while not predicate():
+            if time.time() > deadline:
+                self.fail("Timed out waiting for " + repr(predicate))
+            time.sleep(0.05)
+
+    def tsm_name_of(self, blockdevice_id):
+        tsm_id = self.elasticenter.filesystems[blockdevice_id]['Tsmid']
+        return [t['name'] for t in self.elasticenter.tsms
+                if t['id'] == tsm_id][0]
+
+
+class LifecycleTests(DriverTestCase):
+    def test_create_attach_detach_destroy(self):
+        api = self.make_api()
+        node = api.compute_instance_id()
+        dataset_id = uuid.uuid4()
+
+        volume = api.create_volume(dataset_id, GiB)
+        self.assertEqual(volume.dataset_id, dataset_id)
+        self.assertEqual([v.blockdevice_id for v in api.list_volumes()],
+                         [volume.blockdevice_id])
+
+        attached = api.attach_volume(volume.blockdevice_id, node)
+        self.assertEqual(attached.attached_to, node)
+        # The fake iscsiadm links LUNs to made-up /dev/sdfakeN devices
+        self.assertTrue(api.get_device_path(
+            volume.blockdevice_id).path.startswith('/dev/sdfake'))
+        self.assertEqual([v.attached_to for v in api.list_volumes()], [node])
+
+        api.detach_volume(volume.blockdevice_id)
+        self.assertEqual([v.attached_to for v in api.list_volumes()], [None])
+
+        api.destroy_volume(volume.blockdevice_id)
+        self.assertEqual(api.list_volumes(), [])
+        self.assertEqual(self.elasticenter.filesystems, {})
+
+    def test_destroy_volume_deleted_elsewhere(self):
+        api = self.make_api()
+        volume = api.create_volume(uuid.uuid4(), GiB)
+        # The shared snapshot still lists the volume afterwards
+        self.assertEqual(len(api.list_volumes()), 1)
+
+        del self.elasticenter.filesystems[volume.blockdevice_id]
+        api.destroy_volume(volume.blockdevice_id)
+
+    def test_close_stops_background_threads(self):
+        api = self.make_api()
+        volume = api.create_volume(uuid.uuid4(), GiB)
+        api.list_volumes()
+        threads = [api._filesystem_snapshot._thread, api._job_tracker._thread]
+
+        api.close()
+        self.assertEqual([t.is_alive() for t in threads], [False, False])
+        # A closed driver still works, polling and listing inline
+        api.destroy_volume(volume.blockdevice_id)
+        self.assertEqual(self.elasticenter.filesystems, {})
+
+    def test_create_volumes(self):
+        api = self.make_api()
+        lookups = []
+        get_initiator_group_id = api._get_initiator_group_id
+
+        def counted(account_id, ig_name):
+            lookups.append(ig_name)
+            return get_initiator_group_id(account_id, ig_name)
+        self.patch(api, '_get_initiator_group_id', counted)
+
+        requests = [(uuid.uuid4(), GiB) for _ in range(3)]
+        results = api.create_volumes(requests)
+
+        self.assertEqual([r.error for r in results], [None] * 3)
+        self.assertEqual([r.volume.dataset_id for r in results],
+                         [dataset_id for dataset_id, _ in requests])
+        # The 'ALL' group is looked up once, not for every volume
+        self.assertEqual(lookups, ['ALL'])
+        [(account_id, _)] = api._get_vsm_details()
+        all_ig = get_initiator_group_id(account_id, 'ALL')
+        self.assertEqual(
+            set(s['igid'] for s in self.elasticenter.iscsi_services.values()),
+            set([all_ig]))
+
+    def test_destroy_volumes(self):
+        api = self.make_api()
+        volumes = [api.create_volume(uuid.uuid4(), GiB) for _ in range(3)]
+        ids = [volume.blockdevice_id for volume in volumes]
+        elasticenter = self.elasticenter
+        delete = elasticenter.cmd_deleteFileSystem
+
+        def refuse_second(params):
+            if params['id'] == ids[1]:
+                raise ValueError('volume is busy')
+            return delete(params)
+        self.patch(elasticenter, 'cmd_deleteFileSystem', refuse_second)
+
+        # A volume that is already gone is not an error
+        results = api.destroy_volumes(ids + [u'missing'])
+        self.assertEqual([r.request for r in results], ids + [u'missing'])
+        self.assertEqual([r.error is None for r in results],
+                         [True, False, True, True])
+        self.assertEqual(list(elasticenter.filesystems), [ids[1]])
+
+    def test_reattach_after_detach(self):
+        api = self.make_api()
+        node = api.compute_instance_id()
+        volume = api.create_volume(uuid.uuid4(), GiB)
+
+        for _ in range(2):
+            attached = api.attach_volume(volume.blockdevice_id, node)
+            self.assertEqual(attached.attached_to, node)
+            api.detach_volume(volume.blockdevice_id)
+            self.assertEqual([v.attached_to for v in api.list_volumes()],
+                             [None])
+
+    def test_reattach_after_external_logout(self):
+        # Trust no cached session, the logout happens right after login
+        api = self.make_api(iscsi_session_ttl=0)
+        node = api.compute_instance_id()
+        volume = api.create_volume(uuid.uuid4(), GiB)
+        api.attach_volume(volume.blockdevice_id, node)
+
+        # An administrator logs the session out behind the driver's back
+        vol = self.elasticenter.filesystems[volume.blockdevice_id]
+        subprocess.check_call(
+            shlex.split(fake_iscsiadm.command_line(self.root)) +
+            ['-m', 'node', '-p', vol['ipaddress'], '-T', vol['iqnname'], '-u'])
+        self.assertEqual([v.attached_to for v in api.list_volumes()], [None])
+
+        attached = api.attach_volume(volume.blockdevice_id, node)
+        self.assertEqual(attached.attached_to, node)
+        self.assertEqual([v.attached_to for v in api.list_volumes()], [node])
+
+
+class TemplateTests(DriverTestCase):
+    def test_clone_is_listed_without_template(self):
+        template = self.elasticenter._add_filesystem(
+            'golden', self.elasticenter.tsm, 1024)
+        dataset_id = uuid.uuid4()
+        api = self.make_api(templates={str(dataset_id): 'golden'})
+
+        volume = api.create_volume(dataset_id, 2 * GiB)
+        clone = self.elasticenter.filesystems[volume.blockdevice_id]
+        self.assertEqual(clone['name'], str(dataset_id))
+        self.assertEqual(clone['currentTotalSpace'], '2048')
+        self.assertEqual(self.elasticenter.request_counts['createVolume'], 0)
+
+        listed = api.list_volumes()
+        self.assertEqual([(v.blockdevice_id, v.dataset_id) for v in listed],
+                         [(volume.blockdevice_id, dataset_id)])
+        self.assertNotIn(template['id'], [v.blockdevice_id for v in listed])
+
+
+    def test_templates_looked_up_once_per_listing(self):
+        template = self.elasticenter._add_filesystem(
+            'golden', self.elasticenter.tsm, 1024)
+        api = self.make_api(profiles={'gold': {'iops': 100,
+                                               'template': template['id']}})
+        volumes = [api.create_volume(uuid.uuid4(), GiB) for _ in range(3)]
+
+        lookups = []
+        template_names = api._template_names
+
+        def counted():
+            lookups.append(None)
+            return template_names()
+        self.patch(api, '_template_names', counted)
+
+        listed = api.list_volumes()
+        self.assertEqual(sorted(v.blockdevice_id for v in listed),
+                         sorted(v.blockdevice_id for v in volumes))
+        self.assertEqual(len(lookups), 1)
+
+
+class MultipleVSMTests(DriverTestCase):
+    elasticenter_options = {'extra_vsms': ['VSM2']}
+
+    def test_orphaned_qos_groups_collected_on_every_vsm(self):
+        api = self.make_api(vsms=['VSM1', 'VSM2'], qos_gc_grace=0.2)
+        elasticenter = self.elasticenter
+        for tsm in [elasticenter.tsm] + elasticenter.extra_tsms:
+            group_id = elasticenter._next_id()
+            elasticenter.qos_groups[group_id] = {
+                'id': group_id, 'name': 'QoS_shared_default_' + group_id[:8],
+                'tsmid': tsm['id']}
+
+        # Suspected on the first round, deleted once the grace has passed
+        api._qos_groups._collect_garbage()
+        self.assertEqual(len(elasticenter.qos_groups), 2)
+        time.sleep(0.3)
+        api._qos_groups._collect_garbage()
+        self.assertEqual(elasticenter.qos_groups, {})
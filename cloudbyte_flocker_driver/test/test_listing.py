@@ -0,0 +1,80 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Filtered and paged listFileSystem requests."""
+
+import uuid
+
+from cloudbyte_flocker_driver.test.test_lifecycle import DriverTestCase
+
+
+class FileSystemPagingTests(DriverTestCase):
+    def setUp(self):
+        DriverTestCase.setUp(self)
+        self.ids = [
+            self.elasticenter._add_filesystem(
+                str(uuid.uuid4()), self.elasticenter.tsm, 1024)['id']
+            for _ in range(5)]
+
+        self.requests = []
+        self.serve = self.elasticenter.cmd_listFileSystem
+
+        def recorded(params):
+            self.requests.append(params)
+            return self.serve(params)
+        self.patch(self.elasticenter, 'cmd_listFileSystem', recorded)
+
+    def listed(self, api, params=None):
+        del self.requests[:]
+        return [vol['id'] for vol in api._iter_filesystems(params or {})]
+
+    def pages(self):
+        return [(int(params['page']), int(params['pagesize']))
+                for params in self.requests]
+
+    def test_pages(self):
+        api = self.make_api(filesystem_page_size=2)
+        self.assertEqual(self.listed(api), self.ids)
+        # The short third page is the last
+        self.assertEqual(self.pages(), [(1, 2), (2, 2), (3, 2)])
+
+    def test_empty_last_page(self):
+        api = self.make_api(filesystem_page_size=5)
+        self.assertEqual(self.listed(api), self.ids)
+        self.assertEqual(self.pages(), [(1, 5), (2, 5)])
+
+    def test_paging_disabled(self):
+        api = self.make_api(filesystem_page_size=0)
+        self.assertEqual(self.listed(api), self.ids)
+        self.assertEqual(len(self.requests), 1)
+        self.assertNotIn('pagesize', self.requests[0])
+
+    def test_server_ignoring_paging(self):
+        api = self.make_api(filesystem_page_size=2)
+        serve = self.serve
+
+        def everything(params):
+            params = dict(params)
+            params.pop('page', None)
+            params.pop('pagesize', None)
+            return serve(params)
+        self.serve = everything
+
+        # Every volume once; the second page holds nothing new
+        self.assertEqual(self.listed(api), self.ids)
+        self.assertEqual(self.pages(), [(1, 2), (2, 2)])
+
+    def test_filters_sent_to_elasticenter(self):
+        api = self.make_api(filesystem_page_size=2)
+        self.assertEqual(
+            [vol['id'] for vol in api._request_filesystem(self.ids[3]).volumes],
+            [self.ids[3]])
+        self.assertEqual(self.requests[-1]['id'], self.ids[3])
+
+        del self.requests[:]
+        api._request_filesystems()
+        [(account_id, tsm_details)] = api._get_vsm_details()
+        self.assertEqual(
+            set((params['accountid'], params['tsmid'])
+                for params in self.requests),
+            set([(account_id, tsm_details['tsmid'])]))
@@ -0,0 +1,90 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Prometheus text exposition of the driver metrics."""
+
+from six.moves import urllib
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import metrics
+
+
+class ExpositionTests(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter_with_labels(self):
+        counter = self.registry.counter(
+            'cloudbyte_requests_total', 'ElastiCenter requests.',
+            ['command', 'status'])
+        counter.labels('listTsm', 200).inc()
+        counter.labels('listTsm', 200).inc(2)
+        counter.labels('createVolume', 431).inc()
+
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP cloudbyte_requests_total ElastiCenter requests.',
+            '# TYPE cloudbyte_requests_total counter',
+            'cloudbyte_requests_total{command="createVolume",status="431"} 1.0',
+            'cloudbyte_requests_total{command="listTsm",status="200"} 3.0',
+        ]) + '\n')
+
+    def test_label_values_are_escaped(self):
+        counter = self.registry.counter('errors_total', 'Errors.', ['error'])
+        counter.labels('say "no" \\o/').inc()
+        self.assertIn('errors_total{error="say \\"no\\" \\\\o/"} 1.0',
+                      self.registry.render())
+
+    def test_gauge_without_labels(self):
+        gauge = self.registry.gauge('in_flight', 'Requests in flight.')
+        gauge.inc(3)
+        gauge.dec()
+        self.assertIn('\nin_flight 2.0\n', self.registry.render())
+        gauge.set(7)
+        self.assertIn('\nin_flight 7.0\n', self.registry.render())
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram(
+            'wait_seconds', 'Waits.', ['state'], buckets=(0.1, 1))
+        for value in (0.1, 0.5, 0.5, 2):
+            histogram.labels('present').observe(value)
+
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'wait_seconds_bucket{state="present",le="0.1"} 1',
+            'wait_seconds_bucket{state="present",le="1"} 3',
+            'wait_seconds_bucket{state="present",le="+Inf"} 4',
+            'wait_seconds_sum{state="present"} 3.1',
+            'wait_seconds_count{state="present"} 4',
+        ])
+
+    def test_metrics_sorted_by_name(self):
+        self.registry.counter('b_total', 'B.').inc()
+        self.registry.counter('a_total', 'A.').inc()
+        types = [line for line in self.registry.render().splitlines()
+                 if line.startswith('# TYPE')]
+        self.assertEqual(types, ['# TYPE a_total counter',
+                                 '# TYPE b_total counter'])
+
+    def test_same_name_same_metric(self):
+        first = self.registry.counter('requests_total', 'Requests.')
+        self.assertIs(self.registry.counter('requests_total', 'Requests.'),
+                      first)
+
+    def test_disabled_registry(self):
+        registry = metrics.Registry(enabled=False)
+        counter = registry.counter('requests_total', 'Requests.', ['command'])
+        self.assertIs(counter, metrics.NOOP)
+        counter.labels('listTsm').inc()
+        self.assertEqual(registry.render(), '\n')
+
+    def test_http_endpoint(self):
+        self.registry.counter('requests_total', 'Requests.').inc()
+        server = metrics.serve(self.registry, 0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        response = urllib.request.urlopen(
+            'http://127.0.0.1:%d/metrics' % server.server_port)
+        self.assertEqual(response.headers['Content-Type'],
+                         'text/plain; version=0.0.4')
+        self.assertEqual(response.read().decode('utf-8'),
+                         self.registry.render())
@@ -0,0 +1,93 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Multipath attach against the fake iscsiadm and fake multipathd."""
+
+import os
+import subprocess
+import uuid
+
+from flocker.node.agents.blockdevice import UnattachedVolume
+
+from cloudbyte_flocker_driver.test.test_lifecycle import DriverTestCase, GiB
+from cloudbyte_flocker_driver.testtools import fake_multipathd
+
+
+class MultipathTests(DriverTestCase):
+    elasticenter_options = {'vsm_portals': ['127.0.1.1']}
+
+    def setUp(self):
+        DriverTestCase.setUp(self)
+        self.conf_dir = os.path.join(self.root, 'etc', 'multipath', 'conf.d')
+
+    def make_api(self, **config):
+        options = dict(
+            multipath=True,
+            multipathd_command=fake_multipathd.command_line(self.root),
+            multipath_conf_dir=self.conf_dir,
+            multipath_install_command='install -D -m 0644')
+        options.update(config)
+        return DriverTestCase.make_api(self, **options)
+
+    def multipathd_calls(self):
+        path = os.path.join(self.root, 'calls.log')
+        with open(path) as log:
+            return [line for line in log.read().splitlines()
+                    if line.startswith('multipathd ')]
+
+    def test_attach_installs_configuration(self):
+        api = self.make_api()
+        volume = api.create_volume(uuid.uuid4(), GiB)
+        api.attach_volume(volume.blockdevice_id, api.compute_instance_id())
+
+        with open(os.path.join(self.conf_dir, 'cloudbyte.conf')) as f:
+            self.assertIn('vendor "CloudByt"', f.read())
+        self.assertIn('multipathd reconfigure', self.multipathd_calls())
+
+    def test_configuration_written_through_install_command(self):
+        api = self.make_api(multipath_install_command='false')
+        volume = api.create_volume(uuid.uuid4(), GiB)
+
+        self.assertRaises(subprocess.CalledProcessError, api.attach_volume,
+                          volume.blockdevice_id, api.compute_instance_id())
+        self.assertFalse(os.path.exists(self.conf_dir))
+
+    def test_device_path_remembered_from_attach(self):
+        api = self.make_api()
+        volume = api.create_volume(uuid.uuid4(), GiB)
+        api.attach_volume(volume.blockdevice_id, api.compute_instance_id())
+        calls = len(self.multipathd_calls())
+
+        for _ in range(2):
+            path = api.get_device_path(volume.blockdevice_id).path
+            self.assertTrue(path.startswith('/dev/dm-'))
+        self.assertEqual(self.multipathd_calls()[calls:], [])
+
+    def test_device_path_after_restart(self):
+        api = self.make_api()
+        volume = api.create_volume(uuid.uuid4(), GiB)
+        api.attach_volume(volume.blockdevice_id, api.compute_instance_id())
+        path = api.get_device_path(volume.blockdevice_id)
+
+        # A new agent asks multipathd once
+        restarted = self.make_api()
+        calls = len(self.multipathd_calls())
+        for _ in range(2):
+            self.assertEqual(
+                restarted.get_device_path(volume.blockdevice_id), path)
+        self.assertEqual(len(self.multipathd_calls()[calls:]), 2)
+
+    def test_detach_forgets_map(self):
+        api = self.make_api()
+        node = api.compute_instance_id()
+        volume = api.create_volume(uuid.uuid4(), GiB)
+        api.attach_volume(volume.blockdevice_id, node)
+        first = api.get_device_path(volume.blockdevice_id)
+
+        api.detach_volume(volume.blockdevice_id)
+        self.assertRaises(UnattachedVolume, api.get_device_path,
+                          volume.blockdevice_id)
+
+        # multipathd assembles a new map on the next attach
+        api.attach_volume(volume.blockdevice_id, node)
+        self.assertNotEqual(api.get_device_path(volume.blockdevice_id), first)
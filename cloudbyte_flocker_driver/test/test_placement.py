@@ -0,0 +1,172 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Scoring and choice of the VSM new volumes are created on."""
+
+import copy
+import logging
+
+from bitmath import GiB, TiB
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import placement
+
+
+def listed_tsm(id, name, **figures):
+    """A listTsm entry as ElastiCenter returns it."""
+
+    tsm = {
+        'id': id, 'simid': 'sim-' + id, 'name': name,
+        'ipaddress': '20.10.1.%s' % id[-1], 'subnet': '8',
+        'accountid': 'acc1', 'accountname': 'Account1',
+        'datasetid': 'ds-' + id, 'poolid': 'pool1', 'poolname': 'Pool1',
+        'sitename': 'Site1', 'status': 'Online', 'type': '1',
+        'iops': '0', 'throughput': '0', 'latency': '15',
+        'blocksize': '4k', 'tpcontrol': 'true', 'iopscontrol': 'true',
+        'graceallowed': 'true', 'compression': 'off', 'deduplication': 'off',
+        'sync': 'always', 'noofvolumes': '3',
+        'totalquota': '1T', 'availablequota': '512G',
+        'totaliops': '20000', 'availableiops': '10000',
+    }
+    tsm.update(figures)
+    return tsm
+
+
+class FakeDriver(object):
+    def __init__(self, tsms):
+        self.tsms = tsms
+        self.tsm_requests = 0
+
+    def _get_vsm_details(self):
+        return [(tsm['accountid'], {'tsmid': tsm['id'], 'name': tsm['name'],
+                                    'datasetid': tsm['datasetid']})
+                for tsm in self.tsms]
+
+    def _request_tsm_details(self, account_id):
+        self.tsm_requests += 1
+        return {'listTsmResponse': {
+            'count': len(self.tsms),
+            'listTsm': copy.deepcopy(self.tsms)}}
+
+
+class FigureTests(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(
+            [placement.parse_size(value) for value in
+             ('1T', '512G', '1022.5G', '2048M', '2048', '100GB', ' 4 k')],
+            [TiB(1).bytes, GiB(512).bytes, GiB(1022.5).bytes,
+             GiB(2).bytes, GiB(2).bytes, GiB(100).bytes, 4096])
+        self.assertEqual([placement.parse_size(value)
+                          for value in (None, '', 'unlimited')],
+                         [None, None, None])
+
+    def test_parse_count(self):
+        self.assertEqual([placement.parse_count(value) for value in
+                          ('20000', 20000, '1.5e3', None, 'N/A')],
+                         [20000, 20000, 1500, None, None])
+
+    def test_tsm_headroom(self):
+        self.assertEqual(
+            placement.tsm_headroom(listed_tsm('t1', 'VSM1')),
+            (GiB(512).bytes, TiB(1).bytes, 10000, 20000))
+        self.assertEqual(placement.tsm_headroom({'id': 't1'}),
+                         (None, None, None, None))
+
+
+class ScoreTests(unittest.TestCase):
+    headroom = (100, 200, 1000, 1000)
+
+    def test_smaller_share_left(self):
+        # The smaller of the capacity and IOPS shares left counts
+        self.assertEqual(placement.score(self.headroom, 0, 0), 0.0)
+        self.assertEqual(placement.score(self.headroom, 0, 100), 0.9)
+        self.assertEqual(placement.score(self.headroom, 50, 100), 0.25)
+
+    def test_does_not_fit(self):
+        self.assertIs(placement.score(self.headroom, 101, 0), None)
+        self.assertIs(placement.score(self.headroom, 10, 1001), None)
+
+    def test_unknown_figures_ignored(self):
+        self.assertEqual(placement.score((100, None, None, None), 50, 500),
+                         0.5)
+        self.assertEqual(placement.score((None, None, None, None), 50, 500),
+                         0.0)
+
+
+class PlacementSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.warnings = []
+        handler = logging.Handler()
+        handler.emit = self.warnings.append
+        logger = logging.getLogger(placement.__name__)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+    def choose(self, scheduler, size=GiB(100).bytes, iops=0):
+        return scheduler.choose(size, iops)[1]['name']
+
+    def test_most_headroom(self):
+        driver = FakeDriver([
+            listed_tsm('t1', 'VSM1', availablequota='200G'),
+            listed_tsm('t2', 'VSM2', availablequota='600G'),
+            listed_tsm('t3', 'VSM3', availablequota='900G',
+                       availableiops='100')])
+        scheduler = placement.PlacementScheduler(driver)
+        # VSM3 has the most capacity but hardly any IOPS left
+        self.assertEqual(self.choose(scheduler, iops=50), 'VSM2')
+        self.assertEqual(self.warnings, [])
+
+    def test_burst_spread_by_reservations(self):
+        driver = FakeDriver([
+            listed_tsm('t1', 'VSM1', availablequota='400G'),
+            listed_tsm('t2', 'VSM2', availablequota='300G')])
+        scheduler = placement.PlacementScheduler(driver)
+
+        # Once VSM1 has taken a volume both are even, ties go to the VSM
+        # with less placed on it
+        self.assertEqual([self.choose(scheduler) for _ in range(4)],
+                         ['VSM1', 'VSM2', 'VSM1', 'VSM2'])
+        self.assertEqual(driver.tsm_requests, 1)
+        self.assertEqual(scheduler._reserved,
+                         {'t1': [GiB(200).bytes, 0], 't2': [GiB(200).bytes, 0]})
+
+    def test_fresh_figures_drop_reservations(self):
+        driver = FakeDriver([listed_tsm('t1', 'VSM1'),
+                             listed_tsm('t2', 'VSM2')])
+        scheduler = placement.PlacementScheduler(driver, ttl=0)
+        self.choose(scheduler)
+        self.choose(scheduler)
+        # Figures are fetched for every choice and already count the volumes
+        self.assertEqual(driver.tsm_requests, 4)
+        self.assertEqual(sorted(scheduler._reserved), ['t1'])
+
+    def test_full_vsms_skipped(self):
+        driver = FakeDriver([
+            listed_tsm('t1', 'VSM1', availablequota='50G'),
+            listed_tsm('t2', 'VSM2', availablequota='100G')])
+        scheduler = placement.PlacementScheduler(driver)
+        self.assertEqual(self.choose(scheduler), 'VSM2')
+        e = self.assertRaises(ValueError, self.choose, scheduler)
+        self.assertIn('No configured VSM has room', str(e))
+
+    def test_single_vsm_not_scored(self):
+        driver = FakeDriver([listed_tsm('t1', 'VSM1', availablequota='0G')])
+        scheduler = placement.PlacementScheduler(driver)
+        self.assertEqual(self.choose(scheduler), 'VSM1')
+        self.assertEqual(driver.tsm_requests, 0)
+
+    def test_missing_figures_warn_once(self):
+        incomplete = listed_tsm('t2', 'VSM2', availablequota='900G')
+        del incomplete['availableiops']
+        incomplete['totaliops'] = 'N/A'
+        driver = FakeDriver([listed_tsm('t1', 'VSM1'), incomplete])
+        scheduler = placement.PlacementScheduler(driver, ttl=0)
+
+        # Capacity alone still counts for VSM2
+        self.assertEqual(self.choose(scheduler, iops=100), 'VSM2')
+        self.choose(scheduler, iops=100)
+        self.assertEqual([r.levelno for r in self.warnings],
+                         [logging.WARNING])
+        message = self.warnings[0].getMessage()
+        self.assertIn('availableiops, totaliops', message)
+        self.assertIn('[VSM2]', message)
@@ -0,0 +1,64 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Shared QoS groups and their cleanup against the fake ElastiCenter."""
+
+import time
+import uuid
+
+from cloudbyte_flocker_driver import qos
+from cloudbyte_flocker_driver.test.test_lifecycle import DriverTestCase, GiB
+
+
+class QoSGroupTests(DriverTestCase):
+    def add_group(self, name):
+        group_id = self.elasticenter._next_id()
+        self.elasticenter.qos_groups[group_id] = {
+            'id': group_id, 'name': name,
+            'tsmid': self.elasticenter.tsm['id']}
+        return group_id
+
+    def test_creates_share_a_group(self):
+        api = self.make_api()
+        volumes = [api.create_volume(uuid.uuid4(), GiB) for _ in range(2)]
+
+        group_ids = set(self.elasticenter.filesystems[v.blockdevice_id]['groupid']
+                        for v in volumes)
+        self.assertEqual(len(group_ids), 1)
+        name = self.elasticenter.qos_groups[group_ids.pop()]['name']
+        self.assertTrue(name.startswith(qos.SHARED_QOS_GROUP_PREFIX))
+        self.assertEqual(self.elasticenter.request_counts['addQosGroup'], 1)
+
+    def test_orphan_kept_during_grace(self):
+        api = self.make_api(qos_gc_grace=0.2)
+        orphan_id = self.add_group(qos.SHARED_QOS_GROUP_PREFIX + 'gold_0123abcd')
+
+        api._qos_groups._collect_garbage()
+        self.assertIn(orphan_id, self.elasticenter.qos_groups)
+        time.sleep(0.3)
+        api._qos_groups._collect_garbage()
+        self.assertNotIn(orphan_id, self.elasticenter.qos_groups)
+
+    def test_foreign_groups_kept(self):
+        api = self.make_api(qos_gc_grace=0)
+        foreign = [self.add_group('QoS_' + str(uuid.uuid4())),
+                   self.add_group('QoS_reports'),
+                   self.add_group('backup-tier')]
+
+        api._qos_groups._collect_garbage()
+        api._qos_groups._collect_garbage()
+        for group_id in foreign:
+            self.assertIn(group_id, self.elasticenter.qos_groups)
+
+    def test_own_per_volume_group_collected_after_restart(self):
+        api = self.make_api(qos_group_mode='per_volume', qos_gc_interval=0)
+        volume = api.create_volume(uuid.uuid4(), GiB)
+        group_id = self.elasticenter.filesystems[volume.blockdevice_id]['groupid']
+        api.destroy_volume(volume.blockdevice_id)
+        self.assertIn(group_id, self.elasticenter.qos_groups)
+
+        # The group is known from the state store after a restart
+        restarted = self.make_api(qos_group_mode='per_volume', qos_gc_grace=0)
+        restarted._qos_groups._collect_garbage()
+        self.assertNotIn(group_id, self.elasticenter.qos_groups)
+        self.assertEqual(restarted._state.qos_groups(), [])
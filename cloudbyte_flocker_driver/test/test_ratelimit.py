@@ -0,0 +1,161 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Token bucket and AIMD concurrency limits."""
+
+import threading
+
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import ratelimit
+
+
+class FakeClock(object):
+    """Stands in for the time module; sleeping moves the clock."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patch(ratelimit, 'time', self.clock)
+
+
+class TokenBucketTests(ClockTestCase):
+    def assertWaits(self, bucket, expected):
+        waits = [bucket.acquire() for _ in expected]
+        for wait, wanted in zip(waits, expected):
+            self.assertAlmostEqual(wait, wanted)
+
+    def test_burst_then_rate(self):
+        bucket = ratelimit.TokenBucket(10, burst=2)
+        self.assertWaits(bucket, [0, 0, 0.1, 0.1, 0.1])
+        self.assertAlmostEqual(sum(self.clock.slept), 0.3)
+
+    def test_refill_capped_at_burst(self):
+        bucket = ratelimit.TokenBucket(10, burst=2)
+        self.assertWaits(bucket, [0, 0])
+        self.clock.now += 100
+        self.assertWaits(bucket, [0, 0, 0.1])
+
+    def test_waiters_reserve_in_order(self):
+        bucket = ratelimit.TokenBucket(10, burst=1)
+        bucket.acquire()
+        # Without sleeping, every caller queues behind the previous one
+        self.patch(self.clock, 'sleep', lambda seconds: None)
+        self.assertWaits(bucket, [0.1, 0.2, 0.3])
+
+    def test_default_burst(self):
+        self.assertEqual(ratelimit.TokenBucket(20).burst, 20)
+        self.assertEqual(ratelimit.TokenBucket(0.5).burst, 1)
+
+    def test_zero_rate_is_unlimited(self):
+        bucket = ratelimit.TokenBucket(0)
+        self.assertWaits(bucket, [0] * 100)
+        self.assertEqual(self.clock.slept, [])
+
+
+class AdaptiveConcurrencyTests(ClockTestCase):
+    def make_limit(self, **kwargs):
+        options = dict(initial=4, minimum=1, maximum=16)
+        options.update(kwargs)
+        return ratelimit.AdaptiveConcurrency(**options)
+
+    def answer(self, limit, latency=0.05, overloaded=False, key='listTsm'):
+        limit.acquire()
+        limit.release(key, latency, overloaded)
+
+    def test_additive_increase(self):
+        limit = self.make_limit()
+        # About one more slot per limit's worth of healthy answers
+        for _ in range(4):
+            self.answer(limit)
+        self.assertTrue(4.8 < limit.limit < 5)
+        for _ in range(1000):
+            self.answer(limit)
+        self.assertEqual(limit.limit, 16)
+
+    def test_multiplicative_decrease(self):
+        limit = self.make_limit(initial=16)
+        self.answer(limit, overloaded=True)
+        self.assertEqual(limit.limit, 8)
+
+        for _ in range(10):
+            self.clock.now += 1
+            self.answer(limit, overloaded=True)
+        self.assertEqual(limit.limit, 1)
+
+    def test_failures_together_decrease_once(self):
+        limit = self.make_limit(initial=16)
+        for _ in range(3):
+            self.answer(limit, latency=1, overloaded=True)
+        self.assertEqual(limit.limit, 8)
+
+        self.clock.now += 1.5
+        self.answer(limit, latency=1, overloaded=True)
+        self.assertEqual(limit.limit, 4)
+
+    def test_slow_answer_decreases(self):
+        limit = self.make_limit(initial=16, latency_tolerance=2.0)
+        self.answer(limit, latency=0.2)
+        self.answer(limit, latency=0.3)
+        self.assertEqual(limit.limit, 16)
+
+        self.answer(limit, latency=1.0)
+        self.assertEqual(limit.limit, 8)
+
+    def test_baseline_per_command(self):
+        limit = self.make_limit(initial=16)
+        self.answer(limit, latency=0.2, key='listTsm')
+        # Slower than listTsm, but the first createVolume sets its own
+        self.answer(limit, latency=5, key='createVolume')
+        self.assertEqual(limit.limit, 16)
+
+    def test_fast_answers_never_slow(self):
+        limit = self.make_limit(initial=16, latency_floor=0.1)
+        self.answer(limit, latency=0.001)
+        self.answer(limit, latency=0.05)
+        self.assertEqual(limit.limit, 16)
+
+    def test_acquire_blocks_at_limit(self):
+        limit = self.make_limit(initial=1)
+        limit.acquire()
+        acquired = threading.Event()
+
+        def second():
+            limit.acquire()
+            acquired.set()
+        thread = threading.Thread(target=second)
+        thread.start()
+        self.addCleanup(thread.join, 10)
+
+        self.assertFalse(acquired.wait(0.1))
+        limit.release('listTsm', 0.05, False)
+        self.assertTrue(acquired.wait(10))
+
+
+class OverloadTests(unittest.TestCase):
+    def test_is_overload(self):
+        self.assertEqual(
+            [ratelimit.is_overload(status)
+             for status in (None, 200, 431, 429, 500, 503)],
+            [True, False, False, True, True, True])
+
+
+class BudgetTests(ClockTestCase):
+    def test_release_reports_overload(self):
+        budget = ratelimit.Budget('write', max_concurrency=8)
+        self.assertEqual(budget._concurrency.limit, 4)
+        budget.acquire()
+        budget.release('createVolume', 0.05, 503)
+        self.assertEqual(budget._concurrency.limit, 2)
@@ -0,0 +1,86 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""The local state store and the driver's use of it."""
+
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+from flocker.node.agents.blockdevice import UnknownVolume
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import state
+from cloudbyte_flocker_driver.test.test_lifecycle import DriverTestCase, GiB
+
+
+def _volume(cb_volume_id, size='1024'):
+    return {'id': cb_volume_id, 'name': str(uuid.uuid4()), 'Tsmid': 'tsm',
+            'ipaddress': '10.0.0.1', 'iqnname': 'iqn.' + cb_volume_id,
+            'currentTotalSpace': size, 'groupid': None}
+
+
+class StateStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='cloudbyte-state-')
+        self.addCleanup(shutil.rmtree, self.root)
+        self.store = state.StateStore(os.path.join(self.root, 'state.db'))
+        self.addCleanup(self.store.close)
+
+    def updated(self):
+        return dict(self.store._db.execute(
+            'SELECT blockdevice_id, updated FROM volumes').fetchall())
+
+    def test_replace_listing_writes_only_changes(self):
+        first, second = _volume('1'), _volume('2')
+        self.store.replace_listing([first, second])
+        before = self.updated()
+
+        second = dict(second, currentTotalSpace='2048')
+        self.store.replace_listing([first, second])
+        after = self.updated()
+        self.assertEqual(after['1'], before['1'])
+        self.assertNotEqual(after['2'], before['2'])
+
+        self.store.replace_listing([second])
+        self.assertEqual(list(self.updated()), ['2'])
+        listing, _ = self.store.listing()
+        self.assertEqual(listing.get('2')['currentTotalSpace'], '2048')
+
+    def test_missing_directory_warns(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger(state.__name__)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        store = state.open_store(os.path.join(self.root, 'missing', 'state.db'))
+        self.assertIs(store, state.NOOP_STORE)
+        self.assertEqual([r.levelno for r in records], [logging.WARNING])
+
+
+class VolumeRecordTests(DriverTestCase):
+    def test_deleted_volume_is_unknown(self):
+        api = self.make_api()
+        volume = api.create_volume(uuid.uuid4(), GiB)
+        self.assertIsNotNone(api._state.get_volume(volume.blockdevice_id))
+
+        # Deleted by someone else; the stored record must not answer
+        del self.elasticenter.filesystems[volume.blockdevice_id]
+        api._filesystem_snapshot.invalidate()
+        self.assertRaises(UnknownVolume, api.attach_volume,
+                          volume.blockdevice_id, api.compute_instance_id())
+
+    def test_store_answers_while_elasticenter_is_down(self):
+        api = self.make_api()
+        node = api.compute_instance_id()
+        volume = api.create_volume(uuid.uuid4(), GiB)
+
+        self.server.shutdown()
+        self.server.server_close()
+        api._filesystem_snapshot.invalidate()
+        attached = api.attach_volume(volume.blockdevice_id, node)
+        self.assertEqual(attached.attached_to, node)
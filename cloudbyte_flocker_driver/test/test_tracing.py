@@ -0,0 +1,140 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Span sampling, nesting and export."""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import tracing
+
+
+class ListExporter(object):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class TracerTests(unittest.TestCase):
+    def setUp(self):
+        self.exporter = ListExporter()
+
+    def make_tracer(self, sample_rate=1.0):
+        return tracing.Tracer(sample_rate, self.exporter)
+
+    def test_children_join_the_trace(self):
+        tracer = self.make_tracer()
+        with tracer.span('attach_volume') as root:
+            with tracer.span('request', command='listFileSystem') as child:
+                self.assertIs(tracer.current(), child)
+            self.assertIs(tracer.current(), root)
+        self.assertIs(tracer.current(), None)
+
+        # Exported as they finish, innermost first
+        self.assertEqual(self.exporter.spans, [child, root])
+        self.assertEqual(child.trace_id, root.trace_id)
+        self.assertEqual(child.parent_id, root.span_id)
+        self.assertIs(root.parent_id, None)
+        self.assertEqual(child.attributes, {'command': 'listFileSystem'})
+
+    def test_explicit_parent_on_another_thread(self):
+        tracer = self.make_tracer()
+        spans = []
+
+        with tracer.span('create_volumes') as root:
+            def work():
+                with tracer.span('bulk.item', parent=root) as span:
+                    spans.append(span)
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(spans[0].trace_id, root.trace_id)
+        self.assertEqual(spans[0].parent_id, root.span_id)
+
+    def test_unsampled_trace_records_nothing(self):
+        tracer = self.make_tracer(sample_rate=0)
+        with tracer.span('attach_volume') as root:
+            with tracer.span('request') as child:
+                pass
+        self.assertEqual([root, child], [tracing.NOOP_SPAN] * 2)
+        self.assertEqual(self.exporter.spans, [])
+
+    def test_sampling_decided_per_trace(self):
+        tracer = self.make_tracer(sample_rate=0.5)
+        rolls = iter([0.7, 0.2])
+        self.patch(tracing.random, 'random', lambda: next(rolls))
+
+        with tracer.span('unsampled'):
+            with tracer.span('child'):
+                pass
+        with tracer.span('sampled'):
+            with tracer.span('child'):
+                pass
+        self.assertEqual([span.name for span in self.exporter.spans],
+                         ['child', 'sampled'])
+
+    def test_no_exporter_no_sampling(self):
+        tracer = tracing.Tracer(1.0, None)
+        with tracer.span('attach_volume') as span:
+            self.assertIs(span, tracing.NOOP_SPAN)
+
+    def test_error_recorded(self):
+        tracer = self.make_tracer()
+
+        def fail():
+            with tracer.span('request'):
+                raise ValueError('431')
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.exporter.spans[0].attributes,
+                         {'error': repr(ValueError('431'))})
+        self.assertIs(tracer.current(), None)
+
+    def test_traced_method(self):
+        class Driver(object):
+            tracer = self.make_tracer()
+
+            @tracing.traced
+            def list_volumes(self):
+                return self.tracer.current()
+
+        span = Driver().list_volumes()
+        self.assertEqual(span.name, 'list_volumes')
+        self.assertEqual(self.exporter.spans, [span])
+
+
+class ExporterTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='cloudbyte-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'trace')
+
+    def trace(self, exporter):
+        tracer = tracing.Tracer(1.0, exporter)
+        with tracer.span('attach_volume', volume='vol1') as span:
+            pass
+        exporter._file.close()
+        return span
+
+    def test_json_lines(self):
+        span = self.trace(tracing.JSONLinesExporter(self.path))
+        with open(self.path) as f:
+            [line] = f.read().splitlines()
+        self.assertEqual(json.loads(line)['span_id'], span.span_id)
+
+    def test_chrome_trace(self):
+        span = self.trace(tracing.ChromeTraceExporter(self.path))
+        self.trace(tracing.ChromeTraceExporter(self.path))
+        with open(self.path) as f:
+            # The array is left open, close it to parse it
+            events = json.loads(f.read().rstrip(',\n') + ']')
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]['args']['span_id'], span.span_id)
+        self.assertEqual(events[0]['args']['volume'], 'vol1')
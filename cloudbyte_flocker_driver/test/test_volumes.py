@@ -0,0 +1,94 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Indexes and compact records of listFileSystem results."""
+
+import io
+import json
+
+from twisted.trial import unittest
+
+from cloudbyte_flocker_driver import volumes
+
+
+def filesystem(id, name, tsm='tsm1', iqn=None):
+    return {'id': id, 'name': name, 'Tsmid': tsm, 'iqnname': iqn,
+            'ipaddress': '10.0.0.1', 'currentTotalSpace': '1024'}
+
+
+class VolumeIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.first = filesystem('1', 'data', iqn='iqn.1')
+        self.second = filesystem('2', 'data', tsm='tsm2', iqn='iqn.2')
+        self.third = filesystem('3', 'logs')
+        self.index = volumes.VolumeIndex(
+            [self.first, self.second, self.third])
+
+    def test_lookups(self):
+        self.assertEqual(len(self.index), 3)
+        self.assertIs(self.index.get('2'), self.second)
+        self.assertIs(self.index.get_by_iqn('iqn.1'), self.first)
+        self.assertEqual(self.index.in_tsm('tsm1'), [self.first, self.third])
+        self.assertEqual(
+            [self.index.get('4'), self.index.get_by_name('missing'),
+             self.index.get_by_iqn('iqn.4')], [None, None, None])
+        self.assertEqual(self.index.in_tsm('tsm4'), [])
+
+    def test_duplicate_names_find_the_first(self):
+        self.assertIs(self.index.get_by_name('data'), self.first)
+
+    def test_volumes_without_iqn_are_not_indexed_by_iqn(self):
+        self.assertEqual(sorted(self.index.by_iqn), ['iqn.1', 'iqn.2'])
+
+    def test_from_response(self):
+        index = volumes.VolumeIndex.from_response(
+            {'listFilesystemResponse': {'filesystem': [self.first]}})
+        self.assertIs(index.get('1'), self.first)
+
+        # ElastiCenter leaves the list out when there are no volumes
+        empty = volumes.VolumeIndex.from_response(
+            {'listFilesystemResponse': {}})
+        self.assertEqual(len(empty), 0)
+
+        self.assertRaises(ValueError, volumes.VolumeIndex.from_response, {})
+
+
+class FileSystemRecordTests(unittest.TestCase):
+    def test_reads_like_the_dict(self):
+        fs = filesystem('1', 'data', iqn='iqn.1')
+        fs['unused'] = 'dropped'
+        record = volumes.FileSystemRecord(fs)
+
+        self.assertEqual(record['name'], 'data')
+        self.assertEqual(record.get('iqnname'), 'iqn.1')
+        self.assertIs(record.get('groupid'), None)
+        self.assertEqual(record.get('unused', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: record['unused'])
+
+
+class ReadFilesystemsResponseTests(unittest.TestCase):
+    def test_compact_records(self):
+        fs = filesystem('1', 'data', iqn='iqn.1')
+        fs['path'] = '/VSM1/data'
+        body = json.dumps({'listFilesystemResponse': {'filesystem': [fs]}})
+        response = io.BytesIO(body.encode('utf-8') + b'\n')
+
+        data = volumes.read_filesystems_response(response)
+        [record] = volumes.filesystems_from_response(data)
+        self.assertIsInstance(record, volumes.FileSystemRecord)
+        self.assertEqual(record['iqnname'], 'iqn.1')
+        self.assertIs(record.get('path'), None)
+        # The rest of the body is read for the connection to be reused
+        self.assertEqual(response.read(), b'')
+
+    def test_error_response(self):
+        body = b'{"listFilesystemResponse": {"errorcode": 431}}'
+        data = volumes.read_filesystems_response(io.BytesIO(body))
+        self.assertEqual(data, {'listFilesystemResponse': {'errorcode': 431}})
+
+
+class DescribeTests(unittest.TestCase):
+    def test_long_listings_are_cut(self):
+        self.assertEqual(volumes.describe(['a', 'b']), 'a, b')
+        self.assertEqual(volumes.describe(['a', 'b', 'c'], limit=2),
+                         'a, b, ... 1 more')
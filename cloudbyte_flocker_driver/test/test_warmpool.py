@@ -0,0 +1,103 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""The warm pool against the fake ElastiCenter."""
+
+import time
+import uuid
+
+from cloudbyte_flocker_driver import warmpool
+from cloudbyte_flocker_driver.test.test_lifecycle import DriverTestCase, GiB
+
+
+class WarmPoolTests(DriverTestCase):
+    def make_pool_api(self, **config):
+        config.setdefault('warm_pool', [{'size_gb': 1, 'count': 2}])
+        # Rounds only run when the tests ask for them
+        config.setdefault('warm_pool_refill_interval', 3600)
+        return self.make_api(**config)
+
+    def pool_volumes(self):
+        return set(fs['id'] for fs in self.elasticenter.filesystems.values()
+                   if warmpool.is_pool_volume(fs['name']))
+
+    def fill(self, api, count=2):
+        api.list_volumes()
+        self.wait_for(lambda: api._warm_pool.ready(None, '1G') == count)
+
+    def test_starts_on_first_use(self):
+        api = self.make_pool_api()
+        self.assertEqual(self.elasticenter.request_counts['createVolume'], 0)
+
+        self.fill(api)
+        self.assertEqual(len(self.pool_volumes()), 2)
+        self.assertEqual(api.list_volumes(), [])
+
+    def test_claim_and_refill(self):
+        api = self.make_pool_api()
+        self.fill(api)
+        pool_ids = self.pool_volumes()
+
+        dataset_id = uuid.uuid4()
+        volume = api.create_volume(dataset_id, GiB)
+        self.assertIn(volume.blockdevice_id, pool_ids)
+        self.assertEqual(volume.dataset_id, dataset_id)
+        self.assertEqual(
+            self.elasticenter.filesystems[volume.blockdevice_id]['name'],
+            str(dataset_id))
+        self.assertEqual([v.dataset_id for v in api.list_volumes()],
+                         [dataset_id])
+
+        # The claim wakes the refill thread, which replaces the volume
+        self.wait_for(lambda: len(self.pool_volumes()) == 2)
+        self.wait_for(lambda: api._warm_pool.ready(None, '1G') == 2)
+
+    def test_trim_when_idle(self):
+        api = self.make_pool_api(
+            warm_pool=[{'size_gb': 1, 'count': 2, 'min_count': 1}],
+            warm_pool_idle_timeout=1)
+        self.fill(api)
+
+        time.sleep(1.1)
+        api._warm_pool.refill()
+        self.assertEqual(api._warm_pool.ready(None, '1G'), 1)
+        self.assertEqual(len(self.pool_volumes()), 1)
+
+    def assertCreatedWithoutPool(self, api):
+        pool_ids = self.pool_volumes()
+        dataset_id = uuid.uuid4()
+        volume = api.create_volume(dataset_id, GiB)
+
+        self.assertNotIn(volume.blockdevice_id, pool_ids)
+        self.assertEqual(
+            self.elasticenter.filesystems[volume.blockdevice_id]['name'],
+            str(dataset_id))
+        # The pool volume is still there to be claimed later
+        self.assertEqual(self.pool_volumes(), pool_ids)
+
+    def test_failed_rename_falls_back(self):
+        api = self.make_pool_api()
+        self.fill(api)
+
+        def refuse(params):
+            raise ValueError('filesystem is in use')
+        self.patch(self.elasticenter, 'cmd_updateFileSystem', refuse)
+        self.assertCreatedWithoutPool(api)
+
+    def test_ignored_rename_falls_back(self):
+        api = self.make_pool_api()
+        self.fill(api)
+
+        def ignore(params):
+            filesystem = self.elasticenter.filesystems[params['id']]
+            return {'updatefilesystemresponse': {'filesystem': filesystem}}
+        self.patch(self.elasticenter, 'cmd_updateFileSystem', ignore)
+        self.assertCreatedWithoutPool(api)
+
+    def test_close_stops_refill(self):
+        api = self.make_pool_api()
+        self.fill(api)
+        thread = api._warm_pool._thread
+
+        api.close()
+        self.assertFalse(thread.is_alive())
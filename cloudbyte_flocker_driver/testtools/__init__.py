@@ -0,0 +1,4 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Local stand-ins for ElastiCenter and open-iscsi."""
@@ -0,0 +1,348 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""In-memory ElastiCenter serving the REST commands used by the driver."""
+
+import collections
+import itertools
+import json
+import os
+import ssl
+import threading
+import time
+import uuid
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves import urllib
+
+
+class FakeElastiCenter(object):
+    """Volume inventory and async jobs of a single account and VSM.
+
+    ``latency`` is added to every request, async jobs finish
+    ``job_duration`` seconds after they are submitted, and
+    ``inventory_size`` volumes belonging to another tenant are created up
+    front to make listings realistically large. When ``iscsi_root`` is set
+    the targets each portal advertises are written to
+    ``<iscsi_root>/targets.json`` for the fake iscsiadm; our VSM's targets
+    are also advertised on each of the ``vsm_portals``.
+
+    ``extra_vsms`` names further VSMs of the same account. Every VSM has
+    ``vsm_quota_gb`` of capacity and ``vsm_iops`` IOPS, of which listTsm
+    reports what the volumes and QoS groups on it leave available.
+    """
+
+    def __init__(self, account_name='Account1', vsm_name='VSM1',
+                 vsm_ip='127.0.0.1', latency=0, job_duration=0,
+                 inventory_size=0, iscsi_root=None, vsm_portals=(),
+                 extra_vsms=(), vsm_quota_gb=1024, vsm_iops=20000):
+        self.latency = latency
+        self.job_duration = job_duration
+        self.vsm_ip = vsm_ip
+        self.vsm_portals = list(vsm_portals)
+        self.iscsi_root = iscsi_root
+        self.vsm_quota_gb = vsm_quota_gb
+        self.vsm_iops = vsm_iops
+
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.request_counts = collections.Counter()
+
+        self.accounts = []
+        self.tsms = []
+        self.filesystems = collections.OrderedDict()
+        self.qos_groups = {}
+        self.iscsi_services = {}
+        self.initiator_groups = {}
+        self.jobs = {}
+        # Filesystem id -> its snapshots
+        self.snapshots = collections.defaultdict(list)
+
+        account = self._add_account(account_name)
+        self.tsm = self._add_tsm(account, vsm_name, vsm_ip)
+        self.extra_tsms = [
+            self._add_tsm(account, name, '127.0.2.%d' % (i + 1))
+            for i, name in enumerate(extra_vsms)]
+
+        other_tsm = self._add_tsm(
+            self._add_account('OtherTenant'), 'OtherVSM', '127.0.0.2')
+        for _ in range(inventory_size):
+            self._add_filesystem(str(uuid.uuid4()), other_tsm, 1024)
+
+        self._write_targets()
+
+    def _next_id(self):
+        return str(uuid.UUID(int=next(self._ids)))
+
+    def _add_account(self, name):
+        account = {'id': self._next_id(), 'name': name}
+        self.accounts.append(account)
+        for group in ('ALL', 'None'):
+            ig_id = self._next_id()
+            self.initiator_groups[ig_id] = {
+                'id': ig_id, 'initiatorgroup': group,
+                'accountid': account['id']}
+        return account
+
+    def _add_tsm(self, account, name, ip):
+        tsm = {'id': self._next_id(), 'name': name, 'accountid': account['id'],
+               'datasetid': self._next_id(), 'ipaddress': ip,
+               'totalquota': '%dG' % self.vsm_quota_gb,
+               'totaliops': str(self.vsm_iops)}
+        self.tsms.append(tsm)
+        return tsm
+
+    def _add_filesystem(self, name, tsm, size_mib, qosgroupid=None):
+        fs_id = self._next_id()
+        self.filesystems[fs_id] = {
+            'id': fs_id, 'name': name, 'Tsmid': tsm['id'],
+            'accountid': tsm['accountid'], 'ipaddress': tsm['ipaddress'],
+            'iqnname': 'iqn.2016-01.com.cloudbyte:%s' % name.replace('-', ''),
+            'currentTotalSpace': str(size_mib), 'groupid': qosgroupid,
+            'path': '/%s/%s' % (tsm['name'], name), 'compression': 'off',
+            'deduplication': 'off', 'sync': 'always', 'recordsize': '16k',
+            'blocklength': '512B', 'protocoltype': 'ISCSI', 'status': 'Online',
+        }
+        service_id = self._next_id()
+        self.iscsi_services[service_id] = {
+            'id': service_id, 'volume_id': fs_id, 'igid': None}
+        return self.filesystems[fs_id]
+
+    def _write_targets(self):
+        if not self.iscsi_root:
+            return
+        targets = collections.defaultdict(list)
+        for fs in self.filesystems.values():
+            targets[fs['ipaddress']].append(fs['iqnname'])
+            if fs['Tsmid'] == self.tsm['id']:
+                for portal in self.vsm_portals:
+                    targets[portal].append(fs['iqnname'])
+        path = os.path.join(self.iscsi_root, 'targets.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(targets, f)
+        os.rename(path + '.tmp', path)
+
+    def _submit_job(self, on_complete):
+        job_id = self._next_id()
+        self.jobs[job_id] = {'done_at': time.time() + self.job_duration,
+                             'on_complete': on_complete, 'status': 0}
+        return job_id
+
+    def _run_due_jobs(self):
+        now = time.time()
+        for job in self.jobs.values():
+            if job['status'] == 0 and job['done_at'] <= now:
+                job['on_complete']()
+                job['status'] = 1
+
+    def handle(self, command, params):
+        """Run one API command, returning (http status, response dict)."""
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.request_counts[command] += 1
+            self._run_due_jobs()
+            handler = getattr(self, 'cmd_' + command, None)
+            if handler is None:
+                return 431, {'errorresponse': {
+                    'errortext': 'Unknown command ' + command}}
+            try:
+                return 200, handler(params)
+            except KeyError as e:
+                return 431, {'errorresponse': {
+                    'errortext': 'Missing or unknown ' + str(e)}}
+            except ValueError as e:
+                return 431, {'errorresponse': {'errortext': str(e)}}
+
+    def cmd_listAccount(self, params):
+        return {'listAccountResponse': {'account': list(self.accounts)}}
+
+    def _tsm_usage(self, tsm):
+        """Return (MiB, IOPS) taken by the volumes of a TSM."""
+
+        filesystems = [fs for fs in self.filesystems.values()
+                       if fs['Tsmid'] == tsm['id']]
+        groups = set(fs['groupid'] for fs in filesystems)
+        return (sum(int(fs['currentTotalSpace']) for fs in filesystems),
+                sum(int(g.get('iops', 0)) for gid, g in self.qos_groups.items()
+                    if gid in groups))
+
+    def cmd_listTsm(self, params):
+        tsms = []
+        for tsm in self.tsms:
+            if tsm['accountid'] != params.get('accountid', tsm['accountid']):
+                continue
+            used_mib, used_iops = self._tsm_usage(tsm)
+            total_mib = int(tsm['totalquota'].rstrip('G')) * 1024
+            tsms.append(dict(
+                tsm, availablequota='%dM' % max(0, total_mib - used_mib),
+                availableiops=str(max(0, int(tsm['totaliops']) - used_iops))))
+        return {'listTsmResponse': {'listTsm': tsms}}
+
+    def cmd_addQosGroup(self, params):
+        qos_id = self._next_id()
+        self.qos_groups[qos_id] = dict(params, id=qos_id)
+        return {'addqosgroupresponse': {'qosgroup': self.qos_groups[qos_id]}}
+
+    def cmd_listQosGroup(self, params):
+        groups = [g for g in self.qos_groups.values()
+                  if g['tsmid'] == params.get('tsmid', g['tsmid'])]
+        return {'listqosgroupresponse': {'qosgroup': groups}}
+
+    def cmd_deleteQosGroup(self, params):
+        group_id = params['id']
+        if any(fs['groupid'] == group_id for fs in self.filesystems.values()):
+            raise ValueError('qos group ' + group_id + ' is in use')
+        del self.qos_groups[group_id]
+        return {'deleteqosgroupresponse': {'id': group_id}}
+
+    def cmd_createVolume(self, params):
+        tsm = [t for t in self.tsms if t['id'] == params['tsmid']][0]
+        size_mib = int(params['quotasize'].rstrip('G')) * 1024
+        name = params['name']
+        qosgroupid = params['qosgroupid']
+
+        def complete():
+            self._add_filesystem(name, tsm, size_mib, qosgroupid)
+            self._write_targets()
+
+        return {'createvolumeresponse': {'jobid': self._submit_job(complete)}}
+
+    def cmd_deleteFileSystem(self, params):
+        fs_id = params['id']
+        if fs_id not in self.filesystems:
+            raise KeyError('filesystem ' + fs_id)
+
+        def complete():
+            self.filesystems.pop(fs_id, None)
+            self.snapshots.pop(fs_id, None)
+            for service_id, service in list(self.iscsi_services.items()):
+                if service['volume_id'] == fs_id:
+                    del self.iscsi_services[service_id]
+            self._write_targets()
+
+        return {'deleteFileSystemResponse': {
+            'jobid': self._submit_job(complete)}}
+
+    def cmd_updateFileSystem(self, params):
+        filesystem = self.filesystems[params['id']]
+        if 'name' in params:
+            filesystem['name'] = params['name']
+        if 'quotasize' in params:
+            filesystem['currentTotalSpace'] = str(
+                int(params['quotasize'].rstrip('G')) * 1024)
+        return {'updatefilesystemresponse': {'filesystem': filesystem}}
+
+    def cmd_createStorageSnapshot(self, params):
+        filesystem = self.filesystems[params['id']]
+        if any(snap['name'] == params['name']
+               for snap in self.snapshots[filesystem['id']]):
+            raise ValueError('snapshot ' + params['name'] + ' exists')
+        snapshot = {'id': self._next_id(), 'name': params['name'],
+                    'path': '%s@%s' % (filesystem['path'], params['name'])}
+        self.snapshots[filesystem['id']].append(snapshot)
+        return {'createStorageSnapshotResponse': {'StorageSnapshot': snapshot}}
+
+    def cmd_listStorageSnapshots(self, params):
+        return {'listDatasetSnapshotsResponse': {
+            'snapshot': list(self.snapshots.get(params['id'], []))}}
+
+    def cmd_cloneDatasetSnapshot(self, params):
+        source = self.filesystems[params['id']]
+        if not any(snap['path'] == params['path']
+                   for snap in self.snapshots.get(source['id'], [])):
+            raise KeyError('snapshot ' + params['path'])
+
+        tsm = [t for t in self.tsms if t['id'] == source['Tsmid']][0]
+        clone = self._add_filesystem(
+            params['clonename'], tsm, int(source['currentTotalSpace']),
+            source['groupid'])
+        self._write_targets()
+        return {'cloneDatasetSnapshot': {'filesystem': clone}}
+
+    def cmd_queryAsyncJobResult(self, params):
+        job = self.jobs[params['jobId']]
+        return {'queryasyncjobresultresponse': {
+            'jobid': params['jobId'], 'jobstatus': job['status'],
+            'jobresult': {}}}
+
+    def cmd_listFileSystem(self, params):
+        filesystems = [
+            fs for fs in self.filesystems.values()
+            if fs['id'] == params.get('id', fs['id']) and
+            fs['Tsmid'] == params.get('tsmid', fs['Tsmid']) and
+            fs['accountid'] == params.get('accountid', fs['accountid'])]
+
+        if 'pagesize' in params:
+            page_size = int(params['pagesize'])
+            start = (int(params.get('page', 1)) - 1) * page_size
+            filesystems = filesystems[start:start + page_size]
+
+        return {'listFilesystemResponse': {'filesystem': filesystems}}
+
+    def cmd_listVolumeiSCSIService(self, params):
+        services = [s for s in self.iscsi_services.values()
+                    if s['volume_id'] == params.get('storageid',
+                                                    s['volume_id'])]
+        return {'listVolumeiSCSIServiceResponse': {'iSCSIService': services}}
+
+    def cmd_listiSCSIInitiator(self, params):
+        groups = [g for g in self.initiator_groups.values()
+                  if g['accountid'] == params.get('accountid',
+                                                  g['accountid'])]
+        return {'listInitiatorsResponse': {'initiator': groups}}
+
+    def cmd_updateVolumeiSCSIService(self, params):
+        service = self.iscsi_services[params['id']]
+        service['igid'] = params['igid']
+        return {'updatingvolumeiscsidetails': service}
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes on kept-alive sockets
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        query = urllib.parse.urlparse(self.path).query
+        params = dict(urllib.parse.parse_qsl(query))
+        command = params.pop('command', '')
+        params.pop('response', None)
+        params.pop('apiKey', None)
+
+        status, data = self.server.elasticenter.handle(command, params)
+
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(elasticenter, host='127.0.0.1', port=0, certfile=None):
+    """Serve elasticenter from a background thread; returns the server.
+
+    HTTPS is used when a PEM certfile (certificate and key) is given.
+    """
+
+    server = _Server((host, port), _RequestHandler)
+    server.elasticenter = elasticenter
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.load_cert_chain(certfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
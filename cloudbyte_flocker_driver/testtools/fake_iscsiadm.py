@@ -0,0 +1,332 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Stand-in for iscsiadm backed by a state directory.
+
+Usage: python fake_iscsiadm.py --root DIR <iscsiadm arguments>
+
+DIR holds the session/node state, the targets each portal advertises
+(targets.json, written by the fake ElastiCenter), a log of every
+invocation (calls.log) and a fake dev tree; logging in creates
+DIR/dev/sdX and its DIR/dev/disk/by-path link, logging out removes them.
+
+Node records keep the settings written with `-o update`; a session
+negotiates the record's iSCSI parameters, capped at what the target
+allows (TARGET_LIMITS). Each disk also gets a DIR/sys/block/sdX/queue
+directory holding QUEUE_DEFAULTS.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import sys
+
+ISCSI_ERR_SESS_EXISTS = 15
+ISCSI_ERR_NO_OBJS_FOUND = 21
+
+NODE_DEFAULTS = {
+    'node.session.cmds_max': '128',
+    'node.session.queue_depth': '32',
+    'node.session.nr_sessions': '1',
+    'node.conn[0].iscsi.MaxRecvDataSegmentLength': '262144',
+    'node.session.iscsi.FirstBurstLength': '262144',
+    'node.session.iscsi.MaxBurstLength': '16776192',
+    'node.session.iscsi.ImmediateData': 'Yes',
+    'node.session.iscsi.InitialR2T': 'No',
+}
+
+# Largest values the fake target accepts during negotiation
+TARGET_LIMITS = {
+    'MaxRecvDataSegmentLength': 262144,
+    'FirstBurstLength': 262144,
+    'MaxBurstLength': 1048576,
+}
+
+
+QUEUE_DEFAULTS = {
+    'scheduler': '[mq-deadline] kyber bfq none',
+    'read_ahead_kb': '128',
+    'nr_requests': '64',
+    'max_sectors_kb': '1280',
+    'rq_affinity': '1',
+    'nomerges': '0',
+    'add_random': '0',
+    'rotational': '1',
+}
+
+
+# Resolved on import, before a test runner can change directory
+_SCRIPT = os.path.abspath(__file__)
+if _SCRIPT.endswith('.pyc'):
+    _SCRIPT = _SCRIPT[:-1]
+
+
+def by_path_dir(root):
+    return os.path.join(root, 'dev', 'disk', 'by-path')
+
+
+def sysfs_root(root):
+    return os.path.join(root, 'sys')
+
+
+def add_block_device(root, name, slaves=()):
+    """Create the fake sysfs directory of a block device."""
+
+    block = os.path.join(sysfs_root(root), 'block', name)
+    queue = os.path.join(block, 'queue')
+    if not os.path.isdir(queue):
+        os.makedirs(queue)
+        for key, value in QUEUE_DEFAULTS.items():
+            with open(os.path.join(queue, key), 'w') as f:
+                f.write(value + '\n')
+    if slaves:
+        slaves_dir = os.path.join(block, 'slaves')
+        if os.path.isdir(slaves_dir):
+            shutil.rmtree(slaves_dir)
+        os.makedirs(slaves_dir)
+        for slave in slaves:
+            open(os.path.join(slaves_dir, slave), 'w').close()
+
+
+def remove_block_device(root, name):
+    shutil.rmtree(os.path.join(sysfs_root(root), 'block', name),
+                  ignore_errors=True)
+
+
+def _link_name(ip, iqn):
+    return 'ip-%s:3260-iscsi-%s-lun-0' % (ip, iqn)
+
+
+def _load(root, name, default):
+    try:
+        with open(os.path.join(root, name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def _store(root, name, value):
+    path = os.path.join(root, name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(value, f)
+    os.rename(path + '.tmp', path)
+
+
+def _option(args, *names):
+    for name in names:
+        if name in args:
+            return args[args.index(name) + 1]
+    return None
+
+
+def _portal_ip(portal):
+    return portal.rsplit(':', 1)[0] if portal.count(':') == 1 else portal
+
+
+class FakeISCSI(object):
+    def __init__(self, root):
+        self.root = root
+        self.state = _load(root, 'state.json', {
+            'sessions': [], 'nodes': [], 'devices': {}, 'next_sid': 1,
+            'next_disk': 0})
+        # 'ip iqn' -> settings written to the node record
+        self.state.setdefault('settings', {})
+        # session id -> negotiated parameters
+        self.state.setdefault('negotiated', {})
+
+    def save(self):
+        _store(self.root, 'state.json', self.state)
+
+    def discovery(self, args):
+        ip = _portal_ip(_option(args, '-p', '--portal'))
+        advertised = _load(self.root, 'targets.json', {})
+        for iqn in advertised.get(ip, []):
+            # sendtargets reports every portal of the target
+            for portal in sorted(advertised):
+                if iqn not in advertised[portal]:
+                    continue
+                if [portal, iqn] not in self.state['nodes']:
+                    self.state['nodes'].append([portal, iqn])
+                print('%s:3260,1 %s' % (portal, iqn))
+        return 0
+
+    def list_sessions(self):
+        if not self.state['sessions']:
+            sys.stderr.write('iscsiadm: No active sessions.\n')
+            return ISCSI_ERR_NO_OBJS_FOUND
+        for sid, ip, iqn in self.state['sessions']:
+            print('tcp: [%d] %s:3260,1 %s (non-flash)' % (sid, ip, iqn))
+        return 0
+
+    def list_nodes(self):
+        if not self.state['nodes']:
+            sys.stderr.write('iscsiadm: No records found\n')
+            return ISCSI_ERR_NO_OBJS_FOUND
+        for ip, iqn in self.state['nodes']:
+            print('%s:3260,1 %s' % (ip, iqn))
+        return 0
+
+    def _record(self, ip, iqn):
+        record = dict(NODE_DEFAULTS)
+        record.update(self.state['settings'].get('%s %s' % (ip, iqn), {}))
+        return record
+
+    def show_node(self, ip, iqn):
+        if [ip, iqn] not in self.state['nodes']:
+            sys.stderr.write('iscsiadm: No records found\n')
+            return ISCSI_ERR_NO_OBJS_FOUND
+        print('node.name = %s' % iqn)
+        print('node.conn[0].address = %s' % ip)
+        for key, value in sorted(self._record(ip, iqn).items()):
+            print('%s = %s' % (key, value))
+        return 0
+
+    def update_node(self, ip, iqn, name, value):
+        if [ip, iqn] not in self.state['nodes']:
+            return ISCSI_ERR_NO_OBJS_FOUND
+        self.state['settings'].setdefault('%s %s' % (ip, iqn), {})[name] = value
+        return 0
+
+    def _negotiate(self, ip, iqn):
+        negotiated = {}
+        for key, value in self._record(ip, iqn).items():
+            if '.iscsi.' not in key:
+                continue
+            name = key.rsplit('.', 1)[1]
+            if name in TARGET_LIMITS:
+                value = str(min(int(value), TARGET_LIMITS[name]))
+            negotiated[name] = value
+        return negotiated
+
+    def list_session_details(self):
+        if not self.state['sessions']:
+            sys.stderr.write('iscsiadm: No active sessions.\n')
+            return ISCSI_ERR_NO_OBJS_FOUND
+        for sid, ip, iqn in self.state['sessions']:
+            print('Target: %s (non-flash)' % iqn)
+            print('\tCurrent Portal: %s:3260,1' % ip)
+            print('\tPersistent Portal: %s:3260,1' % ip)
+            print('\t\tSID: %d' % sid)
+            print('\t\tiSCSI Session State: LOGGED_IN')
+            print('\t\t************************')
+            print('\t\tNegotiated iSCSI params:')
+            print('\t\t************************')
+            for name, value in sorted(
+                    self.state['negotiated'].get(str(sid), {}).items()):
+                print('\t\t%s: %s' % (name, value))
+        return 0
+
+    def _session(self, ip, iqn):
+        for session in self.state['sessions']:
+            if session[1:] == [ip, iqn]:
+                return session
+        return None
+
+    def login(self, ip, iqn):
+        if [ip, iqn] not in self.state['nodes']:
+            return ISCSI_ERR_NO_OBJS_FOUND
+        if self._session(ip, iqn):
+            return ISCSI_ERR_SESS_EXISTS
+
+        sid = self.state['next_sid']
+        self.state['next_sid'] += 1
+        self.state['sessions'].append([sid, ip, iqn])
+        self.state['negotiated'][str(sid)] = self._negotiate(ip, iqn)
+
+        disk = 'sdfake%d' % self.state['next_disk']
+        self.state['next_disk'] += 1
+        self.state['devices'][_link_name(ip, iqn)] = disk
+
+        devdir = os.path.join(self.root, 'dev')
+        open(os.path.join(devdir, disk), 'w').close()
+        add_block_device(self.root, disk)
+        os.symlink(os.path.join('..', '..', disk),
+                   os.path.join(by_path_dir(self.root), _link_name(ip, iqn)))
+        print('Login to [iface: default, target: %s, portal: %s,3260] '
+              'successful.' % (iqn, ip))
+        return 0
+
+    def logout(self, ip, iqn):
+        session = self._session(ip, iqn)
+        if session is None:
+            return ISCSI_ERR_NO_OBJS_FOUND
+        self.state['sessions'].remove(session)
+        self.state['negotiated'].pop(str(session[0]), None)
+
+        disk = self.state['devices'].pop(_link_name(ip, iqn))
+        os.unlink(os.path.join(by_path_dir(self.root), _link_name(ip, iqn)))
+        os.unlink(os.path.join(self.root, 'dev', disk))
+        remove_block_device(self.root, disk)
+        return 0
+
+    def delete(self, iqn):
+        nodes = [node for node in self.state['nodes'] if node[1] != iqn]
+        if len(nodes) == len(self.state['nodes']):
+            return ISCSI_ERR_NO_OBJS_FOUND
+        self.state['nodes'] = nodes
+        for key in list(self.state['settings']):
+            if key.split(' ', 1)[1] == iqn:
+                del self.state['settings'][key]
+        return 0
+
+    def run(self, args):
+        mode = _option(args, '-m', '--mode')
+        portal = _option(args, '-p', '--portal')
+        iqn = _option(args, '-T', '--targetname')
+
+        if mode == 'discovery':
+            return self.discovery(args)
+        if mode == 'session':
+            if _option(args, '-P', '--print'):
+                return self.list_session_details()
+            return self.list_sessions()
+        if mode != 'node':
+            return 1
+        if '--login' in args or '-l' in args:
+            return self.login(_portal_ip(portal), iqn)
+        if '--logout' in args or '-u' in args:
+            return self.logout(_portal_ip(portal), iqn)
+        op = _option(args, '-o', '--op')
+        if op == 'delete':
+            return self.delete(iqn)
+        if op == 'update':
+            return self.update_node(_portal_ip(portal), iqn,
+                                    _option(args, '-n', '--name'),
+                                    _option(args, '-v', '--value'))
+        if portal and iqn:
+            return self.show_node(_portal_ip(portal), iqn)
+        return self.list_nodes()
+
+
+def prepare_root(root):
+    """Create the directory layout the fake iscsiadm expects."""
+
+    if not os.path.isdir(by_path_dir(root)):
+        os.makedirs(by_path_dir(root))
+
+
+def command_line(root):
+    """Return an iscsiadm_command running this fake against root."""
+
+    return '"%s" "%s" --root "%s"' % (sys.executable, _SCRIPT, root)
+
+
+def main(argv):
+    root = _option(argv, '--root')
+    args = argv[argv.index('--root') + 2:]
+    prepare_root(root)
+
+    with open(os.path.join(root, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(os.path.join(root, 'calls.log'), 'a') as log:
+            log.write(' '.join(args) + '\n')
+
+        iscsi = FakeISCSI(root)
+        code = iscsi.run(args)
+        iscsi.save()
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
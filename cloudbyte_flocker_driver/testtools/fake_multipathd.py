@@ -0,0 +1,147 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Stand-in for multipathd sharing the state directory of the fake iscsiadm.
+
+Usage: python fake_multipathd.py --root DIR <multipathd arguments>
+
+Every target with at least one fake iSCSI session gets a map, named
+mpathN and backed by DIR/dev/dm-N (and DIR/sys/block/dm-N, its disks
+listed as slaves), holding the disks of all of its sessions. Only the commands the driver runs are understood:
+
+    show paths raw format "%d %m"
+    show maps raw format "%n %d"
+    del map NAME
+    reconfigure
+
+Invocations are logged to DIR/calls.log like those of the fake iscsiadm.
+"""
+
+import fcntl
+import os
+import sys
+
+if __name__ == '__main__':
+    # Run as a script; importing the package would pull in Flocker
+    import fake_iscsiadm
+else:
+    from cloudbyte_flocker_driver.testtools import fake_iscsiadm
+
+# Resolved on import, before a test runner can change directory
+_SCRIPT = os.path.abspath(__file__)
+if _SCRIPT.endswith('.pyc'):
+    _SCRIPT = _SCRIPT[:-1]
+
+
+class FakeMultipathd(object):
+    def __init__(self, root):
+        self.root = root
+        self.iscsi = fake_iscsiadm._load(root, 'state.json', {
+            'sessions': [], 'devices': {}})
+        self.state = fake_iscsiadm._load(root, 'multipath.json', {
+            'maps': {}, 'flushed': [], 'next_dm': 0, 'reconfigured': 0})
+
+    def save(self):
+        fake_iscsiadm._store(self.root, 'multipath.json', self.state)
+
+    def _paths(self):
+        """Map iqn to the disks of its sessions."""
+
+        paths = {}
+        for _, ip, iqn in self.iscsi['sessions']:
+            disk = self.iscsi['devices'].get(fake_iscsiadm._link_name(ip, iqn))
+            if disk:
+                paths.setdefault(iqn, []).append(disk)
+        return paths
+
+    def sync(self):
+        """Assemble maps for new targets and drop those without paths."""
+
+        paths = self._paths()
+        maps = self.state['maps']
+        # A flushed map stays down until the target has new paths
+        self.state['flushed'] = [
+            [iqn, disks] for iqn, disks in self.state['flushed']
+            if sorted(paths.get(iqn, [])) == disks]
+        flushed = set(iqn for iqn, _ in self.state['flushed'])
+
+        for name, info in list(maps.items()):
+            if info['iqn'] not in paths:
+                self._remove(name)
+
+        mapped = set(info['iqn'] for info in maps.values())
+        for iqn in sorted(paths):
+            if iqn in mapped or iqn in flushed:
+                continue
+            dm = 'dm-%d' % self.state['next_dm']
+            self.state['next_dm'] += 1
+            maps['mpath%s' % dm[3:]] = {'iqn': iqn, 'dm': dm}
+            open(os.path.join(self.root, 'dev', dm), 'w').close()
+
+        for info in maps.values():
+            fake_iscsiadm.add_block_device(self.root, info['dm'],
+                                           paths[info['iqn']])
+        return paths
+
+    def _remove(self, name):
+        info = self.state['maps'].pop(name)
+        try:
+            os.unlink(os.path.join(self.root, 'dev', info['dm']))
+        except OSError:
+            pass
+        fake_iscsiadm.remove_block_device(self.root, info['dm'])
+
+    def run(self, args):
+        paths = self.sync()
+        by_iqn = dict((info['iqn'], name)
+                      for name, info in self.state['maps'].items())
+
+        if args[:2] == ['show', 'paths']:
+            for iqn in sorted(paths):
+                for disk in paths[iqn]:
+                    print('%s %s' % (disk, by_iqn.get(iqn, '[orphan]')))
+            return 0
+        if args[:2] == ['show', 'maps']:
+            for name, info in sorted(self.state['maps'].items()):
+                print('%s %s' % (name, info['dm']))
+            return 0
+        if args[:2] == ['del', 'map'] and len(args) > 2:
+            if args[2] not in self.state['maps']:
+                print('fail')
+                return 1
+            iqn = self.state['maps'][args[2]]['iqn']
+            self.state['flushed'].append([iqn, sorted(paths[iqn])])
+            self._remove(args[2])
+            print('ok')
+            return 0
+        if args[:1] == ['reconfigure']:
+            self.state['reconfigured'] += 1
+            print('ok')
+            return 0
+        return 1
+
+
+def command_line(root):
+    """Return a multipathd_command running this fake against root."""
+
+    return '"%s" "%s" --root "%s"' % (sys.executable, _SCRIPT, root)
+
+
+def main(argv):
+    root = fake_iscsiadm._option(argv, '--root')
+    args = argv[argv.index('--root') + 2:]
+    fake_iscsiadm.prepare_root(root)
+
+    with open(os.path.join(root, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(os.path.join(root, 'calls.log'), 'a') as log:
+            log.write('multipathd ' + ' '.join(args) + '\n')
+
+        multipathd = FakeMultipathd(root)
+        code = multipathd.run(args)
+        multipathd.save()
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
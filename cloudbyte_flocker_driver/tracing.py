@@ -0,0 +1,193 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Lightweight per-operation tracing spans.
+
+Every public driver operation opens a root span; ElastiCenter commands,
+job polls, iscsiadm runs and waits nested inside it become child spans.
+A configurable fraction of root spans is sampled and every finished span
+of a sampled trace is handed to an exporter.
+"""
+
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+
+class _NoopSpan(object):
+    """Span used outside sampled traces; discards everything."""
+
+    sampled = False
+
+    def set(self, key, value):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _new_id():
+    return '%016x' % random.getrandbits(64)
+
+
+class Span(object):
+    sampled = True
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.end = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id, 'span_id': self.span_id,
+            'parent_id': self.parent_id, 'name': self.name,
+            'start': self.start, 'duration': self.end - self.start,
+            'thread': self.thread, 'attributes': self.attributes,
+        }
+
+
+class _SpanContext(object):
+    def __init__(self, tracer, name, parent, attributes):
+        self._tracer = tracer
+        self._name = name
+        self._parent = parent
+        self._attributes = attributes
+        self._span = None
+
+    def __enter__(self):
+        self._span = self._tracer._start(self._name, self._parent,
+                                         self._attributes)
+        return self._span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._tracer._finish(self._span, exc_value)
+        return False
+
+
+class Tracer(object):
+    """Creates spans and tracks the current one per thread."""
+
+    def __init__(self, sample_rate=0.0, exporter=None):
+        self.sample_rate = sample_rate if exporter is not None else 0.0
+        self.exporter = exporter
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self):
+        """Return the innermost open span of this thread, or None."""
+
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def span(self, name, parent=None, **attributes):
+        """Context manager for a span, child of parent or the current span.
+
+        parent lets work running on another thread join the caller's trace.
+        """
+
+        return _SpanContext(self, name, parent, attributes)
+
+    def _start(self, name, parent, attributes):
+        if parent is None:
+            parent = self.current()
+
+        if parent is None:
+            # A new root: decide once whether the whole trace is recorded
+            if self.sample_rate > 0 and random.random() < self.sample_rate:
+                span = Span(name, _new_id(), None, attributes)
+            else:
+                span = NOOP_SPAN
+        elif parent.sampled:
+            span = Span(name, parent.trace_id, parent.span_id, attributes)
+        else:
+            span = NOOP_SPAN
+
+        self._stack().append(span)
+        return span
+
+    def _finish(self, span, error):
+        self._stack().pop()
+        if not span.sampled:
+            return
+        span.end = time.time()
+        if error is not None:
+            span.set('error', repr(error))
+        self.exporter.export(span)
+
+
+class JSONLinesExporter(object):
+    """Append every finished span to a file as one JSON object per line."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+
+class ChromeTraceExporter(object):
+    """Write spans as Chrome trace events (chrome://tracing, Perfetto).
+
+    The file is a JSON array that is left open so it can be appended to
+    while the agent runs; the trace viewers accept that form.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a')
+        if new:
+            self._file.write('[\n')
+
+    def export(self, span):
+        event = {
+            'name': span.name, 'cat': 'cloudbyte', 'ph': 'X',
+            'ts': int(span.start * 1e6),
+            'dur': int((span.end - span.start) * 1e6),
+            'pid': os.getpid(), 'tid': span.thread,
+            'args': dict(span.attributes, trace_id=span.trace_id,
+                         span_id=span.span_id, parent_id=span.parent_id),
+        }
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self._file.write(line + ',\n')
+            self._file.flush()
+
+
+EXPORTERS = {
+    'jsonl': JSONLinesExporter,
+    'chrome': ChromeTraceExporter,
+}
+
+
+def traced(method):
+    """Run a driver method inside a span named after it."""
+
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.tracer.span(name):
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,124 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Indexed views over CloudByte volume listings."""
+
+import itertools
+
+from cloudbyte_flocker_driver import jsonstream
+
+# listFileSystem fields the driver reads; everything else is dropped
+FILESYSTEM_FIELDS = ('id', 'name', 'Tsmid', 'ipaddress', 'iqnname',
+                     'currentTotalSpace', 'groupid')
+
+# Number of names quoted in "volume not found" messages
+MAX_LISTED_VOLUMES = 10
+
+
+class FileSystemRecord(object):
+    """Compact copy of a listFileSystem entry, readable like the dict."""
+
+    __slots__ = FILESYSTEM_FIELDS
+
+    def __init__(self, filesystem):
+        for field in FILESYSTEM_FIELDS:
+            setattr(self, field, filesystem.get(field))
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def __repr__(self):
+        return 'FileSystemRecord(%r)' % dict(
+            (field, getattr(self, field)) for field in FILESYSTEM_FIELDS)
+
+
+def index_by(items, key):
+    """Map each item's key field to the first item carrying it."""
+
+    index = {}
+    for item in items:
+        index.setdefault(item.get(key), item)
+    return index
+
+
+def filesystems_from_response(cb_volumes):
+    """Return the volume list of a listFileSystem response."""
+
+    volumes_res = cb_volumes.get('listFilesystemResponse')
+
+    if volumes_res is None:
+        msg = ("No response was received from CloudByte's "
+                "list filesystem api call.")
+        raise ValueError(msg)
+
+    return volumes_res.get('filesystem') or []
+
+
+def read_filesystems_response(response):
+    """Decode a listFileSystem HTTP response into FileSystemRecords.
+
+    The filesystem array is decoded one entry at a time while it streams
+    in, so only the compact records of a large inventory stay in memory.
+    The result has the shape of the JSON response.
+    """
+
+    stream = jsonstream.JSONArrayStream(response, 'filesystem')
+    records = [FileSystemRecord(fs) for fs in stream]
+    if not stream.found:
+        return stream.document
+
+    # Drain the rest of the body so the connection can be reused
+    response.read()
+    return {'listFilesystemResponse': {'filesystem': records}}
+
+
+def describe(names, limit=MAX_LISTED_VOLUMES):
+    """Short listing of a sized collection of names for error messages."""
+
+    shown = ', '.join(str(name) for name in itertools.islice(names, limit))
+    if len(names) > limit:
+        shown += ', ... %d more' % (len(names) - limit)
+    return shown
+
+
+class VolumeIndex(object):
+    """Hash lookups over the volumes of a listFileSystem response."""
+
+    def __init__(self, volumes):
+        self.volumes = volumes
+        self.by_id = {}
+        self.by_name = {}
+        self.by_tsm = {}
+        self.by_iqn = {}
+
+        for vol in volumes:
+            self.by_id[vol['id']] = vol
+            self.by_name.setdefault(vol['name'], vol)
+            self.by_tsm.setdefault(vol.get('Tsmid'), []).append(vol)
+            if vol.get('iqnname'):
+                self.by_iqn[vol['iqnname']] = vol
+
+    @classmethod
+    def from_response(cls, cb_volumes):
+        return cls(filesystems_from_response(cb_volumes))
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def get(self, cb_volume_id):
+        return self.by_id.get(cb_volume_id)
+
+    def get_by_name(self, cb_volume_name):
+        return self.by_name.get(cb_volume_name)
+
+    def get_by_iqn(self, iqn):
+        return self.by_iqn.get(iqn)
+
+    def in_tsm(self, tsm_id):
+        return self.by_tsm.get(tsm_id, [])
@@ -0,0 +1,221 @@
+# Copyright 2016 CloudByte Inc
+# See LICENSE file for details.
+
+"""Pool of pre-provisioned volumes handed out by create_volume.
+
+Pool volumes are created, QoS-assigned and exported to the 'ALL'
+initiator group ahead of time, so claiming one only renames it to the
+dataset id. They are recognised in the ElastiCenter listing by their name,
+which also records the bucket and the node that owns them:
+
+    warmpool-<node>-<size>G-<random>-<profile>
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+
+from bitmath import GiB
+
+WARM_POOL_PREFIX = 'warmpool-'
+
+
+def is_pool_volume(name):
+    return str(name).startswith(WARM_POOL_PREFIX)
+
+
+def node_tag(instance_id):
+    """Short, name-safe tag of the node owning a pool volume."""
+
+    return hashlib.sha1(str(instance_id).encode('utf-8')).hexdigest()[:8]
+
+
+def pool_volume_name(node, quota, profile_name):
+    return '%s%s-%s-%s-%s' % (WARM_POOL_PREFIX, node, quota,
+                              uuid.uuid4().hex[:12], profile_name or '')
+
+
+def parse_pool_volume_name(name):
+    """Return (node, (profile, quota)) for a pool volume name, else None."""
+
+    if not is_pool_volume(name):
+        return None
+    parts = str(name)[len(WARM_POOL_PREFIX):].split('-', 3)
+    if len(parts) != 4:
+        return None
+    node, quota, _, profile_name = parts
+    return node, (profile_name or None, quota)
+
+
+class Bucket(object):
+    """Target number of ready volumes of one profile and size."""
+
+    def __init__(self, profile=None, size_gb=1, count=1, min_count=0):
+        self.profile = profile
+        self.quota = '%dG' % int(size_gb)
+        self.size = GiB(int(size_gb)).bytes
+        self.count = int(count)
+        self.min_count = min(int(min_count), self.count)
+
+    @property
+    def key(self):
+        return (self.profile, self.quota)
+
+
+class WarmPool(object):
+    """Keeps the configured buckets filled from a background thread.
+
+    ``driver`` is the CloudByteBlockDeviceAPI that volumes are created,
+    exported, bound and destroyed through. A bucket nobody claimed from
+    for ``idle_timeout`` seconds is trimmed down to its ``min_count``; the
+    next claim restores its full ``count``.
+    """
+
+    def __init__(self, driver, buckets, refill_interval=30, idle_timeout=3600):
+        self._driver = driver
+        self.buckets = dict((bucket.key, bucket) for bucket in buckets)
+        self.refill_interval = refill_interval
+        self.idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        # Ready pool volume ids per bucket key, oldest first
+        self._ready = dict((key, []) for key in self.buckets)
+        # Pool volumes known to be fully exported
+        self._prepared = set()
+        # Volumes handed out; listings taken before the rename still show
+        # them as pool volumes
+        self._claimed = set()
+        now = time.time()
+        self._last_claim = dict((key, now) for key in self.buckets)
+
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self._stopped.is_set():
+                return
+            # Buckets are idle from the moment the pool starts filling
+            now = time.time()
+            self._last_claim = dict((key, now) for key in self.buckets)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop refilling, waiting up to timeout for a running round."""
+
+        self._stopped.set()
+        self._wakeup.set()
+        with self._lock:
+            thread = self._thread
+        if thread is not None and timeout:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refill()
+            except Exception:
+                # ElastiCenter may be unreachable, try again next round
+                pass
+            self._wakeup.wait(self.refill_interval)
+            self._wakeup.clear()
+
+    def ready(self, profile_name, quota):
+        with self._lock:
+            return len(self._ready.get((profile_name, quota), []))
+
+    def claim(self, dataset_id, profile_name, quota):
+        """Bind a ready volume to dataset_id; return its id, or None."""
+
+        key = (profile_name, quota)
+        with self._lock:
+            if key not in self.buckets:
+                return None
+            self._last_claim[key] = time.time()
+            if not self._ready[key]:
+                self._wakeup.set()
+                return None
+            cb_volume_id = self._ready[key].pop(0)
+            self._claimed.add(cb_volume_id)
+
+        try:
+            self._driver._bind_pool_volume(cb_volume_id, dataset_id)
+        except Exception:
+            # Still a pool volume as far as we know, the next refill
+            # picks it up again if it exists
+            with self._lock:
+                self._claimed.discard(cb_volume_id)
+            return None
+        finally:
+            self._wakeup.set()
+
+        return cb_volume_id
+
+    def _target(self, bucket, now):
+        if self.idle_timeout and now - self._last_claim[bucket.key] > self.idle_timeout:
+            return bucket.min_count
+        return bucket.count
+
+    def refill(self):
+        """Reconcile the pool with ElastiCenter, creating and trimming."""
+
+        driver = self._driver
+        node = node_tag(driver.compute_instance_id())
+        cb_volumes = driver._list_filesystems(fresh=True)
+
+        found = {}
+        for vol in cb_volumes.volumes:
+            parsed = parse_pool_volume_name(vol['name'])
+            if parsed is not None and parsed[0] == node:
+                found.setdefault(parsed[1], []).append(vol['id'])
+        found_ids = set(i for ids in found.values() for i in ids)
+
+        with self._lock:
+            # Claimed volumes drop out of the listing once renamed
+            self._claimed &= found_ids
+            for key in found:
+                found[key] = [i for i in found[key] if i not in self._claimed]
+            unprepared = [i for key in found if key in self.buckets
+                          for i in found[key] if i not in self._prepared]
+
+        for cb_volume_id in unprepared:
+            # Left over from an earlier run, make sure it is exported
+            driver._update_initiator_group(
+                cb_volume_id, 'ALL', cb_volumes.get(cb_volume_id).get('Tsmid'))
+            with self._lock:
+                self._prepared.add(cb_volume_id)
+
+        # Volumes of buckets removed from the configuration go away
+        surplus = [i for key in found if key not in self.buckets
+                   for i in found[key]]
+
+        now = time.time()
+        with self._lock:
+            for key, bucket in self.buckets.items():
+                listed = [i for i in found.get(key, [])
+                          if i not in self._claimed]
+                ready = [i for i in self._ready[key] if i in listed]
+                ready += [i for i in listed if i not in ready]
+                target = self._target(bucket, now)
+                surplus.extend(ready[target:])
+                self._ready[key] = ready[:target]
+            self._prepared &= found_ids
+
+        for cb_volume_id in surplus:
+            driver._destroy_volume(cb_volume_id, cb_volumes)
+
+        for key, bucket in self.buckets.items():
+            while not self._stopped.is_set():
+                with self._lock:
+                    if len(self._ready[key]) >= self._target(bucket, time.time()):
+                        break
+                cb_volume_id = driver._create_pool_volume(
+                    pool_volume_name(node, bucket.quota, bucket.profile),
+                    bucket.size, bucket.profile)
+                with self._lock:
+                    self._prepared.add(cb_volume_id)
+                    self._ready[key].append(cb_volume_id)